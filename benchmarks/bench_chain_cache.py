@@ -0,0 +1,57 @@
+"""Per-call overhead of building an LLM chain with and without memoization.
+
+Run with::
+
+    python benchmarks/bench_chain_cache.py
+"""
+
+import pathlib
+import timeit
+import warnings
+
+import yaml
+
+from chatify.chains import CreateLLMChain
+
+PROMPT_FILE = pathlib.Path(__file__).parents[1] / 'chatify' / 'prompts' / 'tutor.yaml'
+
+CONFIGS = {
+    'default': {
+        'cache_config': {'cache': False},
+        'model_config': {'model': 'fake_model'},
+        'chain_config': {'chain_type': 'default'},
+    },
+    'proxy': {
+        'cache_config': {'cache': False},
+        'model_config': {'model': 'proxy', 'proxy_url': 'http://127.0.0.1:1/prompt/'},
+        'chain_config': {'chain_type': 'proxy'},
+    },
+}
+
+
+def main(number=2000):
+    prompts = list(yaml.load(open(PROMPT_FILE), Loader=yaml.SafeLoader).values())
+    for name, config in CONFIGS.items():
+        llm_chain = CreateLLMChain(config)
+
+        def uncached():
+            for prompt in prompts:
+                llm_chain._build_chain(prompt)
+
+        def cached():
+            for prompt in prompts:
+                llm_chain.create_chain(config['model_config'], prompt_template=prompt)
+
+        calls = number * len(prompts)
+        before = timeit.timeit(uncached, number=number) / calls
+        after = timeit.timeit(cached, number=number) / calls
+        print(
+            f'{name:>8}: rebuilt {before * 1e6:8.1f} us/call, '
+            f'memoized {after * 1e6:8.1f} us/call ({before / after:5.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main()
@@ -0,0 +1,93 @@
+"""Import cost of ``%load_ext chatify``, measured with ``python -X importtime``.
+
+The extension is loaded into a fresh interpreter in which IPython has already
+been imported (as it is in a kernel), and the time spent importing modules on
+behalf of chatify is reported. Run with::
+
+    python benchmarks/bench_import_time.py [--max-ms 200]
+
+The script exits with status 1 if the import time exceeds ``--max-ms`` or if
+any of the heavy modules that should only load on first use is imported.
+"""
+
+import argparse
+import subprocess
+import sys
+
+# Modules that must not be imported until the first %%explain
+LAZY_MODULES = [
+    'langchain',
+    'langchain_core',
+    'langchain_community',
+    'ipywidgets',
+    'markdown_it',
+    'huggingface_hub',
+    'numpy',
+]
+
+SCRIPT = '''
+from IPython.core.interactiveshell import InteractiveShell
+shell = InteractiveShell.instance()
+import sys
+preloaded = set(sys.modules)
+import chatify
+chatify.load_ipython_extension(shell)
+print(",".join(sorted(set(sys.modules) - preloaded)))
+'''
+
+
+def measure():
+    """Loads the extension in a subprocess and parses its import times.
+
+    Returns
+    -------
+    total_us : int
+        Microseconds spent importing the modules loaded by the extension.
+    modules : dict
+        Self time in microseconds of every module loaded by the extension.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = set(result.stdout.strip().splitlines()[-1].split(','))
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:') :].split('|')
+        name = name.strip()
+        if name in loaded:
+            modules[name] = int(self_us)
+    return sum(modules.values()), modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-ms', type=float, default=None)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    total_us, modules = measure()
+    print(
+        f'%load_ext chatify imported {len(modules)} modules in {total_us / 1e3:.1f} ms'
+    )
+    for name, self_us in sorted(modules.items(), key=lambda item: -item[1])[: args.top]:
+        print(f'  {self_us / 1e3:8.1f} ms  {name}')
+
+    failed = False
+    eager = sorted(name for name in modules if name.split('.')[0] in LAZY_MODULES)
+    if eager:
+        print(f'Imported eagerly but should be lazy: {", ".join(eager)}')
+        failed = True
+    if args.max_ms is not None and total_us / 1e3 > args.max_ms:
+        print(f'Import time exceeds the {args.max_ms:.0f} ms budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
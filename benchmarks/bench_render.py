@@ -0,0 +1,99 @@
+"""Rendering time of large, code-heavy responses with ``get_html``.
+
+Compares the previous approach (a new parser, formatter and stylesheet for
+every response) with the shared renderer: cold, with memoized code blocks (as
+when a streamed response is re-rendered) and with memoized HTML. Run with::
+
+    python benchmarks/bench_render.py
+"""
+
+import timeit
+
+from markdown_it import MarkdownIt
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+
+from chatify.utils import MarkdownRenderer, _highlight, get_html
+
+CODE = '''
+def simulate(n_steps, dt=0.1, tau=10.0):
+    """Simulate a leaky integrate-and-fire neuron."""
+    v = np.zeros(n_steps)
+    for t in range(1, n_steps):
+        dv = (-(v[t - 1] - E_L) + R * I[t]) / tau
+        v[t] = v[t - 1] + dv * dt
+        if v[t] > V_th:
+            v[t] = V_reset
+    return v
+'''
+
+
+def make_response(n_blocks=20):
+    """Returns a markdown response with ``n_blocks`` distinct code blocks."""
+    parts = ['# 🤖 Step-by-step explanation\n']
+    for i in range(n_blocks):
+        parts.append(
+            f'## Step {i + 1}\n\nThis *step* updates the **membrane potential** '
+            f'using `dv` and https://example.com/docs/{i}.\n\n'
+            f'```python{CODE.replace("simulate", f"simulate_{i}")}```\n\n'
+            '- point one\n- point two\n'
+        )
+    return '\n'.join(parts)
+
+
+def previous_get_html(markdown, code_style='default'):
+    """The implementation ``get_html`` replaced, kept as a baseline."""
+
+    def highlight_code(code, name, attrs):
+        try:
+            lexer = get_lexer_by_name(name)
+        except Exception:
+            lexer = get_lexer_by_name('python')
+        formatter = HtmlFormatter(cssclass='codehilite', linenos='table')
+        return highlight(code, lexer, formatter)
+
+    md = MarkdownIt(
+        'js-default',
+        {
+            'linkify': True,
+            'html': True,
+            'typographer': True,
+            'highlight': highlight_code,
+        },
+    )
+    css = HtmlFormatter(style=code_style, linenos='table').get_style_defs()
+    return f'<head><style>{css}</style></head>' + md.render(markdown)
+
+
+def main(number=20):
+    renderer = MarkdownRenderer()
+
+    def cold(response):
+        # No memoized HTML and no memoized code blocks
+        _highlight.cache_clear()
+        return renderer.render(response, cache=False)
+
+    for n_blocks in (1, 20, 100):
+        response = make_response(n_blocks)
+        # Also primes the memoized renderer with the response
+        assert previous_get_html(response) == get_html(response)
+
+        timings = {
+            'previous': lambda: previous_get_html(response),
+            'cold': lambda: cold(response),
+            'warm blocks': lambda: renderer.render(response, cache=False),
+            'memoized': lambda: get_html(response),
+        }
+        results = {
+            name: timeit.timeit(fn, number=number) / number * 1e3
+            for name, fn in timings.items()
+        }
+        print(
+            f'{n_blocks:>4} code blocks ({len(response) / 1e3:6.1f} kB): '
+            + ', '.join(f'{name} {ms:8.3f} ms' for name, ms in results.items())
+        )
+
+
+if __name__ == '__main__':
+    main()
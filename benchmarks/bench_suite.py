@@ -0,0 +1,124 @@
+"""pytest-benchmark suite covering the request path, offline.
+
+Run with ``make bench``; see CONTRIBUTING.rst.
+"""
+
+import ast
+import json
+
+import pytest
+
+from chatify.answer_store import AnswerStore, write_answer_store
+from chatify.cache import cache_key
+from chatify.chains import CreateLLMChain
+from chatify.compaction import compact_code
+from chatify.main import Chatify
+from chatify.prompt_registry import PromptRegistry
+from chatify.transport import decode_response
+from chatify.utils import MarkdownRenderer, _highlight, compress_code, get_html
+
+import stub_server
+from bench_render import make_response
+
+
+@pytest.mark.parametrize('n_blocks', [1, 20])
+def bench_get_html_cold(benchmark, n_blocks):
+    renderer = MarkdownRenderer()
+    response = make_response(n_blocks)
+
+    def render():
+        _highlight.cache_clear()
+        return renderer.render(response, cache=False)
+
+    benchmark(render)
+
+
+def bench_get_html_memoized(benchmark):
+    response = make_response(20)
+    get_html(response)
+    benchmark(get_html, response)
+
+
+DECODERS = {
+    'json': decode_response,
+    'literal_eval': lambda content: ast.literal_eval(content.decode('utf-8')),
+    # What RequestChain used to do; only safe because we wrote the content
+    'eval': lambda content: eval(content.decode('utf-8')),
+}
+
+
+@pytest.mark.parametrize('decoder', list(DECODERS))
+def bench_decode_response(benchmark, decoder):
+    # The Python decoders turn the escaped emoji into surrogate pairs
+    content = json.dumps(make_response(100)).encode('utf-8')
+    benchmark(DECODERS[decoder], content)
+
+
+def bench_compress_code(benchmark, cell):
+    benchmark(compress_code, cell * 10)
+
+
+def bench_read_prompt_dir(benchmark, tmp_path, monkeypatch):
+    # Without a config.yaml in the working directory, Chatify uses its defaults
+    monkeypatch.chdir(tmp_path)
+    chatify = Chatify()
+    benchmark(chatify._read_prompt_dir)
+
+
+def bench_read_prompt_dir_cold(benchmark):
+    names = ['tutor', 'tester', 'inventer', 'experimenter']
+    benchmark(lambda: PromptRegistry(bundle_file=None).get_many(names))
+
+
+def bench_create_chain(benchmark, fake_config, prompt):
+    llm_chain = CreateLLMChain(fake_config)
+    benchmark(llm_chain.create_chain, fake_config['model_config'], prompt)
+
+
+def bench_create_chain_uncached(benchmark, fake_config, prompt):
+    llm_chain = CreateLLMChain(fake_config)
+    benchmark(llm_chain._build_chain, prompt)
+
+
+def bench_execute_fake_model(benchmark, fake_config, prompt, cell):
+    llm_chain = CreateLLMChain(fake_config)
+    chain = llm_chain.create_chain(fake_config['model_config'], prompt)
+    benchmark(llm_chain.execute, chain, cell)
+
+
+def bench_request_chain(benchmark, proxy_config, prompt, cell):
+    llm_chain = CreateLLMChain(proxy_config)
+    chain = llm_chain.create_chain(proxy_config['model_config'], prompt)
+    benchmark(llm_chain.execute, chain, cell)
+
+
+def bench_request_chain_legacy(benchmark, proxy_config, prompt, cell):
+    server = stub_server.serve(legacy=True)
+    proxy_config['model_config']['proxy_url'] = server.proxy_url
+    llm_chain = CreateLLMChain(proxy_config)
+    chain = llm_chain.create_chain(proxy_config['model_config'], prompt)
+    benchmark(llm_chain.execute, chain, cell)
+    server.shutdown()
+
+
+def bench_request_chain_streaming(benchmark, proxy_config, prompt, cell):
+    proxy_config['model_config']['streaming'] = True
+    llm_chain = CreateLLMChain(proxy_config)
+    chain = llm_chain.create_chain(proxy_config['model_config'], prompt)
+    benchmark(llm_chain.execute, chain, cell, on_update=lambda text: None)
+
+
+def bench_compact_code(benchmark, cell):
+    benchmark(compact_code, cell * 10)
+
+
+def bench_answer_store_lookup(benchmark, tmp_path, cell):
+    path = str(tmp_path / 'course.answers')
+    write_answer_store(
+        path,
+        ((cache_key('tutor', 'proxy', f'{cell}{i}'), cell * 5) for i in range(10000)),
+        models=['proxy'],
+    )
+    store = AnswerStore(path)
+    assert benchmark(store.get, 'tutor', f'{cell}5000') == cell * 5
+    store.close()
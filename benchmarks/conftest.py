@@ -0,0 +1,51 @@
+import warnings
+
+import pytest
+
+import stub_server
+from chatify.prompt_registry import get_registry
+
+
+def _config(model_config, chain_type):
+    return {
+        'cache_config': {'cache': False},
+        'feedback': False,
+        'model_config': model_config,
+        'chain_config': {'chain_type': chain_type},
+        'prompts_config': {'prompts_to_use': ['tutor', 'tester']},
+    }
+
+
+@pytest.fixture(autouse=True)
+def _ignore_warnings():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+@pytest.fixture(scope='session')
+def proxy_server():
+    server = stub_server.serve()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def fake_config():
+    return _config({'model': 'fake_model'}, 'default')
+
+
+@pytest.fixture
+def proxy_config(proxy_server):
+    return _config({'model': 'proxy', 'proxy_url': proxy_server.proxy_url}, 'proxy')
+
+
+@pytest.fixture(scope='session')
+def prompt():
+    return next(iter(get_registry().get('tutor').values()))
+
+
+@pytest.fixture(scope='session')
+def cell():
+    with open(stub_server.__file__) as f:
+        return f.read()
@@ -0,0 +1,127 @@
+"""A local stand-in for the Chatify proxy server, for offline benchmarks.
+
+The server speaks the protocol ``RequestChain`` uses: it accepts a JSON (or
+gzip-compressed JSON) ``{"user_text": ...}`` body POSTed to
+``/prompt/{prompt_id}/response`` and replies with the response text as a JSON
+string, or streamed as server-sent events or NDJSON when the client accepts
+``text/event-stream`` or ``application/x-ndjson``. With ``legacy=True`` it
+answers like older proxies, with a Python string literal.
+
+For tests, statuses appended to the server's ``failures`` list (e.g.
+``(503, {'Retry-After': '0'})``) are answered to the next requests instead,
+and ``chunk_delay`` slows the body down to one 16-byte chunk per that many
+seconds.
+"""
+
+import gzip
+import http.server
+import json
+import threading
+import time
+
+RESPONSE = (
+    '# 🤖 Explanation\n\nThis code defines a function and calls it.\n\n'
+    '```python\ndef f(x):\n    return x ** 2\n```\n\n'
+    'Beep boop, good luck with your learning journey! 🤖\n'
+)
+
+
+class StubProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            request = json.loads(body)
+        except (OSError, EOFError, ValueError):
+            self.send_error(400, 'Expected a JSON body')
+            return
+        if not isinstance(request, dict) or not isinstance(
+            request.get('user_text'), str
+        ):
+            self.send_error(400, 'Expected a "user_text" string')
+            return
+
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'prompt' or parts[2] != 'response':
+            self.send_error(404)
+            return
+
+        self.server.requests += 1
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        accept = self.headers.get('Accept', '')
+        chunks = [RESPONSE[i : i + 16] for i in range(0, len(RESPONSE), 16)]
+        if self.server.legacy:
+            payload = repr(RESPONSE).encode('utf-8')
+            content_type = 'text/html'
+        elif 'text/event-stream' in accept:
+            events = [f'data: {json.dumps(chunk)}\n\n' for chunk in chunks]
+            payload = (''.join(events) + 'data: [DONE]\n\n').encode('utf-8')
+            content_type = 'text/event-stream'
+        elif 'application/x-ndjson' in accept:
+            payload = ''.join(json.dumps(chunk) + '\n' for chunk in chunks)
+            payload = payload.encode('utf-8')
+            content_type = 'application/x-ndjson'
+        else:
+            payload = json.dumps(RESPONSE).encode('utf-8')
+            content_type = 'application/json'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if not self.server.chunk_delay:
+            self.wfile.write(payload)
+            return
+        for i in range(0, len(payload), 16):
+            time.sleep(self.server.chunk_delay)
+            self.wfile.write(payload[i : i + 16])
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=0, legacy=False):
+    """Starts the stub server on a background thread.
+
+    Parameters
+    ----------
+    host : str, optional
+        Interface to listen on, by default '127.0.0.1'.
+    port : int, optional
+        Port to listen on, by default any free port.
+    legacy : bool, optional
+        Whether to answer with Python string literals, by default False.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        The running server; its ``proxy_url`` attribute is the URL to use as
+        ``model_config["proxy_url"]``, and ``requests`` counts the requests
+        it answered. Call ``shutdown()`` to stop it.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), StubProxyHandler)
+    server.daemon_threads = True
+    server.legacy = legacy
+    server.failures = []
+    server.chunk_delay = 0
+    server.requests = 0
+    server.proxy_url = f'http://{host}:{server.server_address[1]}/prompt/'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
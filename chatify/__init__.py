@@ -4,8 +4,49 @@ __author__ = """Contextual Dynamics Laboratory"""
 __email__ = 'contextualdynamics@gmail.com'
 __version__ = '0.1.1'
 
-from .main import Chatify
-from .llm_models import FakeLLMModel, CachedLLMModel, OpenAIModel, OpenAIChatModel, HuggingFaceModel, ModelsFactory, BaseLLMModel
+# NOTE: Submodules are imported lazily (PEP 562), so that `%load_ext chatify`
+# does not pay for langchain, ipywidgets or any model backend up front.
+_lazy_attributes = {
+    'Chatify': 'main',
+    'FakeLLMModel': 'llm_models',
+    'CachedLLMModel': 'llm_models',
+    'OpenAIModel': 'llm_models',
+    'OpenAIChatModel': 'llm_models',
+    'HuggingFaceModel': 'llm_models',
+    'ModelsFactory': 'llm_models',
+    'BaseLLMModel': 'llm_models',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+
+        module = importlib.import_module(f'.{_lazy_attributes[name]}', __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
+
+
+_magics = None
+
 
 def load_ipython_extension(ipython):
-    ipython.register_magics(Chatify)
+    global _magics
+    from .main import Chatify
+
+    _magics = Chatify(ipython)
+    ipython.register_magics(_magics)
+    _magics.prewarm()
+
+
+def unload_ipython_extension(ipython):
+    # Loaded models stay in the process-wide registry, so `%reload_ext chatify`
+    # does not load them again
+    global _magics
+    if _magics is not None:
+        _magics.close()
+        _magics = None
@@ -0,0 +1,325 @@
+"""Read-only store of precomputed answers, memory-mapped for fast lookups.
+
+A course's precomputed answers (see ``chatify-build-cache``) never change at
+runtime, so instead of querying them through SQLite they can be packed into a
+single file that is memory-mapped and searched in place::
+
+    header    magic, format version, metadata length, number of answers
+    metadata  JSON: the model identities the answers were generated with
+    keys      sorted 32-byte SHA-256 request keys (see :func:`cache_key`)
+    offsets   n + 1 little-endian uint64 offsets into the blob region
+    blobs     the UTF-8 answers, back to back
+
+A lookup is a binary search over the keys, so it reads O(log n) keys and a
+single answer, and costs no I/O beyond page faults once the file is cached by
+the OS. Stores are built from response caches, and merged or compacted, with
+the ``chatify-answer-store`` command.
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import sqlite3
+import struct
+
+from .cache import ResponseCodec, cache_key
+
+MAGIC = b"CHATIFY\x00"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIQ")
+_OFFSET = struct.Struct("<Q")
+KEY_SIZE = 32
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class _Keys:
+    """Sequence view of the sorted keys, for :mod:`bisect`."""
+
+    def __init__(self, buffer, start, count):
+        self.buffer = buffer
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.start + i * KEY_SIZE
+        return self.buffer[start : start + KEY_SIZE]
+
+
+class AnswerStore:
+    """A memory-mapped, read-only map from request keys to answers."""
+
+    def __init__(self, path):
+        """Opens an answer store.
+
+        Parameters
+        ----------
+        path : str
+            Path of the store file.
+
+        Raises
+        ------
+        ValueError
+            If the file is not an answer store of a supported version.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError(f"{path} is not a Chatify answer store")
+        magic, version, meta_len, count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a Chatify answer store")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported answer store version {version}")
+
+        start = _HEADER.size
+        self.metadata = json.loads(self._mmap[start : start + meta_len])
+        self.model_ids = self.metadata.get("models", [])
+        self._count = count
+        self._keys_start = _align(start + meta_len)
+        self._offsets_start = self._keys_start + count * KEY_SIZE
+        self._blobs_start = self._offsets_start + (count + 1) * _OFFSET.size
+        self._keys = _Keys(self._mmap, self._keys_start, count)
+        # Answers are decoded straight from the mapping, without a copy
+        self._view = memoryview(self._mmap)
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < self._count and self._keys[i] == key:
+            return i
+        return None
+
+    def _answer(self, i):
+        start, end = struct.unpack_from(
+            "<2Q", self._mmap, self._offsets_start + i * _OFFSET.size
+        )
+        return self._view[self._blobs_start + start : self._blobs_start + end]
+
+    def get_key(self, key):
+        """Looks up an answer by request key.
+
+        Parameters
+        ----------
+        key : str or bytes
+            Hex digest or raw bytes of the key.
+
+        Returns
+        -------
+        answer : str or None
+            The answer, or None if the store has none.
+        """
+        if isinstance(key, str):
+            key = bytes.fromhex(key)
+        i = self._find(key)
+        if i is None:
+            return None
+        return str(self._answer(i), "utf-8")
+
+    def get(self, prompt_id, text, model_ids=()):
+        """Looks up the answer to a request.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        text : str
+            The cell text.
+        model_ids : iterable of str, optional
+            Identities of the models whose answers are accepted, tried in
+            order before the models the store was built with.
+
+        Returns
+        -------
+        answer : str or None
+            The answer, or None if the store has none.
+        """
+        for model_id in dict.fromkeys([*model_ids, *self.model_ids]):
+            answer = self.get_key(cache_key(prompt_id, model_id, text))
+            if answer is not None:
+                return answer
+        return None
+
+    def items(self):
+        """Iterates over the keys and answers, in key order.
+
+        Yields
+        ------
+        key : bytes
+            Raw key.
+        answer : memoryview
+            UTF-8 encoded answer.
+        """
+        for i in range(self._count):
+            yield self._keys[i], self._answer(i)
+
+    def close(self):
+        """Unmaps the store."""
+        self._view.release()
+        self._mmap.close()
+
+
+def write_answer_store(path, items, models=()):
+    """Writes an answer store.
+
+    The file is written next to ``path`` and renamed over it once complete.
+
+    Parameters
+    ----------
+    path : str
+        Path of the store file.
+    items : iterable of (str or bytes, str or bytes)
+        Keys (hex digests or raw bytes) and answers. When a key occurs more
+        than once, its last answer is kept.
+    models : iterable of str, optional
+        Identities of the models the answers were generated with.
+
+    Returns
+    -------
+    count : int
+        Number of answers written.
+    """
+    answers = {}
+    for key, answer in items:
+        if isinstance(key, str):
+            key = bytes.fromhex(key)
+        if isinstance(answer, str):
+            answer = answer.encode("utf-8")
+        answers[bytes(key)] = bytes(answer)
+    keys = sorted(answers)
+
+    meta = json.dumps({"models": list(dict.fromkeys(models))}).encode("utf-8")
+    header = _HEADER.pack(MAGIC, VERSION, len(meta), len(keys))
+    offsets = [0]
+    for key in keys:
+        offsets.append(offsets[-1] + len(answers[key]))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(header + meta)
+        f.write(b"\x00" * (_align(f.tell()) - f.tell()))
+        f.writelines(keys)
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.writelines(answers[key] for key in keys)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(keys)
+
+
+def _is_answer_store(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_shard(path, model_id=None):
+    """Reads the answers of an answer store or of a response cache database.
+
+    Parameters
+    ----------
+    path : str
+        Path of an answer store or of a ``ResponseCache`` SQLite file.
+    model_id : str, optional
+        Only read the answers of this model from a response cache; by default
+        all of them.
+
+    Returns
+    -------
+    items : list of (bytes, bytes)
+        Raw keys and UTF-8 answers.
+    models : list of str
+        Identities of the models the answers were generated with.
+    """
+    if _is_answer_store(path):
+        store = AnswerStore(path)
+        try:
+            return [(bytes(k), bytes(a)) for k, a in store.items()], store.model_ids
+        finally:
+            store.close()
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        codec = ResponseCodec(conn)
+        # Caches written before responses were compressed have no codec column
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(responses)")}
+        codec_column = "codec" if "codec" in columns else "NULL"
+        rows = [
+            (key, model, codec.decode(value, value_codec))
+            for key, model, value, value_codec in conn.execute(
+                f"SELECT key, model, response, {codec_column} FROM responses"
+            )
+            if model_id is None or model == model_id
+        ]
+    finally:
+        conn.close()
+    items = [(bytes.fromhex(key), answer.encode("utf-8")) for key, _, answer in rows]
+    # The most common model first, as it is tried first
+    counts = {}
+    for _, model, _ in rows:
+        counts[model] = counts.get(model, 0) + 1
+    return items, sorted(counts, key=counts.get, reverse=True)
+
+
+def merge(output, inputs, model_id=None):
+    """Merges answer stores and response caches into one answer store.
+
+    Parameters
+    ----------
+    output : str
+        Path of the store to write; it may also be one of the inputs.
+    inputs : list of str
+        Answer stores or response cache databases. Answers of later inputs
+        replace those of earlier ones.
+    model_id : str, optional
+        Only keep the answers of this model from response caches.
+
+    Returns
+    -------
+    count : int
+        Number of answers written.
+    """
+    items, models = [], []
+    for path in inputs:
+        shard_items, shard_models = read_shard(path, model_id)
+        items.extend(shard_items)
+        models.extend(shard_models)
+    return write_answer_store(output, items, models)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="chatify-answer-store",
+        description="Build, merge or compact memory-mapped Chatify answer stores.",
+    )
+    parser.add_argument("output", help="answer store to write")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="answer stores or response caches (e.g. from chatify-build-cache); "
+        "later inputs take precedence",
+    )
+    parser.add_argument(
+        "--model-id",
+        default=None,
+        help="only keep the responses of this model from response caches",
+    )
+    args = parser.parse_args(argv)
+
+    count = merge(args.output, args.inputs, model_id=args.model_id)
+    print(f"Wrote {args.output}: {count} answers.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,238 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Mapping, Optional
+
+from langchain.llms.base import LLM
+
+
+class BatchScheduler:
+    """Collects concurrent prompts into batches for a single model call.
+
+    A worker thread waits for the first pending prompt, then keeps collecting
+    prompts until ``max_batch_size`` are pending or ``max_wait_ms`` have passed,
+    and generates all of them with one call. Each caller waits on its own
+    future. The worker is started by the first prompt and exits once no prompt
+    arrived for ``idle_timeout`` seconds (or on :meth:`close`), so that an
+    unused scheduler does not keep ``generate`` (and its model) alive.
+    """
+
+    def __init__(self, generate, max_batch_size=8, max_wait_ms=10, idle_timeout=60):
+        """Initializes the BatchScheduler instance.
+
+        Parameters
+        ----------
+        generate : callable
+            Called with a list of prompts and a list of stop sequences (or
+            None); returns the list of outputs in the same order.
+        max_batch_size : int, optional
+            Maximum number of prompts per batch, by default 8.
+        max_wait_ms : float, optional
+            Milliseconds to wait for more prompts after the first one arrives,
+            by default 10.
+        idle_timeout : float, optional
+            Seconds without prompts after which the worker exits, by default
+            60.
+        """
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.idle_timeout = idle_timeout
+        self.batch_sizes = []
+
+        self._pending = []
+        self._stopping = False
+        self._worker = None
+        self._condition = threading.Condition()
+
+    def submit(self, prompt, stop=None):
+        """Schedules a prompt for the next batch.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt.
+        stop : list of str, optional
+            Stop sequences; only prompts with the same stop sequences are
+            generated together.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the generated text.
+        """
+        future = Future()
+        with self._condition:
+            self._pending.append((prompt, stop, future))
+            if self._worker is None:
+                self._stopping = False
+                self._worker = threading.Thread(
+                    target=self._run, name="chatify-batching", daemon=True
+                )
+                self._worker.start()
+            self._condition.notify()
+        return future
+
+    def close(self):
+        """Stops the worker once the pending prompts have been generated.
+
+        Waits for the worker to exit. Prompts submitted afterwards start a new
+        worker.
+        """
+        with self._condition:
+            worker = self._worker
+            self._stopping = True
+            self._condition.notify()
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                if self._stopping or not self._condition.wait(self.idle_timeout):
+                    if self._pending:
+                        break
+                    self._worker = None
+                    return None
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[: self.max_batch_size]
+            del self._pending[: self.max_batch_size]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            groups = {}
+            for prompt, stop, future in batch:
+                if future.set_running_or_notify_cancel():
+                    key = tuple(stop) if stop else None
+                    groups.setdefault(key, []).append((prompt, future))
+
+            for stop, items in groups.items():
+                self.batch_sizes.append(len(items))
+                try:
+                    outputs = self.generate(
+                        [prompt for prompt, _ in items], list(stop) if stop else None
+                    )
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), output in zip(items, outputs):
+                    future.set_result(output)
+
+
+class BatchingLLM(LLM):
+    """Wraps an LLM so that concurrent calls are generated in batches.
+
+    Attributes
+    ----------
+    llm : LLM
+        The wrapped model.
+    max_batch_size : int
+        Maximum number of prompts generated together.
+    max_wait_ms : float
+        Milliseconds a prompt waits for others to join its batch.
+    """
+
+    llm: Any
+    max_batch_size: int = 8
+    max_wait_ms: float = 10
+    scheduler: Any = None
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.scheduler = BatchScheduler(
+            self._generate_batch, self.max_batch_size, self.max_wait_ms
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        """Return type of LLM.
+
+        Returns
+        -------
+        str
+            Type of LLM.
+        """
+        return f"batching-{self.llm._llm_type}"
+
+    def close(self):
+        """Stops the scheduler's worker thread, which references the model.
+
+        Calls made afterwards start a new worker.
+        """
+        self.scheduler.close()
+
+    def _generate_batch(self, prompts, stop=None):
+        pipeline = getattr(self.llm, "pipeline", None)
+        if pipeline is None:
+            result = self.llm.generate(prompts, stop=stop)
+            return [generations[0].text for generations in result.generations]
+
+        # Hugging Face pipelines pad the prompts into one generate call only when
+        # given a batch size; langchain's wrapper sends them one by one
+        responses = pipeline(
+            prompts, batch_size=len(prompts), **(self.llm.pipeline_kwargs or {})
+        )
+        outputs = []
+        for response in responses:
+            if isinstance(response, list):
+                response = response[0]
+            outputs.append(response.get("generated_text", response.get("text")))
+        return outputs
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
+        """Waits for the prompt's batch to be generated.
+
+        Parameters
+        ----------
+        prompt : str
+            Input prompt.
+        stop : List[str], optional
+            List of stop tokens, by default None.
+
+        Returns
+        -------
+        str
+            Generated response.
+        """
+        return self.scheduler.submit(prompt, stop).result()
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        """Get the identifying parameters.
+
+        Returns
+        -------
+        Mapping[str, Any]
+            Identifying parameters.
+        """
+        return {
+            "llm": self.llm._identifying_params,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+        }
+
+
+def enable_padding(pipeline):
+    """Lets a Hugging Face text generation pipeline pad batched prompts.
+
+    Parameters
+    ----------
+    pipeline : transformers.Pipeline
+        The pipeline; its tokenizer is updated in place.
+    """
+    tokenizer = pipeline.tokenizer
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = pipeline.model.config.eos_token_id
+    if pipeline.task == "text-generation":
+        # Decoder-only models continue from the end of the prompt
+        tokenizer.padding_side = "left"
@@ -0,0 +1,266 @@
+"""Command line tool that precomputes Chatify responses for whole notebooks.
+
+Every code cell of the given notebooks is sent through every configured prompt,
+and the responses are written to a response cache file that Chatify loads at
+runtime (see ``cache_config`` in ``default_config.yaml``). Rerunning the tool
+with the same output file only requests the responses that are still missing,
+so an interrupted build can simply be resumed.
+
+Example::
+
+    chatify-build-cache examples/*.ipynb --config config.yaml --workers 8 --rate 2
+"""
+
+import argparse
+import json
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+from .cache import ResponseCache
+from .chains import CreateLLMChain
+from .utils import model_identity, read_prompt_dir
+
+
+def read_notebook_cells(path):
+    """Extracts the code cells of a Jupyter notebook.
+
+    A leading ``%%explain`` line is removed, since Chatify never sees it, and
+    empty cells are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path of the ``.ipynb`` file.
+
+    Returns
+    -------
+    cells : list of str
+        Source code of the notebook's code cells.
+    """
+    with open(path, encoding="utf-8") as f:
+        notebook = json.load(f)
+
+    cells = []
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        if source.lstrip().startswith("%%explain"):
+            source = source.lstrip().split("\n", 1)[1] if "\n" in source else ""
+        if source.strip():
+            cells.append(source)
+    return cells
+
+
+class RateLimiter:
+    """A thread-safe limiter allowing at most ``rate`` calls per second."""
+
+    def __init__(self, rate=None):
+        """Initializes the RateLimiter instance.
+
+        Parameters
+        ----------
+        rate : float, optional
+            Maximum number of calls per second; unlimited when None.
+        """
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+
+def build_cache(
+    notebooks,
+    config,
+    output,
+    workers=4,
+    rate=None,
+    model_id=None,
+    compress=False,
+    verbose=True,
+):
+    """Precomputes the responses to every cell and prompt of the notebooks.
+
+    Parameters
+    ----------
+    notebooks : list of str
+        Paths of the ``.ipynb`` files.
+    config : dict
+        Chatify configuration selecting the model and the prompts.
+    output : str
+        Path of the response cache file to write.
+    workers : int, optional
+        Number of requests sent in parallel, by default 4.
+    rate : float, optional
+        Maximum number of requests per second; unlimited when None.
+    model_id : str, optional
+        Model identity the responses are stored under, by default the identity
+        of ``config["model_config"]``. Set this to the runtime model's identity
+        when building a cache with a different model than students will use.
+    compress : bool, optional
+        Whether to compress the responses with a zstd dictionary trained on
+        them once they are all cached, by default False. Needs zstandard.
+    verbose : bool, optional
+        Whether to print progress, by default True.
+
+    Returns
+    -------
+    stats : dict
+        Number of 'cached', 'skipped' and 'failed' requests.
+    """
+    # The builder writes responses itself, so the chain's own cache is disabled
+    config = dict(config, cache_config=dict(config["cache_config"], cache=False))
+    llm_chain = CreateLLMChain(config)
+    model_id = model_id or model_identity(config["model_config"])
+    version = config["cache_config"]["cache_db_version"]
+    # Cell texts are kept so that kernels can index the responses for similarity
+    # lookups
+    cache = ResponseCache(
+        output, max_entries=None, dictionary_version=version, keep_text=True
+    )
+
+    cells = []
+    for notebook in notebooks:
+        cells.extend(read_notebook_cells(notebook))
+    prompt_types = read_prompt_dir(config["prompts_config"]["prompts_to_use"])
+
+    jobs = []
+    skipped = 0
+    for cell in cells:
+        for prompts in prompt_types.values():
+            for prompt in prompts.values():
+                chain = llm_chain.create_chain(
+                    config["model_config"], prompt_template=prompt
+                )
+                prompt_id = chain.metadata["prompt_id"]
+                if cache.contains(prompt_id, model_id, cell):
+                    skipped += 1
+                else:
+                    jobs.append((chain, prompt_id, cell))
+
+    if verbose:
+        print(
+            f"{len(cells)} cells, {len(jobs) + skipped} requests: "
+            f"{skipped} already cached, {len(jobs)} to do."
+        )
+
+    limiter = RateLimiter(rate)
+
+    def run(chain, prompt_id, cell):
+        limiter.wait()
+        response = llm_chain.execute(chain, cell)
+        cache.set(prompt_id, model_id, cell, response)
+
+    stats = {"cached": 0, "skipped": skipped, "failed": 0}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(run, *job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+                stats["cached"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                if verbose:
+                    print(f"Request failed: {e}")
+            if verbose and (done % 50 == 0 or done == len(futures)):
+                print(f"{done}/{len(futures)} requests done.")
+    except BaseException:
+        # E.g. Ctrl-C: the requests in flight finish, the others are dropped,
+        # and the build can be resumed by running it again
+        executor.shutdown(cancel_futures=True)
+        cache.close()
+        raise
+    executor.shutdown()
+
+    if compress:
+        sizes = cache.train_dictionary(version=version)
+        if verbose:
+            print(
+                f"Compressed {sizes['entries']} responses from {sizes['before']} "
+                f"to {sizes['after']} bytes."
+            )
+    cache.close()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="chatify-build-cache",
+        description="Precompute Chatify responses for every code cell of notebooks.",
+    )
+    parser.add_argument("notebooks", nargs="+", help=".ipynb files to process")
+    parser.add_argument(
+        "--config",
+        default=None,
+        help="config.yaml selecting the model and prompts "
+        "(default: Chatify's default configuration)",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="cache file to write (default: NMA_2023_v{cache_db_version}.cache)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="parallel requests (default: 4)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="maximum requests per second (default: unlimited)",
+    )
+    parser.add_argument(
+        "--model-id",
+        default=None,
+        help="model identity to store responses under "
+        "(default: the configured model's identity)",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="compress the responses with a zstd dictionary trained on them "
+        "(requires zstandard)",
+    )
+    args = parser.parse_args(argv)
+
+    config_file = args.config or pathlib.Path(__file__).parent / "default_config.yaml"
+    with open(config_file) as f:
+        config = yaml.load(f, Loader=yaml.SafeLoader)
+    output = (
+        args.output or f'NMA_2023_v{config["cache_config"]["cache_db_version"]}.cache'
+    )
+
+    stats = build_cache(
+        args.notebooks,
+        config,
+        output,
+        workers=args.workers,
+        rate=args.rate,
+        model_id=args.model_id,
+        compress=args.compress,
+    )
+    print(
+        f"Wrote {output}: {stats['cached']} new, {stats['skipped']} already cached, "
+        f"{stats['failed']} failed."
+    )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,16 +1,974 @@
-from gptcache import Cache
-from gptcache.adapter.langchain_models import LangChainLLMs
-from gptcache.embedding import Onnx
-from gptcache.manager import CacheBase, VectorBase, get_data_manager
-from gptcache.processor.pre import get_prompt
-from gptcache.similarity_evaluation.distance import SearchDistanceEvaluation
-from gptcache.similarity_evaluation.exact_match import ExactMatchEvaluation
+import hashlib
+import io
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+import warnings
+import zlib
 
-from .utils import download_cache_database
+import numpy as np
+
+from .utils import model_identity
+
+
+def normalize_text(text):
+    """Normalizes cell text so that trivially different copies share a cache entry.
+
+    Line endings are unified, trailing whitespace is removed from every line and
+    leading and trailing blank lines are dropped. Indentation is preserved.
+
+    Parameters
+    ----------
+    text : str
+        The cell text.
+
+    Returns
+    -------
+    text : str
+        The normalized text.
+    """
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+
+def cache_key(prompt_id, model_id, text):
+    """Returns the exact-match cache key for a request.
+
+    Parameters
+    ----------
+    prompt_id : str
+        Identifier of the prompt.
+    model_id : str
+        Identity of the model, see :func:`chatify.utils.model_identity`.
+    text : str
+        The cell text.
+
+    Returns
+    -------
+    key : str
+        Hex digest identifying the request.
+    """
+    data = '\x00'.join([prompt_id, model_id, normalize_text(text)])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# Schema changes of the response cache, applied in order; PRAGMA user_version
+# records how many have been applied to a database
+_MIGRATIONS = (
+    'ALTER TABLE responses ADD COLUMN codec TEXT',
+    'CREATE TABLE dictionaries ('
+    'id INTEGER PRIMARY KEY, version TEXT, created REAL, data BLOB)',
+    'ALTER TABLE responses ADD COLUMN text TEXT',
+)
+
+COMPRESSION_LEVEL = 19
+
+# Whether a missing zstandard was already reported
+_warned_zstandard = False
+
+
+class ResponseCodec:
+    """Compresses responses with the zstd dictionaries stored in a database.
+
+    Responses are stored as plain text (codec NULL) or compressed with a zstd
+    dictionary trained on the cached responses (codec ``'zstd:<id>'``). Every
+    dictionary keeps the ``cache_db_version`` it was trained for, and responses
+    record the dictionary they were compressed with, so a new dictionary never
+    invalidates the responses compressed with an older one. ``zstandard`` is
+    only needed to read and write compressed responses.
+    """
+
+    def __init__(self, conn, version=None):
+        """Initializes the ResponseCodec instance.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+            Connection to the database holding the dictionaries.
+        version : str, optional
+            ``cache_db_version`` whose dictionary compresses new responses, by
+            default the most recently trained dictionary.
+        """
+        self.conn = conn
+        self.version = None if version is None else str(version)
+        self._decompressors = {}
+        self._compressor = None
+        self._codec = None
+        self.refresh()
+
+    def refresh(self):
+        """Picks the dictionary new responses are compressed with."""
+        self._compressor = self._codec = None
+        tables = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'dictionaries'"
+        ).fetchone()
+        if tables is None:
+            return
+        query = 'SELECT id, data FROM dictionaries'
+        params = ()
+        if self.version is not None:
+            query += ' WHERE version = ?'
+            params = (self.version,)
+        row = self.conn.execute(query + ' ORDER BY id DESC LIMIT 1', params).fetchone()
+        if row is None:
+            return
+        try:
+            import zstandard
+        except ImportError:
+            # Responses are stored uncompressed without zstandard
+            return
+        dictionary = zstandard.ZstdCompressionDict(row[1])
+        self._compressor = zstandard.ZstdCompressor(
+            level=COMPRESSION_LEVEL, dict_data=dictionary
+        )
+        self._codec = f'zstd:{row[0]}'
+
+    def encode(self, response):
+        """Compresses a response with the current dictionary, if there is one.
+
+        Parameters
+        ----------
+        response : str
+            The response.
+
+        Returns
+        -------
+        value : str or bytes
+            The value to store.
+        codec : str or None
+            The codec of the value.
+        """
+        if self._compressor is None:
+            return response, None
+        return self._compressor.compress(response.encode('utf-8')), self._codec
+
+    def decode(self, value, codec):
+        """Decompresses a stored response.
+
+        Parameters
+        ----------
+        value : str or bytes
+            The stored value.
+        codec : str or None
+            Its codec.
+
+        Returns
+        -------
+        response : str
+            The response.
+
+        Raises
+        ------
+        ImportError
+            If the response is compressed and zstandard is not installed.
+        ValueError
+            If the codec is unknown or its dictionary is not in the database.
+        """
+        if codec is None:
+            return value
+        name, _, dictionary_id = codec.partition(':')
+        if name != 'zstd':
+            raise ValueError(f'Unknown response codec {codec!r}')
+
+        decompressor = self._decompressors.get(dictionary_id)
+        if decompressor is None:
+            import zstandard
+
+            row = self.conn.execute(
+                'SELECT data FROM dictionaries WHERE id = ?', (int(dictionary_id),)
+            ).fetchone()
+            if row is None:
+                raise ValueError(
+                    f'The dictionary of response codec {codec!r} is missing'
+                )
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(row[0])
+            )
+            self._decompressors[dictionary_id] = decompressor
+        # Decompressed as a stream, which needs no content size in the frame
+        reader = decompressor.stream_reader(value)
+        return io.TextIOWrapper(reader, encoding='utf-8').read()
+
+
+def _warn_zstandard():
+    global _warned_zstandard
+    if not _warned_zstandard:
+        _warned_zstandard = True
+        warnings.warn(
+            'Compressed cached responses are ignored; install zstandard to '
+            'read them.'
+        )
+
+
+class ResponseCache:
+    """A persistent, SQLite-backed exact-match cache of model responses.
+
+    Entries are evicted least-recently-used first once the cache holds more than
+    ``max_entries`` responses, and expire ``ttl`` seconds after they were stored.
+    Lookups only read the database: which responses were used is recorded in
+    memory and written with the next stored response (or on :meth:`close`), so
+    that readers never wait for, or hold, the database's write lock. A
+    read-only cache is never written to, so that e.g. a downloaded database
+    keeps its checksum.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_entries=10000,
+        ttl=None,
+        dictionary_version=None,
+        shared=False,
+        busy_timeout=5.0,
+        read_only=False,
+        mode=None,
+        keep_text=False,
+    ):
+        """Initializes a new ResponseCache instance.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite database file.
+        max_entries : int, optional
+            Maximum number of cached responses, by default 10000. The cache is
+            unbounded when None.
+        ttl : float, optional
+            Seconds after which a response expires; responses never expire when
+            None (the default).
+        dictionary_version : str, optional
+            ``cache_db_version`` whose compression dictionary compresses new
+            responses, by default the most recently trained one; see
+            :meth:`train_dictionary`.
+        shared : bool, optional
+            Whether several processes (e.g. every kernel on a node) use the
+            database at the same time, by default False. The database is then
+            put in WAL mode, so that readers never wait for a writer. It must be
+            on a local file system.
+        busy_timeout : float, optional
+            Seconds to wait for another process to finish writing before
+            failing with ``sqlite3.OperationalError``, by default 5.
+        read_only : bool, optional
+            Whether to open an existing database read-only, by default False.
+            Storing a response then fails with ``sqlite3.OperationalError``.
+        mode : int, optional
+            Permissions of the database file if it is created, e.g. ``0o660``
+            to let the file's group write it; by default those allowed by the
+            umask. The journals SQLite creates next to it get the same
+            permissions.
+        keep_text : bool, optional
+            Whether to also store the cell text of every response, by default
+            False, so that the responses can be indexed for similarity lookups;
+            see :meth:`texts`.
+
+        Raises
+        ------
+        sqlite3.DatabaseError
+            If the file is not an SQLite database, or is opened read-only and
+            is not a response cache.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.read_only = read_only
+        self.keep_text = keep_text
+        self.hits = 0
+        self.misses = 0
+        # Time of the last lookup and number of hits of every response looked
+        # up since the last write
+        self._accessed = {}
+
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = sqlite3.connect(
+                pathlib.Path(path).absolute().as_uri() + '?mode=ro',
+                uri=True,
+                timeout=busy_timeout,
+                check_same_thread=False,
+            )
+            tables = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'responses'"
+            ).fetchone()
+            if tables is None:
+                # E.g. a cache written by older versions of Chatify with gptcache
+                self._conn.close()
+                raise sqlite3.DatabaseError(f'{path} is not a Chatify response cache')
+            # Databases built before responses were compressed cannot be
+            # migrated, and have no codec column
+            columns = {
+                row[1] for row in self._conn.execute('PRAGMA table_info(responses)')
+            }
+            self._codec_column = 'codec' if 'codec' in columns else 'NULL'
+            self._text_column = 'text' if 'text' in columns else 'NULL'
+            self.codec = ResponseCodec(self._conn, dictionary_version)
+            return
+
+        self._codec_column = 'codec'
+        self._text_column = 'text'
+        if mode is not None:
+            _create_file(path, mode)
+        self._conn = sqlite3.connect(
+            path, timeout=busy_timeout, check_same_thread=False
+        )
+        if shared:
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            # Committed writes survive a crashed process; only a power loss
+            # can roll back the last ones
+            self._conn.execute('PRAGMA synchronous = NORMAL')
+        with self._conn:
+            # Processes opening the database at the same time set it up in turn
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, prompt_id TEXT, model TEXT, response TEXT, '
+                'created REAL, accessed REAL, hits INTEGER DEFAULT 0)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)'
+            )
+            (applied,) = self._conn.execute('PRAGMA user_version').fetchone()
+            for migration in _MIGRATIONS[applied:]:
+                self._conn.execute(migration)
+            self._conn.execute(f'PRAGMA user_version = {len(_MIGRATIONS)}')
+        self.codec = ResponseCodec(self._conn, dictionary_version)
+
+    def get(self, prompt_id, model_id, text):
+        """Looks up a cached response.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        model_id : str
+            Identity of the model.
+        text : str
+            The cell text.
+
+        Returns
+        -------
+        response : str or None
+            The cached response, or None if there is none.
+        """
+        key = cache_key(prompt_id, model_id, text)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT response, created, {self._codec_column} FROM responses '
+                'WHERE key = ?',
+                (key,),
+            ).fetchone()
+            # Expired responses are deleted by the next write
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                row = None
+
+            if row is not None:
+                try:
+                    response = self.codec.decode(row[0], row[2])
+                except ImportError:
+                    _warn_zstandard()
+                    row = None
+                except ValueError as e:
+                    # An undecodable response is a miss, not a failed request
+                    warnings.warn(f'Ignoring cached response: {e}')
+                    row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if not self.read_only:
+                _, hits = self._accessed.get(key, (now, 0))
+                self._accessed[key] = (now, hits + 1)
+            return response
+
+    def _write_accesses(self):
+        """Records the lookups since the last write; call in a transaction."""
+        self._conn.executemany(
+            'UPDATE responses SET accessed = max(accessed, ?), hits = hits + ? '
+            'WHERE key = ?',
+            [(accessed, hits, key) for key, (accessed, hits) in self._accessed.items()],
+        )
+        self._accessed.clear()
+
+    def set(self, prompt_id, model_id, text, response):
+        """Stores a response, evicting the least recently used ones if needed.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        model_id : str
+            Identity of the model.
+        text : str
+            The cell text.
+        response : str
+            The model response.
+        """
+        key = cache_key(prompt_id, model_id, text)
+        now = time.time()
+        with self._lock, self._conn:
+            value, codec = self.codec.encode(response)
+            self._write_accesses()
+            if self.ttl is not None:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE created < ?', (now - self.ttl,)
+                )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, prompt_id, model, response, codec, text, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key,
+                    prompt_id,
+                    model_id,
+                    value,
+                    codec,
+                    text if self.keep_text else None,
+                    now,
+                    now,
+                ),
+            )
+            if self.max_entries is not None:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY accessed '
+                    'LIMIT max(0, (SELECT COUNT(*) FROM responses) - ?))',
+                    (self.max_entries,),
+                )
+
+    def contains(self, prompt_id, model_id, text):
+        """Checks for a cached response without counting a hit or miss.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        model_id : str
+            Identity of the model.
+        text : str
+            The cell text.
+
+        Returns
+        -------
+        found : bool
+            Whether a response is cached.
+        """
+        key = cache_key(prompt_id, model_id, text)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+        return row is not None
+
+    def purge_expired(self):
+        """Deletes all expired responses."""
+        if self.ttl is None:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,)
+            )
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of cached responses.
+
+        Returns
+        -------
+        stats : dict
+            Dictionary with 'hits', 'misses' and 'entries' keys.
+        """
+        with self._lock:
+            (entries,) = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def clear(self):
+        """Deletes all cached responses."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM responses')
+            self._accessed.clear()
+
+    def responses(self):
+        """Returns every cached response.
+
+        Returns
+        -------
+        responses : list of tuple
+            The key, model identity and (decompressed) response of every
+            cached response.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT key, model, response, {self._codec_column} FROM responses'
+            ).fetchall()
+            return [
+                (key, model, self.codec.decode(value, codec))
+                for key, model, value, codec in rows
+            ]
+
+    def texts(self, model_id):
+        """Returns the responses of a model that were stored with their cell text.
+
+        Parameters
+        ----------
+        model_id : str
+            Identity of the model.
+
+        Returns
+        -------
+        texts : list of tuple
+            The prompt identifier, cell text and (decompressed) response of
+            every response stored by a cache with ``keep_text`` set.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT prompt_id, {self._text_column}, response, '
+                f'{self._codec_column} FROM responses '
+                f'WHERE model = ? AND {self._text_column} IS NOT NULL',
+                (model_id,),
+            ).fetchall()
+            return [
+                (prompt_id, text, self.codec.decode(value, codec))
+                for prompt_id, text, value, codec in rows
+            ]
+
+    def train_dictionary(self, dict_size=110 * 1024, version=None):
+        """Trains a zstd dictionary on the cached responses and recompresses them.
+
+        Cached responses repeat the same headings, disclaimers and code, which
+        a shared dictionary lets zstd compress away even in short responses.
+        Responses stored afterwards are compressed with the new dictionary.
+        The database is vacuumed so that the file shrinks.
+
+        Parameters
+        ----------
+        dict_size : int, optional
+            Size of the dictionary in bytes, by default 110 KiB.
+        version : str, optional
+            ``cache_db_version`` the dictionary is trained for, by default the
+            cache's ``dictionary_version``.
+
+        Returns
+        -------
+        stats : dict
+            Number of 'entries' and total size of the responses in bytes
+            'before' and 'after' compression.
+
+        Raises
+        ------
+        ImportError
+            If zstandard is not installed.
+        ValueError
+            If there are too few cached responses to train a dictionary on.
+        """
+        import zstandard
+
+        version = version if version is not None else self.codec.version
+        version = None if version is None else str(version)
+        responses = self.responses()
+        samples = [response.encode('utf-8') for _, _, response in responses]
+        try:
+            dictionary = zstandard.train_dictionary(
+                dict_size, samples, level=COMPRESSION_LEVEL
+            )
+        except zstandard.ZstdError as e:
+            raise ValueError(
+                f'Could not train a dictionary on {len(samples)} responses: {e}'
+            ) from e
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT INTO dictionaries (version, created, data) '
+                    'VALUES (?, ?, ?)',
+                    (version, time.time(), dictionary.as_bytes()),
+                )
+                self.codec.version = version
+                self.codec.refresh()
+                after = 0
+                for key, _, response in responses:
+                    value, codec = self.codec.encode(response)
+                    after += len(value)
+                    self._conn.execute(
+                        'UPDATE responses SET response = ?, codec = ? WHERE key = ?',
+                        (value, codec, key),
+                    )
+            self._conn.execute('VACUUM')
+        return {
+            'entries': len(samples),
+            'before': sum(len(sample) for sample in samples),
+            'after': after,
+        }
+
+    def close(self):
+        """Records the last lookups and closes the database connection."""
+        with self._lock:
+            if self._accessed:
+                try:
+                    with self._conn:
+                        self._write_accesses()
+                except sqlite3.OperationalError:
+                    # Only the order of evictions depends on them
+                    pass
+            self._conn.close()
+
+
+def _create_file(path, mode):
+    """Creates an empty file with the given permissions, if it is missing."""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, mode)
+    except FileExistsError:
+        return
+    try:
+        # Not restricted by the umask, unlike the mode given to os.open
+        os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+
+
+def embed_texts(texts, dim=512, ngram=3):
+    """Embeds texts as hashed character n-gram and token count vectors.
+
+    The embedding needs no model or network access: every character n-gram and
+    word of the (whitespace-collapsed) text is hashed into one of ``dim``
+    buckets with a random sign, and each vector is scaled to unit length, so
+    the dot product of two embeddings is their cosine similarity.
+
+    Parameters
+    ----------
+    texts : list of str
+        Texts to embed.
+    dim : int, optional
+        Embedding dimension, by default 512.
+    ngram : int, optional
+        Length of the character n-grams, by default 3.
+
+    Returns
+    -------
+    embeddings : np.ndarray
+        Array of shape (len(texts), dim) and dtype float32.
+    """
+    embeddings = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        text = ' '.join(normalize_text(text).split())
+        features = [text[j : j + ngram] for j in range(len(text) - ngram + 1)]
+        features += re.findall(r'\w+', text)
+        if not features:
+            continue
+        hashes = np.fromiter(
+            (zlib.crc32(feature.encode('utf-8')) for feature in features),
+            dtype=np.uint32,
+            count=len(features),
+        )
+        signs = np.where(hashes >> 31, 1.0, -1.0)
+        embeddings[i] = np.bincount(hashes % dim, weights=signs, minlength=dim)
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+    return embeddings
+
+
+def _namespace(prompt_id, model_id):
+    digest = hashlib.sha1(f'{prompt_id}\x00{model_id}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little', signed=True)
+
+
+class SimilarityCache:
+    """An offline semantic-similarity cache of model responses.
+
+    Embeddings (see :func:`embed_texts`) are kept in a memory-mapped float32
+    matrix next to the SQLite database, which stores the responses. A lookup
+    returns the response to the most similar cached request for the same prompt
+    and model, provided its cosine similarity reaches ``threshold``. Once the
+    cache is full the oldest entries are overwritten, and entries expire
+    ``ttl`` seconds after they were stored.
+
+    Kernels started in the same directory share the cache files: rows are
+    allocated in database transactions, and every row records the checksum of
+    its embedding, so that a row overwritten by another kernel is never
+    returned with a response it does not belong to.
+    """
+
+    def __init__(self, path, max_entries=10000, threshold=0.95, dim=512, ttl=None):
+        """Initializes a new SimilarityCache instance.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite database file; embeddings are stored in
+            ``path + '.vectors'``.
+        max_entries : int, optional
+            Maximum number of cached responses, by default 10000.
+        threshold : float, optional
+            Minimum cosine similarity for a hit, by default 0.95.
+        dim : int, optional
+            Embedding dimension, by default 512.
+        ttl : float, optional
+            Seconds after which a response expires; responses never expire when
+            None (the default).
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.dim = dim
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        vectors_file = path + '.vectors'
+        shape = (max_entries, dim)
+        expected_size = max_entries * dim * np.dtype(np.float32).itemsize
+        with self._conn:
+            # Processes opening the cache at the same time set it up in turn
+            self._conn.execute('BEGIN IMMEDIATE')
+            columns = {
+                row[1] for row in self._conn.execute('PRAGMA table_info(similarity)')
+            }
+            if columns and 'checksum' not in columns:
+                # Rows of older versions cannot be checked against their embeddings
+                self._conn.execute('DROP TABLE similarity')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS similarity ('
+                'row INTEGER PRIMARY KEY, namespace INTEGER, response TEXT, '
+                'created REAL, seq INTEGER, checksum INTEGER)'
+            )
+            # Number of responses ever stored, which decides the next row
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS similarity_state ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER)'
+            )
+            self._conn.execute(
+                'INSERT OR IGNORE INTO similarity_state (id, seq) VALUES (0, 0)'
+            )
+
+            if (
+                os.path.exists(vectors_file)
+                and os.path.getsize(vectors_file) == expected_size
+            ):
+                self._vectors = np.memmap(
+                    vectors_file, dtype=np.float32, mode='r+', shape=shape
+                )
+            else:
+                # Embeddings from a differently shaped cache cannot be reused
+                self._vectors = np.memmap(
+                    vectors_file, dtype=np.float32, mode='w+', shape=shape
+                )
+                self._conn.execute('DELETE FROM similarity')
+
+        # Namespace of each row, so that lookups only match the same prompt/model
+        self._namespaces = np.zeros(max_entries, dtype=np.int64)
+        self._used = np.zeros(max_entries, dtype=bool)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        # Last row write already loaded into the arrays above
+        self._seq = -1
+        self._refresh()
+
+    def _refresh(self):
+        # Loads the rows written (by any kernel) since the last refresh
+        rows = self._conn.execute(
+            'SELECT row, namespace, created, seq FROM similarity '
+            'WHERE seq > ? AND row < ?',
+            (self._seq, self.max_entries),
+        ).fetchall()
+        for row, namespace, created, seq in rows:
+            self._namespaces[row] = namespace
+            self._used[row] = True
+            self._created[row] = created
+            self._seq = max(self._seq, seq)
+
+    def lookup_many(self, requests, k=1):
+        """Looks up the cached responses most similar to a batch of requests.
+
+        Parameters
+        ----------
+        requests : list of tuple
+            ``(prompt_id, model_id, text)`` tuples.
+        k : int, optional
+            Number of candidates to return per request, by default 1.
+
+        Returns
+        -------
+        results : list of list
+            For each request, up to ``k`` ``(similarity, response)`` tuples
+            above the threshold, most similar first.
+        """
+        queries = embed_texts([text for _, _, text in requests], dim=self.dim)
+        namespaces = np.array(
+            [_namespace(prompt_id, model_id) for prompt_id, model_id, _ in requests],
+            dtype=np.int64,
+        )
+
+        with self._lock:
+            self._refresh()
+            # Cosine similarity of every query with every cached embedding
+            similarities = queries @ self._vectors.T
+            available = self._used
+            if self.ttl is not None:
+                available = available & (self._created >= time.time() - self.ttl)
+            mask = (namespaces[:, None] != self._namespaces[None, :]) | ~available
+            similarities[mask] = -np.inf
+
+            k = min(k, self.max_entries)
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            results = []
+            for i, candidates in enumerate(top):
+                candidates = candidates[np.argsort(-similarities[i, candidates])]
+                matches = []
+                for row in candidates:
+                    if similarities[i, row] < self.threshold:
+                        break
+                    found = self._conn.execute(
+                        'SELECT response, namespace, checksum FROM similarity '
+                        'WHERE row = ?',
+                        (int(row),),
+                    ).fetchone()
+                    # The row may have been cleared or overwritten by another
+                    # kernel since the arrays were loaded, or be half written
+                    if (
+                        found is None
+                        or found[1] != namespaces[i]
+                        or found[2] != zlib.crc32(self._vectors[row].tobytes())
+                    ):
+                        continue
+                    matches.append((float(similarities[i, row]), found[0]))
+                if matches:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                results.append(matches)
+        return results
+
+    def get(self, prompt_id, model_id, text):
+        """Returns the response to the most similar cached request, if any.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        model_id : str
+            Identity of the model.
+        text : str
+            The cell text.
+
+        Returns
+        -------
+        response : str or None
+            The cached response, or None on a cache miss.
+        """
+        (matches,) = self.lookup_many([(prompt_id, model_id, text)])
+        return matches[0][1] if matches else None
+
+    def set(self, prompt_id, model_id, text, response):
+        """Stores a response, overwriting the oldest entry if the cache is full.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        model_id : str
+            Identity of the model.
+        text : str
+            The cell text.
+        response : str
+            The model response.
+        """
+        self.set_many([(prompt_id, model_id, text, response)])
+
+    def set_many(self, entries):
+        """Stores a batch of responses in one transaction.
+
+        Parameters
+        ----------
+        entries : list of tuple
+            ``(prompt_id, model_id, text, response)`` tuples.
+        """
+        embeddings = embed_texts([text for _, _, text, _ in entries], dim=self.dim)
+        now = time.time()
+        with self._lock, self._conn:
+            # Kernels sharing the cache take turns to allocate rows
+            self._conn.execute('BEGIN IMMEDIATE')
+            (seq,) = self._conn.execute(
+                'SELECT seq FROM similarity_state WHERE id = 0'
+            ).fetchone()
+            self._conn.execute(
+                'UPDATE similarity_state SET seq = ? WHERE id = 0',
+                (seq + len(entries),),
+            )
+            rows = []
+            for i, (prompt_id, model_id, _, response) in enumerate(entries):
+                row = (seq + i) % self.max_entries
+                namespace = _namespace(prompt_id, model_id)
+                checksum = zlib.crc32(embeddings[i].tobytes())
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO similarity '
+                    '(row, namespace, response, created, seq, checksum) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (row, namespace, response, now, seq + i, checksum),
+                )
+                rows.append((row, namespace))
+            # Written last, so that if the transaction fails the rows' previous
+            # entries no longer match their checksums and are skipped
+            for i, (row, namespace) in enumerate(rows):
+                self._vectors[row] = embeddings[i]
+                self._namespaces[row] = namespace
+                self._used[row] = True
+                self._created[row] = now
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of cached responses.
+
+        Returns
+        -------
+        stats : dict
+            Dictionary with 'hits', 'misses' and 'entries' keys.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': int(self._used.sum()),
+        }
+
+    def clear(self):
+        """Deletes all cached responses."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM similarity')
+            self._used[:] = False
+
+    def close(self):
+        """Flushes the embeddings to disk and closes the database connection."""
+        with self._lock:
+            self._vectors.flush()
+            self._conn.close()
 
 
 class LLMCacher:
-    """A class for caching and managing LLM (Language Model) instances."""
+    """A class for caching and managing LLM (Language Model) responses.
+
+    Precomputed responses (see ``chatify-build-cache``) are read from the
+    cache database, which is never evicted from. Responses generated at
+    runtime are cached in a separate local database next to it, which keeps
+    the ``max_entries`` most recently used ones.
+
+    When the cache database is downloaded, it is downloaded in the background
+    and the caches are only opened once the download has finished; until then
+    every lookup is a miss and nothing is stored.
+
+    With the ``similarity`` caching strategy, the precomputed responses are
+    indexed for similarity lookups once, the first time the cache database is
+    opened, so that lightly edited course cells are answered from it too. Only
+    databases built with their cell texts (as ``chatify-build-cache`` does) can
+    be indexed.
+
+    With ``shared_path`` set, responses are also cached in a database shared
+    by every kernel on the node, so that a cell explained in one kernel is
+    answered from the cache in all the others.
+    """
 
     def __init__(self, config):
         """Initializes a new LLMCacher instance.
@@ -21,56 +979,222 @@ class LLMCacher:
             A dictionary containing configuration parameters.
         """
         self.cache_config = config['cache_config']
-        self.llm_cache = None
+        self.model_id = model_identity(config['model_config'])
+        self.response_cache = None
+        self.local_cache = None
+        self.similarity_cache = None
+        self.precomputed_similarity_cache = None
+        self._ready = threading.Event()
         self._download_qa_database()
 
+        self.shared_cache = None
+        shared_path = self.cache_config.get('shared_path', None)
+        if shared_path is not None:
+            mode = self.cache_config.get('shared_mode', None)
+            if isinstance(mode, str):
+                mode = int(mode, 8)
+            try:
+                self.shared_cache = ResponseCache(
+                    os.path.expanduser(shared_path),
+                    max_entries=self.cache_config.get('shared_max_entries', 100000),
+                    ttl=self.cache_config.get('ttl', None),
+                    dictionary_version=self.cache_config['cache_db_version'],
+                    shared=True,
+                    mode=mode,
+                )
+            except sqlite3.Error as e:
+                print(f'{shared_path} could not be opened as a shared cache: {e}')
+
+    def _shared(self, method, *args):
+        # A busy or broken shared cache must not fail the request
+        try:
+            return getattr(self.shared_cache, method)(*args)
+        except sqlite3.Error as e:
+            print(f'The shared Chatify cache is unavailable: {e}')
+            return None
+
+    def _open_caches(self):
+        max_entries = self.cache_config.get('max_entries', 10000)
+        # Precomputed responses are all kept, however many there are, and the
+        # database is never changed, so that it is not downloaded again
+        self.response_cache = None
+        if os.path.exists(self.db_file):
+            try:
+                self.response_cache = ResponseCache(
+                    self.db_file,
+                    max_entries=None,
+                    ttl=self.cache_config.get('ttl', None),
+                    dictionary_version=self.cache_config['cache_db_version'],
+                    read_only=True,
+                )
+            except sqlite3.DatabaseError as e:
+                print(f'Precomputed responses are not used: {e}')
+        self.local_cache = ResponseCache(
+            self.local_file,
+            max_entries=max_entries,
+            ttl=self.cache_config.get('ttl', None),
+            dictionary_version=self.cache_config['cache_db_version'],
+        )
+
+        # Similar (e.g. lightly edited) cells fall back to the similarity caches
+        self.similarity_cache = self.precomputed_similarity_cache = None
+        if self.cache_config.get('caching_strategy', 'exact') == 'similarity':
+            self.similarity_cache = SimilarityCache(
+                self.local_file,
+                max_entries=max_entries,
+                threshold=self.cache_config.get('similarity_threshold', 0.95),
+                ttl=self.cache_config.get('ttl', None),
+            )
+            if self.response_cache is not None:
+                self.precomputed_similarity_cache = self._index_precomputed()
+
+    def _index_precomputed(self):
+        texts = self.response_cache.texts(self.model_id)
+        if not texts:
+            return None
+        index = SimilarityCache(
+            self.index_file,
+            max_entries=len(texts),
+            threshold=self.cache_config.get('similarity_threshold', 0.95),
+        )
+        # The index is only built when the database is first opened (a new
+        # database has a new cache_db_version, and so a new index file)
+        if index.stats()['entries'] != len(texts):
+            index.clear()
+            index.set_many(
+                [
+                    (prompt_id, self.model_id, text, response)
+                    for prompt_id, text, response in texts
+                ]
+            )
+        return index
+
     def _download_qa_database(self):
         cache_db_version = self.cache_config['cache_db_version']
         self.db_file = f'NMA_2023_v{cache_db_version}.cache'
+        self.local_file = f'NMA_2023_v{cache_db_version}.local.cache'
+        self.index_file = f'NMA_2023_v{cache_db_version}.index.cache'
+
+        url = self.cache_config['url']
+        if url is None:
+            self._open_caches()
+            self._ready.set()
+            return
 
-        if self.cache_config['url'] is not None:
-            download_cache_database(self.cache_config)
+        # Imported here so that requests is only loaded when downloading
+        from .download import start_download
 
-    def cache_llm(self, llm, *args, **kwargs):
-        """Caches the LLM using the specified caching strategy.
+        self.download = start_download(
+            url, self.db_file, sha256=self.cache_config.get('sha256', None)
+        )
+        self.download.add_done_callback(self._download_done)
+
+    def _download_done(self, download):
+        error = download.exception()
+        if error is not None:
+            # Fall back to the previously downloaded copy, if any
+            url = self.cache_config['url']
+            print(f'{self.db_file} could not be downloaded from {url}: {error}')
+        try:
+            self._open_caches()
+        except sqlite3.DatabaseError as e:
+            self.response_cache = self.local_cache = None
+            self.similarity_cache = self.precomputed_similarity_cache = None
+            print(f'{self.db_file} could not be opened, caching is disabled: {e}')
+        finally:
+            self._ready.set()
+
+    def wait(self, timeout=None):
+        """Waits for the cache database to be downloaded and opened.
 
         Parameters
         ----------
-        llm : LLM
-            The LLM (Language Model) to be cached.
-        *args : positional arguments
-            Additional positional arguments.
-        **kwargs : keyword arguments
-            Additional keyword arguments.
+        timeout : float, optional
+            Seconds to wait at most, by default until it is ready.
 
         Returns
         -------
-        llm : LangChainLLMs
-            The LangChainLLMs instance after caching the LLM.
-        """
-        self.llm_cache = Cache()
-        self.llm_cache.set_openai_key()
-
-        if self.cache_config['caching_strategy'] == 'similarity':
-            onnx = Onnx()
-            cache_base = CacheBase(self.db_file)
-            vector_base = VectorBase('faiss', dimension=onnx.dimension)
-            data_manager = get_data_manager(
-                cache_base, vector_base, max_size=10, clean_size=2
-            )
-            self.llm_cache.init(
-                pre_embedding_func=get_prompt,
-                embedding_func=onnx.to_embeddings,
-                data_manager=data_manager,
-                similarity_evaluation=SearchDistanceEvaluation(),
+        ready : bool
+            Whether the caches are open.
+        """
+        return self._ready.wait(timeout) and self.local_cache is not None
+
+    def lookup(self, prompt_id, text):
+        """Returns the cached response to a request, if there is one.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        text : str
+            The cell text.
+
+        Returns
+        -------
+        response : str or None
+            The cached response, or None on a cache miss.
+        """
+        response = None
+        if self.local_cache is not None:
+            response = self.local_cache.get(prompt_id, self.model_id, text)
+        if response is None and self.response_cache is not None:
+            response = self.response_cache.get(prompt_id, self.model_id, text)
+        if response is None and self.shared_cache is not None:
+            response = self._shared('get', prompt_id, self.model_id, text)
+        if response is None and self.similarity_cache is not None:
+            response = self.similarity_cache.get(prompt_id, self.model_id, text)
+        if response is None and self.precomputed_similarity_cache is not None:
+            response = self.precomputed_similarity_cache.get(
+                prompt_id, self.model_id, text
             )
-        else:
-            # Exact caching
-            data_manager = get_data_manager(data_path=self.db_file)
-            self.llm_cache.init(
-                pre_embedding_func=get_prompt,
-                data_manager=data_manager,
-                similarity_evaluation=ExactMatchEvaluation(),
+        return response
+
+    def store(self, prompt_id, text, response):
+        """Caches the response to a request.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+        text : str
+            The cell text.
+        response : str
+            The model response.
+        """
+        if self.shared_cache is not None:
+            # Other kernels may hold the shared database's write lock for up to
+            # its busy timeout, so the response is stored in the background
+            from .workers import get_executor
+
+            get_executor(1, name='chatify-shared-cache').submit(
+                self._shared, 'set', prompt_id, self.model_id, text, response
             )
-        llm = LangChainLLMs(llm=llm)
-        return llm
+        if self.local_cache is None:
+            return
+        self.local_cache.set(prompt_id, self.model_id, text, response)
+        if self.similarity_cache is not None:
+            self.similarity_cache.set(prompt_id, self.model_id, text, response)
+
+    def stats(self):
+        """Returns the cache hit and miss counters.
+
+        Returns
+        -------
+        stats : dict
+            Dictionary with the 'hits', 'misses' and 'entries' of the cache
+            database (missing while it is being downloaded), plus 'local',
+            'similarity', 'precomputed_similarity' and 'shared' entries with
+            the counters of those caches, if enabled.
+        """
+        stats = {}
+        if self.response_cache is not None:
+            stats.update(self.response_cache.stats())
+        if self.local_cache is not None:
+            stats['local'] = self.local_cache.stats()
+        if self.similarity_cache is not None:
+            stats['similarity'] = self.similarity_cache.stats()
+        if self.precomputed_similarity_cache is not None:
+            stats['precomputed_similarity'] = self.precomputed_similarity_cache.stats()
+        if self.shared_cache is not None:
+            stats['shared'] = self._shared('stats')
+        return stats
@@ -1,13 +1,67 @@
-from typing import Any, Dict, List, Optional
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
 
-import requests
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from langchain.chains import LLMChain, LLMMathChain
 from langchain.chains.base import Chain
 from langchain.prompts import PromptTemplate
 
-from .llm_models import ModelsFactory
-from .utils import compress_code
+from .model_registry import get_model_registry
+from .stats import label, span
+from .transport import (
+    JSON,
+    STREAMING_ACCEPT,
+    decode_response,
+    get_transport,
+    iter_chunks,
+    media_type,
+    read_body,
+)
+from .utils import fingerprint, read_prompt_dir
+
+
+class StreamingHandler(BaseCallbackHandler):
+    """Callback handler that passes partial responses on as tokens arrive.
+
+    Updates are throttled to at most one every ``min_interval`` seconds, so
+    that re-rendering the partial response does not slow down generation.
+    """
+
+    def __init__(self, on_update: Callable[[str], None], min_interval: float = 0.1):
+        """Initializes the StreamingHandler instance.
+
+        Parameters
+        ----------
+        on_update : callable
+            Called with the full text received so far.
+        min_interval : float, optional
+            Minimum number of seconds between two updates, by default 0.1.
+        """
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.text = ""
+        self._last_update = 0.0
+
+    def _append(self, token: str) -> None:
+        self.text += token
+        now = time.monotonic()
+        if now - self._last_update >= self.min_interval:
+            self._last_update = now
+            self.on_update(self.text)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Receives a new token from a streaming LLM."""
+        self._append(token)
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        """Receives a new chunk from a streaming :class:`RequestChain`."""
+        # LLMChain also reports the formatted prompt through on_text
+        if kwargs.get("stream", False):
+            self._append(text)
 
 
 class RequestChain(Chain):
@@ -17,6 +71,8 @@ class RequestChain(Chain):
         "accept": "application/json",
         "Content-Type": "application/json",
     }
+    transport: Any = None
+    streaming: bool = False
     input_key: str = "text"
     url: str = "url"  #: :meta private:
     output_key: str = "text"  #: :meta private:
@@ -43,14 +99,27 @@ class RequestChain(Chain):
         run_manager: Optional[CallbackManagerForChainRun] = None,
     ) -> Dict[str, Any]:
         # Prepare data
-        if self.url != "/":
-            self.url += "/"
-        combined_url = self.url + self.prompt["prompt_id"] + "/response"
+        url = self.url if self.url.endswith("/") else self.url + "/"
+        combined_url = url + self.prompt["prompt_id"] + "/response"
         data = {"user_text": inputs[self.input_key]}
 
-        # Send the request
-        response = requests.post(url=combined_url, headers=self.headers, json=data)
-        output = eval(response.content.decode("utf-8"))
+        # Send the request through the shared, keep-alive connection pool
+        transport = self.transport or get_transport()
+        if self.streaming and run_manager is not None:
+            # Servers that cannot stream ignore the header and reply as usual
+            headers = {**self.headers, "accept": STREAMING_ACCEPT}
+            response = transport.post(combined_url, data, headers=headers, stream=True)
+            if media_type(response) != JSON:
+                chunks = []
+                for chunk in iter_chunks(response):
+                    chunks.append(chunk)
+                    run_manager.on_text(chunk, stream=True)
+                return {self.output_key: "".join(chunks)}
+        else:
+            response = transport.post(combined_url, data, headers=self.headers)
+        content = read_body(response)
+        with span("decode"):
+            output = decode_response(content)
 
         return {self.output_key: output}
 
@@ -73,31 +142,126 @@ class CreateLLMChain:
         self.chain_config = config["chain_config"]
 
         self.llm_model = None
-        self.llm_models_factory = ModelsFactory()
+        # Configuration the shared model was acquired with, until it is released
+        self._model_config = None
+
+        # Chains only differ by prompt, so they are built once and reused
+        self.max_cached_chains = self.chain_config.get("max_cached_chains", 32)
+        self._chains = OrderedDict()
+        self._chains_lock = threading.Lock()
 
         self.cache = config["cache_config"]["cache"]
-        # NOTE: The caching function is deprecated
-        # self.cacher = LLMCacher(config)
+        self.cacher = None
+        if self.cache:
+            # Imported here so that numpy is only loaded when caching is enabled
+            from .cache import LLMCacher
+
+            self.cacher = LLMCacher(config)
+
+        # Precomputed answers are checked before any request to the proxy
+        self.answer_store = None
+        self._model_ids = ()
+        store_path = config["cache_config"].get("answer_store")
+        if store_path is not None and config["model_config"]["model"] in (
+            "proxy",
+            "cached_model",
+        ):
+            from .answer_store import AnswerStore
+            from .utils import model_identity
+
+            self.answer_store = AnswerStore(os.path.expanduser(store_path))
+            self._model_ids = (model_identity(config["model_config"]),)
 
         # Setup model and chain factory
         self._setup_llm_model(config["model_config"])
         self._setup_chain_factory()
+        self._setup_compaction(config["model_config"])
 
         return None
 
     def _setup_llm_model(self, model_config):
         """Sets up the LLM model.
 
+        Models are shared by every chain in the process with the same model
+        configuration, so the weights are only loaded once.
+
         Returns
         --------
         None
         """
-        if self.llm_model is None:
-            self.llm_model = self.llm_models_factory.get_model(model_config)
+        if self._model_config is None:
+            self.llm_model = get_model_registry().acquire(model_config)
+            self._model_config = model_config
+
+            if model_config.get("model") == "llama_model" and model_config.get(
+                "prefix_cache", False
+            ):
+                self._warm_prefixes()
+
+    def _warm_prefixes(self):
+        """Evaluates the prompts' fixed prefixes in the background.
+
+        Returns
+        --------
+        future : concurrent.futures.Future
+            Resolves to the number of evaluated prefixes.
+        """
+        from .prefix_cache import warm_prefixes
+        from .workers import get_executor
+
+        prompts_to_use = self.config.get("prompts_config", {}).get("prompts_to_use", [])
+        prompts = [
+            prompt
+            for prompt_type in read_prompt_dir(prompts_to_use).values()
+            for prompt in prompt_type.values()
+        ]
+        return get_executor(1, name="chatify-prefix").submit(
+            warm_prefixes, self.llm_model, prompts
+        )
+
+    def _setup_compaction(self, model_config):
+        """Sets up the compaction of the code sent to the model.
+
+        Returns
+        --------
+        None
+        """
+        self.compaction = None
+        if not self.chain_config.get("compact_code", False):
+            return
+
+        from .compaction import get_token_counter
+
+        self.compaction = {
+            "drop_comments": self.chain_config.get("drop_comments", True),
+            "max_literal_chars": self.chain_config.get("max_literal_chars", 200),
+            "max_sequence_items": self.chain_config.get("max_sequence_items", 16),
+            "max_tokens": self.chain_config.get("max_code_tokens"),
+        }
+        if self.compaction["max_tokens"] is not None:
+            # Loading a tokenizer is slow, so it is only done once
+            self.compaction["count_tokens"] = get_token_counter(
+                model_config, self.llm_model
+            )
+
+    def close(self):
+        """Releases the model and discards the memoized chains.
 
-            # NOTE: The caching function is deprecated
-            if self.cache:
-                self.llm_model = self.cacher.cache_llm(self.llm_model)
+        The model stays loaded for other chains; unused models are freed with
+        ``get_model_registry().evict()``.
+
+        Returns
+        --------
+        None
+        """
+        self.clear_chain_cache()
+        if self.answer_store is not None:
+            self.answer_store.close()
+            self.answer_store = None
+        if self._model_config is not None:
+            get_model_registry().release(self._model_config)
+            self._model_config = None
+        self.llm_model = None
 
     def _setup_chain_factory(self):
         """Sets up the chain factory dictionary.
@@ -128,21 +292,29 @@ class CreateLLMChain:
         )
         return PROMPT
 
-    def create_chain(self, model_config=None, prompt_template=None):
-        """Creates an LLM chain based on the model configuration and prompt template.
+    def _build_chain(self, prompt_template):
+        """Builds a new LLM chain for the prompt template.
 
         Parameters
         ----------
-        model_config (dict): Configuration settings for the LLM model.
-        prompt_template (PromptTemplate): Prompt template object.
+        prompt_template (dict): Prompt configuration.
 
         Returns
         -------
         chain (LLMChain): LLM chain object.
         """
+        # The prompt id identifies the prompt in the response cache
+        metadata = {
+            "prompt_id": prompt_template.get("prompt_id")
+            or fingerprint(prompt_template.get("content"))
+        }
         if self.config["chain_config"]["chain_type"] == "proxy":
             chain = RequestChain(
-                url=self.config["model_config"]["proxy_url"], prompt=prompt_template
+                url=self.config["model_config"]["proxy_url"],
+                prompt=prompt_template,
+                transport=get_transport(self.config["model_config"]),
+                streaming=self.config["model_config"].get("streaming", False),
+                metadata=metadata,
             )
         else:
             try:
@@ -151,11 +323,60 @@ class CreateLLMChain:
                 chain_type = "default"
 
             chain = self.chain_factory[chain_type](
-                llm=self.llm_model, prompt=self.create_prompt(prompt_template)
+                llm=self.llm_model,
+                prompt=self.create_prompt(prompt_template),
+                metadata=metadata,
             )
         return chain
 
-    def execute(self, chain, inputs, *args, **kwargs):
+    def create_chain(self, model_config=None, prompt_template=None):
+        """Creates an LLM chain based on the model configuration and prompt template.
+
+        Chains are memoized in a bounded LRU cache keyed on the chain type, the
+        prompt and the model configuration, so editing a prompt file or the
+        model configuration yields a new chain.
+
+        Parameters
+        ----------
+        model_config (dict): Configuration settings for the LLM model.
+        prompt_template (PromptTemplate): Prompt template object.
+
+        Returns
+        -------
+        chain (LLMChain): LLM chain object.
+        """
+        # Python caches string hashes, so keying on the template text is cheap
+        key = (
+            self.chain_config.get("chain_type", "default"),
+            prompt_template.get("prompt_id"),
+            prompt_template.get("content"),
+            tuple(prompt_template.get("input_variables", ())),
+            fingerprint(self.config["model_config"]),
+        )
+        with self._chains_lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                self._chains.move_to_end(key)
+                return chain
+
+        chain = self._build_chain(prompt_template)
+        with self._chains_lock:
+            self._chains[key] = chain
+            while len(self._chains) > self.max_cached_chains:
+                self._chains.popitem(last=False)
+        return chain
+
+    def clear_chain_cache(self):
+        """Discards all memoized chains.
+
+        Returns
+        --------
+        None
+        """
+        with self._chains_lock:
+            self._chains.clear()
+
+    def execute(self, chain, inputs, *args, on_update=None, **kwargs):
         """Executes the LLM chain with the given inputs.
 
         Parameters
@@ -163,6 +384,8 @@ class CreateLLMChain:
         chain (LLMChain): LLM chain object.
         inputs (str): Input text to be processed by the chain.
         *args: Additional positional arguments.
+        on_update (callable, optional): Called with the partial output as it is
+            streamed in, if the model or proxy supports streaming.
         **kwargs: Additional keyword arguments.
 
         Returns
@@ -170,11 +393,44 @@ class CreateLLMChain:
         output: Output text generated by the LLM chain.
         """
 
-        if self.cache:
-            inputs = chain.prompt.format(text=compress_code(inputs))
-            output = chain.llm(inputs, cache_obj=self.cacher.llm_cache)
-            self.cacher.llm_cache.flush()
-        else:
-            output = chain.invoke(inputs)["text"]
+        prompt_id = (chain.metadata or {}).get("prompt_id")
+        use_cache = self.cacher is not None and prompt_id is not None
+
+        if self.answer_store is not None and prompt_id is not None:
+            with span("cache_lookup"):
+                output = self.answer_store.get(prompt_id, inputs, self._model_ids)
+            if output is not None:
+                label(cache="store")
+                return output
+
+        # Answer from the response cache before calling the model or proxy
+        if use_cache:
+            with span("cache_lookup"):
+                output = self.cacher.lookup(prompt_id, inputs)
+            label(cache="hit" if output is not None else "miss")
+            if output is not None:
+                return output
+
+        # Caches are keyed on the cell as written, as by chatify-build-cache;
+        # only the model sees the compacted code
+        model_inputs = inputs
+        if self.compaction is not None and isinstance(inputs, str):
+            from .compaction import compact_code
+
+            with span("compact"):
+                model_inputs = compact_code(inputs, **self.compaction)
+
+        with span("model"):
+            if on_update is not None:
+                handler = StreamingHandler(on_update)
+                output = chain.invoke(model_inputs, config={"callbacks": [handler]})[
+                    "text"
+                ]
+            else:
+                output = chain.invoke(model_inputs)["text"]
+
+        if use_cache:
+            with span("cache_store"):
+                self.cacher.store(prompt_id, inputs, output)
 
         return output
@@ -0,0 +1,320 @@
+"""Compaction of code cells before they are sent to a model.
+
+Prompts are mostly made of the user's code, so every token removed from it
+makes a request faster and cheaper. :func:`compact_code` works on Python
+tokens and on the syntax tree rather than on lines, so indentation (which is
+meaningful in Python) is kept while comments, long string literals (e.g.
+docstrings) and long literal data arrays are dropped or collapsed. The result
+is then truncated to a token budget, counted with the model's own tokenizer
+(see :func:`get_token_counter`).
+"""
+
+import ast
+import functools
+import io
+import re
+import tokenize
+
+_TOKENIZE_ERRORS = (tokenize.TokenError, IndentationError, SyntaxError)
+
+# IPython line magics and shell commands, which are not valid Python (but not
+# e.g. a continued "% b" or "!= b")
+_MAGIC_LINE = re.compile(r"^[ \t]*(?:%[A-Za-z_]|!(?!=)).*$", re.MULTILINE)
+
+_STRING_PREFIX = re.compile(r"^([a-zA-Z]*)('''|\"\"\"|'|\")")
+
+
+def _offsets(text):
+    """Returns the offset of the start of every line (1-based) in the text."""
+    offsets = [0, 0]
+    for line in text.split("\n"):
+        offsets.append(offsets[-1] + len(line) + 1)
+    return offsets
+
+
+def _position(text, offsets, lineno, byte_col):
+    """Converts a line and UTF-8 byte column, as given by ast, to an offset."""
+    line = text[offsets[lineno] : offsets[lineno + 1]]
+    return offsets[lineno] + len(line.encode("utf-8")[:byte_col].decode("utf-8"))
+
+
+def _is_constant(node):
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return _is_constant(node.operand)
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return all(_is_constant(element) for element in node.elts)
+    if isinstance(node, ast.Dict):
+        return all(
+            key is not None and _is_constant(key) and _is_constant(value)
+            for key, value in zip(node.keys, node.values)
+        )
+    return False
+
+
+def _mask_magics(text):
+    """Blanks out magic and shell lines, keeping the offsets of the rest."""
+    return _MAGIC_LINE.sub(lambda match: " " * len(match.group()), text)
+
+
+def _array_edits(text, offsets, max_items):
+    """Collapses literal arrays with more than ``max_items`` items to ``...``."""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return []
+
+    edits = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Dict):
+            items = node.values
+        elif isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            items = node.elts
+        else:
+            continue
+        if len(items) <= max_items or not _is_constant(node):
+            continue
+        # Keep the first items and replace the others by an Ellipsis, so that
+        # the code stays valid
+        last_kept, last = items[max_items - 1], items[-1]
+        start = _position(text, offsets, last_kept.end_lineno, last_kept.end_col_offset)
+        end = _position(text, offsets, last.end_lineno, last.end_col_offset)
+        edits.append((start, end, ", ..."))
+    return edits
+
+
+def _shorten_string(token, max_chars):
+    match = _STRING_PREFIX.match(token)
+    if match is None:
+        return token
+    prefix, quote = match.groups()
+    body = token[len(prefix) + len(quote) : -len(quote)]
+    # Never end the kept part on a backslash, which would escape the quote
+    kept = body[:max_chars].rstrip("\\")
+    return f"{prefix}{quote}{kept}...{quote}"
+
+
+def _token_edits(text, masked, offsets, drop_comments, max_literal_chars):
+    """Drops comments and shortens long strings.
+
+    ``masked`` is the text with its magics blanked out, which is tokenized so
+    that e.g. the ``#egg=`` of a ``!pip install`` URL is not taken for a
+    comment; edits are made on the original text.
+    """
+    edits = []
+    tokens = []
+    try:
+        tokens.extend(tokenize.generate_tokens(io.StringIO(masked).readline))
+    except _TOKENIZE_ERRORS:
+        # Keep the edits of the tokens before e.g. an unterminated string
+        pass
+    for token in tokens:
+        (start_row, start_col), (end_row, end_col) = token.start, token.end
+        start = offsets[start_row] + start_col
+        end = offsets[end_row] + end_col
+        if token.type == tokenize.COMMENT and drop_comments:
+            line_start = offsets[start_row]
+            before = text[line_start:start].rstrip()
+            if before:
+                # Also drop the whitespace before the comment
+                edits.append((line_start + len(before), end, ""))
+            else:
+                edits.append((line_start, offsets[start_row + 1], ""))
+        elif (
+            token.type == tokenize.STRING
+            and max_literal_chars is not None
+            and len(token.string) > max_literal_chars
+        ):
+            # A string may span masked lines, so it is read from the original
+            string = text[start:end]
+            edits.append((start, end, _shorten_string(string, max_literal_chars)))
+    return edits
+
+
+def _apply(text, edits):
+    parts = []
+    position = 0
+    for start, end, replacement in sorted(edits):
+        # Edits inside a collapsed array have nothing left to edit
+        if start < position:
+            continue
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def _drop_blank_lines(text):
+    lines = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        # Runs of blank lines are collapsed into one
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def truncate_to_budget(text, max_tokens, count_tokens):
+    """Keeps the first lines of the text that fit in a token budget.
+
+    Parameters
+    ----------
+    text : str
+        The text.
+    max_tokens : int
+        Maximum number of tokens.
+    count_tokens : callable
+        Returns the number of tokens of a string.
+
+    Returns
+    -------
+    text : str
+        The text if it fits, otherwise its first lines followed by a comment
+        giving the number of dropped lines.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    lines = text.splitlines()
+
+    def truncated(n):
+        return "\n".join(lines[:n] + [f"# ... ({len(lines) - n} more lines)"])
+
+    # Binary search for the most lines that fit, tokenizing O(log n) times
+    low, high = 0, len(lines)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(truncated(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return truncated(low)
+
+
+def _compact_python(text, drop_comments, max_literal_chars, max_sequence_items):
+    # Lines are only split at "\n", as by tokenize
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    offsets = _offsets(text)
+    # Magics are blanked out rather than removed, to keep the offsets valid
+    masked = _mask_magics(text)
+    edits = []
+    if max_sequence_items is not None:
+        edits += _array_edits(masked, offsets, max_sequence_items)
+    edits += _token_edits(text, masked, offsets, drop_comments, max_literal_chars)
+    return _drop_blank_lines(_apply(text, edits))
+
+
+def compact_code(
+    text,
+    drop_comments=True,
+    max_literal_chars=200,
+    max_sequence_items=16,
+    max_tokens=None,
+    count_tokens=None,
+):
+    """Reduces the number of tokens of a code cell, keeping its meaning.
+
+    Parameters
+    ----------
+    text : str
+        The code.
+    drop_comments : bool, optional
+        Whether to drop comments, by default True.
+    max_literal_chars : int, optional
+        String literals (including docstrings) longer than this are cut, by
+        default 200; None keeps them.
+    max_sequence_items : int, optional
+        Literal lists, tuples, sets and dicts with more items than this are cut
+        to their first items followed by ``...``, by default 16; None keeps
+        them.
+    max_tokens : int, optional
+        Token budget; code exceeding it is cut to its first lines. By default
+        the code is not truncated.
+    count_tokens : callable, optional
+        Returns the number of tokens of a string; required with
+        ``max_tokens``.
+
+    Returns
+    -------
+    text : str
+        The compacted code. Cell magics (cells starting with ``%%``) are not
+        Python and are only truncated.
+    """
+    if not text.lstrip().startswith("%%"):
+        text = _compact_python(
+            text, drop_comments, max_literal_chars, max_sequence_items
+        )
+    if max_tokens is not None:
+        text = truncate_to_budget(text, max_tokens, count_tokens)
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def _huggingface_tokenizer(model_name):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_encoding(model_name):
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens of a string without a tokenizer.
+
+    Parameters
+    ----------
+    text : str
+        The text.
+
+    Returns
+    -------
+    tokens : int
+        About one token per four characters, as for most BPE tokenizers on
+        English text and code.
+    """
+    return (len(text) + 3) // 4
+
+
+def get_token_counter(model_config, llm=None):
+    """Returns a function counting tokens with the model's tokenizer.
+
+    Tokenizers are loaded once per process.
+
+    Parameters
+    ----------
+    model_config : dict
+        Configuration of the model.
+    llm : LLM, optional
+        The loaded model, used to tokenize with llama.cpp models.
+
+    Returns
+    -------
+    count_tokens : callable
+        Returns the number of tokens of a string. Falls back to
+        :func:`estimate_tokens` when the tokenizer is not available, e.g. for
+        the proxy.
+    """
+    model = model_config.get("model")
+    try:
+        if model == "llama_model" and llm is not None:
+            client = getattr(llm, "llm", llm).client
+            return lambda text: len(client.tokenize(text.encode("utf-8"), False))
+        if model == "huggingface_model":
+            tokenizer = _huggingface_tokenizer(model_config["model_name"])
+            return lambda text: len(tokenizer.encode(text))
+        encoding = _tiktoken_encoding(model_config.get("model_name", "gpt-4"))
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except (ImportError, OSError, AttributeError):
+        return estimate_tokens
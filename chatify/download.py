@@ -0,0 +1,216 @@
+"""Resumable, verified downloads of cache databases.
+
+:func:`download_file` downloads to ``<path>.part`` and only renames the file to
+``<path>`` once it is complete and verified, so a crash or a lost connection
+never leaves a truncated database behind. An interrupted download is resumed
+from where it stopped with an HTTP ``Range`` request. A file that is already
+complete is not downloaded again: its checksum is checked against the
+expected one or, without one, the server is asked whether it changed since
+(``If-None-Match``). What is known about the downloaded file is kept in
+``<path>.json``.
+
+:func:`start_download` runs the download in a background thread, so that
+loading the extension does not wait for it.
+"""
+
+import hashlib
+import json
+import os
+
+import requests
+
+# Bytes read at a time; a dropped connection loses at most the chunk being read
+CHUNK_SIZE = 64 * 1024
+
+
+class ChecksumError(ValueError):
+    """Raised when a downloaded file does not have the expected checksum."""
+
+
+def _sha256(path, h=None):
+    h = h or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(path, meta):
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+
+def _is_current(path, meta, url, sha256):
+    """Returns whether the file at path is the complete download of url."""
+    if not os.path.exists(path) or meta.get("url") != url:
+        return False
+    stat = os.stat(path)
+    # The checksum is only recomputed when the file changed since it was stored
+    if meta.get("size") != stat.st_size or meta.get("mtime") != stat.st_mtime:
+        meta["sha256"] = _sha256(path).hexdigest()
+        meta["size"], meta["mtime"] = stat.st_size, stat.st_mtime
+    return sha256 is None or meta["sha256"] == sha256.lower()
+
+
+def download_file(url, path, sha256=None, timeout=(3.05, 60), session=None):
+    """Downloads a file, resuming and verifying it.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file.
+    path : str
+        Where to save the file.
+    sha256 : str, optional
+        Expected SHA-256 hex digest of the file. Without it, the file is
+        checked for changes with its ETag or modification date.
+    timeout : float or tuple, optional
+        Connect and read timeouts in seconds, by default (3.05, 60).
+    session : requests.Session, optional
+        Session to download with, by default a new one.
+
+    Returns
+    -------
+    downloaded : bool
+        Whether the file was (re)downloaded; False if it was already current.
+
+    Raises
+    ------
+    ChecksumError
+        If the downloaded file does not have the expected checksum (or size).
+    requests.RequestException
+        If the download fails. A partial download is kept and resumed by the
+        next call.
+    """
+    session = session or requests.Session()
+    meta_path = path + ".json"
+    part = path + ".part"
+    meta = _read_meta(meta_path)
+
+    headers = {}
+    if _is_current(path, meta, url, sha256):
+        if sha256 is not None:
+            _write_meta(meta_path, meta)
+            return False
+        # Ask the server whether the file changed since it was downloaded
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        elif meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        else:
+            return False
+
+    # Resume a partial download of the same version of the file
+    offset = 0
+    part_meta = meta.get("part", {})
+    if os.path.exists(part) and part_meta.get("url") == url:
+        offset = os.path.getsize(part)
+        validator = part_meta.get("etag") or part_meta.get("last_modified")
+        if offset and validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        else:
+            offset = 0
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            _write_meta(meta_path, meta)
+            return False
+        if response.status_code == 416:
+            # The partial file is not a prefix of the current one; start over
+            os.remove(part)
+            meta.pop("part", None)
+            _write_meta(meta_path, meta)
+            return download_file(url, path, sha256, timeout, session)
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            total = response.headers.get("Content-Range", "*").rsplit("/", 1)[-1]
+            size = int(total) if total.isdigit() else None
+            h = _sha256(part)
+        else:
+            # The server ignored the range, or the file changed: start over
+            offset = 0
+            length = response.headers.get("Content-Length")
+            size = int(length) if length is not None else None
+            h = hashlib.sha256()
+
+        meta["part"] = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        _write_meta(meta_path, meta)
+
+        with open(part, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                h.update(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    digest = h.hexdigest()
+    if size is not None and os.path.getsize(part) != size:
+        raise ChecksumError(
+            f"Downloaded {os.path.getsize(part)} of {size} bytes from {url}"
+        )
+    if sha256 is not None and digest != sha256.lower():
+        # A corrupt file would be resumed forever, so it is discarded
+        os.remove(part)
+        meta.pop("part", None)
+        _write_meta(meta_path, meta)
+        raise ChecksumError(f"{url} does not have the expected SHA-256 checksum")
+
+    # Journals of a replaced SQLite database would be applied to the new one
+    for journal in (path + "-wal", path + "-shm", path + "-journal"):
+        if os.path.exists(journal):
+            os.remove(journal)
+    os.replace(part, path)
+    stat = os.stat(path)
+    part_meta = meta.pop("part")
+    meta.update(
+        url=url,
+        etag=part_meta["etag"],
+        last_modified=part_meta["last_modified"],
+        sha256=digest,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+    )
+    _write_meta(meta_path, meta)
+    return True
+
+
+def start_download(url, path, sha256=None, **kwargs):
+    """Downloads a file with :func:`download_file` in a background thread.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file.
+    path : str
+        Where to save the file.
+    sha256 : str, optional
+        Expected SHA-256 hex digest of the file.
+    **kwargs
+        Passed on to :func:`download_file`.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Resolves to whether the file was downloaded, or to the download's
+        exception.
+    """
+    from .workers import get_executor
+
+    return get_executor(1, name="chatify-download").submit(
+        download_file, url, path, sha256, **kwargs
+    )
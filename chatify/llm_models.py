@@ -1,19 +1,65 @@
 import os
+import random
 import warnings
+from typing import Any, List, Mapping, Optional
 
-with warnings.catch_warnings():  # catch warnings about accelerate library
-    warnings.simplefilter("ignore")
-    from langchain.callbacks.manager import CallbackManager
-    from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-    from langchain.chat_models import ChatOpenAI
-    from langchain.llms import HuggingFacePipeline, LlamaCpp, OpenAI
+from langchain.llms.base import LLM
 
-    try:
-        from huggingface_hub import hf_hub_download
-    except ModuleNotFoundError:
-        hf_hub_download = None  # ignore missing library unless needed later
+# NOTE: Backend libraries (OpenAI, Hugging Face, llama.cpp) are imported in the
+# init_model method of the model that needs them, so that only the selected
+# backend is ever loaded.
 
-from .utils import FakeListLLM
+
+class FakeListLLM(LLM):
+    """Fake LLM wrapper for testing purposes.
+
+    Attributes
+    ----------
+    responses : List
+        List of responses.
+    """
+
+    responses: List
+
+    @property
+    def _llm_type(self) -> str:
+        """Return type of LLM.
+
+        Returns
+        -------
+        str
+            Type of LLM.
+        """
+        return "fake-list"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """First try to lookup in queries, else return 'foo' or 'bar'.
+
+        Parameters
+        ----------
+        prompt : str
+            Input prompt.
+        stop : List[str], optional
+            List of stop tokens, by default None.
+
+        Returns
+        -------
+        str
+            Generated response.
+        """
+        response = self.responses[random.randint(0, len(self.responses) - 1)]
+        return response
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        """Get the identifying parameters.
+
+        Returns
+        -------
+        Mapping[str, Any]
+            Identifying parameters.
+        """
+        return {}
 
 
 class ModelsFactory:
@@ -138,6 +184,8 @@ class OpenAIModel(BaseLLMModel):
         llm_model : ChatOpenAI
             Initialized OpenAI Chat Model.
         """
+        from langchain.llms import OpenAI
+
         if self.model_config["open_ai_key"] is None:
             raise ValueError("openai_api_key value cannot be None")
 
@@ -178,6 +226,8 @@ class OpenAIChatModel(BaseLLMModel):
         llm_model : ChatOpenAI
             Initialized OpenAI Chat Model.
         """
+        from langchain.chat_models import ChatOpenAI
+
         if self.model_config["open_ai_key"] is None:
             raise ValueError("openai_api_key value cannot be None")
 
@@ -187,6 +237,7 @@ class OpenAIChatModel(BaseLLMModel):
             model_name=self.model_config["model_name"],
             presence_penalty=0.1,
             max_tokens=self.model_config["max_tokens"],
+            streaming=self.model_config.get("streaming", False),
         )
         return llm_model
 
@@ -278,8 +329,9 @@ class HuggingFaceModel(BaseLLMModel):
         self.proxy = self.model_config["proxy"]
         self.proxy_port = self.model_config["proxy_port"]
 
-        with warnings.catch_warnings():
+        with warnings.catch_warnings():  # catch warnings about accelerate library
             warnings.simplefilter("ignore")
+            from langchain.llms import HuggingFacePipeline
 
             try:
                 llm = HuggingFacePipeline.from_model_id(
@@ -298,6 +350,17 @@ class HuggingFaceModel(BaseLLMModel):
                         "presence_penalty": 0.1,
                     },
                 )
+
+        # Concurrent requests are padded into one batched generate call
+        if self.model_config.get("batch_size", 1) > 1:
+            from .batching import BatchingLLM, enable_padding
+
+            enable_padding(llm.pipeline)
+            llm = BatchingLLM(
+                llm=llm,
+                max_batch_size=self.model_config["batch_size"],
+                max_wait_ms=self.model_config.get("batch_wait_ms", 10),
+            )
         return llm
 
 
@@ -324,6 +387,15 @@ class LlamaModel(BaseLLMModel):
         llm_model : HuggingFaceModel
             Initialized Hugging Face Chat Model.
         """
+        with warnings.catch_warnings():  # catch warnings about accelerate library
+            warnings.simplefilter("ignore")
+            from huggingface_hub import hf_hub_download
+            from langchain.callbacks.manager import CallbackManager
+            from langchain.callbacks.streaming_stdout import (
+                StreamingStdOutCallbackHandler,
+            )
+            from langchain.llms import LlamaCpp
+
         self.model_path = hf_hub_download(
             repo_id=self.model_config["model_name"],
             filename=self.model_config["weights_fname"],
@@ -331,7 +403,11 @@ class LlamaModel(BaseLLMModel):
 
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
+            # Streamed tokens go to the response widget instead of stdout
+            if self.model_config.get("streaming", False):
+                callback_manager = CallbackManager([])
+            else:
+                callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
 
             try:
                 llm = LlamaCpp(
@@ -350,6 +426,12 @@ class LlamaModel(BaseLLMModel):
                     callback_manager=callback_manager,
                     verbose=True,
                 )
+
+        # Keep the state after each prompt's fixed preamble to skip evaluating it
+        if self.model_config.get("prefix_cache", False):
+            from .prefix_cache import attach_prefix_cache
+
+            attach_prefix_cache(llm.client, self.model_config)
         return llm
 
 
@@ -1,13 +1,21 @@
-import pathlib
+import collections
+import functools
+import html
+import threading
 
-import ipywidgets as widgets
 import yaml
-from IPython.core.magic import Magics, cell_magic, magics_class
+from IPython.core.magic import Magics, cell_magic, line_magic, magics_class
+from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
 from IPython.display import display
 
-from .chains import CreateLLMChain
+from .prefetch import Prefetcher
+from .prompt_registry import get_registry
+from .stats import get_recorder, span
 from .utils import check_dev_config, get_html
-from .widgets import button_widget, loading_widget, option_widget, text_widget, thumbs
+from .workers import get_executor
+
+# NOTE: ipywidgets, langchain and the model backends are imported on first use,
+# so that `%load_ext chatify` returns quickly.
 
 
 @magics_class
@@ -52,85 +60,189 @@ class Chatify(Magics):
                 "model_config": {
                     "model": "proxy",
                     "proxy_url": "https://chatify.experiments.kordinglab.com/prompt/",
+                    "prewarm": True,
+                    "streaming": True,
                 },
                 "chain_config": {"chain_type": "proxy"},
                 "prompts_config": {
                     "prompts_to_use": ["tutor", "tester", "inventer", "experimenter"]
                 },
+                "ui_config": {"max_workers": 4},
             }
 
         self.prompts_config = self.cfg["prompts_config"]
+        self.ui_config = self.cfg.get("ui_config", {})
 
-        self.llm_chain = CreateLLMChain(self.cfg)
+        self._llm_chain = None
+        self._llm_chain_lock = threading.Lock()
+        self.executor = get_executor(self.ui_config.get("max_workers", 4))
+        self.prefetcher = Prefetcher(
+            max_workers=self.ui_config.get("prefetch_concurrency", 2)
+        )
+        self._pending_lock = threading.Lock()
+        self.stats = get_recorder(self.ui_config.get("stats_history", 1000))
         self.tabs = None
+        self.ui = None
+        # Widgets of the most recent cells; older ones are closed
+        self._history = collections.deque()
+
+    @property
+    def llm_chain(self):
+        """The CreateLLMChain object, created (and its model loaded) on first use."""
+        with self._llm_chain_lock:
+            if self._llm_chain is None:
+                from .chains import CreateLLMChain
+
+                self._llm_chain = CreateLLMChain(self.cfg)
+        return self._llm_chain
+
+    def prewarm(self):
+        """Opens the proxy connection ahead of the first request, if enabled.
+
+        Returns
+        -------
+        None
+        """
+        model_config = self.cfg["model_config"]
+        if self.cfg["chain_config"]["chain_type"] == "proxy" and model_config.get(
+            "prewarm", False
+        ):
+            from .transport import get_transport
+
+            get_transport(model_config).prewarm(model_config["proxy_url"])
+
+    def close(self):
+        """Releases the model, so that it can be freed once no chain uses it.
+
+        Returns
+        -------
+        None
+        """
+        with self._llm_chain_lock:
+            if self._llm_chain is not None:
+                self._llm_chain.close()
+                self._llm_chain = None
 
     def _read_prompt_dir(self):
         """Reads prompt files from the dirname + '/prompts/' directory.
 
+        Prompt files are parsed once per process by the prompt registry and only
+        re-parsed when they change.
+
         Returns
         -------
         prompt_types : dict
             A dictionary mapping prompt types to their corresponding YAML contents.
         """
-        dirname = pathlib.Path(__file__).parent.resolve()
-        prompt_files = list(pathlib.Path(str(dirname) + "/prompts/").glob("*.yaml"))
-        prompt_types = {}
-        for f in self.prompts_config["prompts_to_use"]:
-            for prompt_file in prompt_files:
-                if f == prompt_file.name.split(".")[0]:
-                    prompt_types[f] = yaml.load(
-                        open(prompt_file), Loader=yaml.SafeLoader
-                    )
-        return prompt_types
+        return get_registry().get_many(self.prompts_config["prompts_to_use"])
 
     def _create_ui_elements(self):
         """Creates UI elements like buttons, prompt types, texts, and options."""
+        from .widgets import button_widget, loading_widget, thumbs
+
         # Buttons and prompt types
         self.execute_button = button_widget()
         self.loading = loading_widget()
-        self.prompt_types = self._read_prompt_dir()
+        with span("prompt_load"):
+            self.prompt_types = self._read_prompt_dir()
         self.prompt_names = {
             item: key for item, key in enumerate(self.prompt_types.keys())
         }
 
-        # Create different text and options field for each prompt
+        # Text and options fields are created when their tab is first shown
         self.texts, self.options = {}, {}
-        for key, values in self.prompt_types.items():
-            self.texts[key] = text_widget()
-            self.options[key] = option_widget(values)
 
         # Thumbs up and down
         self.thumbs_up = thumbs("\U0001F44D")
         self.thumbs_down = thumbs("\U0001F44E")
 
-    def _arrange_ui_elements(self, prompt_type):
+    def _arrange_ui_elements(self, prompt_type, ui=None):
         """Arranges UI elements based on the selected prompt type.
 
         Parameters
         ----------
         prompt_type : str
             The selected prompt type.
+        ui : dict, optional
+            The widgets of the cell, by default the most recent cell.
 
         Returns
         -------
         vbox : object
             A VBox container holding the arranged UI elements.
         """
+        import ipywidgets as widgets
+
+        from .widgets import option_widget, text_widget
+
+        ui = ui or self.ui
+        if prompt_type not in ui["options"]:
+            ui["texts"][prompt_type] = text_widget()
+            ui["options"][prompt_type] = option_widget(ui["prompt_types"][prompt_type])
+
         # Arrange options and buttons
         if self.cfg["feedback"]:
             elements = [
-                self.options[prompt_type],
-                self.execute_button,
-                self.thumbs_up,
-                self.thumbs_down,
+                ui["options"][prompt_type],
+                ui["execute_button"],
+                ui["thumbs_up"],
+                ui["thumbs_down"],
             ]
 
         else:
-            elements = [self.options[prompt_type], self.execute_button, self.loading]
+            elements = [
+                ui["options"][prompt_type],
+                ui["execute_button"],
+                ui["loading"],
+            ]
         hbox = widgets.HBox(elements)
-        vbox = widgets.VBox([hbox, self.texts[prompt_type]])
+        vbox = widgets.VBox([hbox, ui["texts"][prompt_type]])
         return vbox
 
+    def _show_tab(self, change, ui):
+        """Builds the contents of a tab the first time it is selected.
+
+        Parameters
+        ----------
+        change : dict
+            The traitlets change of the tab container's selected index.
+        ui : dict
+            The widgets of the cell the tab belongs to.
+        """
+        index = change["new"]
+        if index is None:
+            return
+        prompt_type = ui["prompt_names"][index]
+        if prompt_type in ui["options"]:
+            return
+
+        children = list(ui["tabs"].children)
+        placeholder = children[index]
+        children[index] = self._arrange_ui_elements(prompt_type, ui)
+        ui["tabs"].children = children
+        placeholder.close()
+
+    def _remember(self, ui):
+        """Adds a cell's widgets to the history, closing those of older cells.
+
+        Parameters
+        ----------
+        ui : dict
+            The widgets of the new cell.
+        """
+        from .widgets import close_widgets
+
+        self._history.append(ui)
+        while len(self._history) > self.ui_config.get("history", 20):
+            old = self._history.popleft()
+            close_widgets(
+                old["accordion"],
+                old["execute_button"],
+                old["loading"],
+                old["thumbs_up"],
+                old["thumbs_down"],
+            )
+
     def _cache(self, input_string, prompt):
         chain = self.llm_chain.create_chain(
             self.cfg["model_config"], prompt_template=prompt
@@ -138,7 +250,7 @@ class Chatify(Magics):
         output = self.llm_chain.execute(chain, input_string)
         return output
 
-    def gpt(self, inputs, prompt):
+    def gpt(self, inputs, prompt, on_update=None):
         """Queries the GPT model and returns the output in markdown format.
 
         Parameters
@@ -147,38 +259,192 @@ class Chatify(Magics):
             The input dictionary containing line and cell values.
         prompt : str
             The prompt for querying the GPT model.
+        on_update : callable, optional
+            Called with the partial output rendered as HTML while the response
+            is streamed in.
 
         Returns
         -------
         output : str
             The GPT model output in markdown format.
         """
-        # TODO: Should we create the chain every time? Only prompt is changing not the model
-        chain = self.llm_chain.create_chain(
-            self.cfg["model_config"], prompt_template=prompt
-        )
-        output = self.llm_chain.execute(chain, inputs["cell"])
+        with self.stats.request(
+            prompt_id=prompt.get("prompt_id"), streaming=on_update is not None
+        ):
+            # Chains are memoized by CreateLLMChain; only the prompt changes
+            with span("chain"):
+                chain = self.llm_chain.create_chain(
+                    self.cfg["model_config"], prompt_template=prompt
+                )
+            if on_update is not None:
+
+                def render_partial(partial):
+                    with span("render"):
+                        partial_html = get_html(partial, cache=False)
+                    on_update(partial_html)
+
+                output = self.llm_chain.execute(
+                    chain, inputs["cell"], on_update=render_partial
+                )
+            else:
+                output = self.llm_chain.execute(chain, inputs["cell"])
+
+            with span("render"):
+                return get_html(output)
+
+    def _collect_ui(self):
+        """Collects the widgets and inputs of the current %%explain cell.
 
-        return get_html(output)
+        Returns
+        -------
+        ui : dict
+            The widgets, prompts and cell inputs a request needs.
+        """
+        return {
+            "tabs": self.tabs,
+            "accordion": None,
+            "texts": self.texts,
+            "options": self.options,
+            "execute_button": self.execute_button,
+            "loading": self.loading,
+            "thumbs_up": self.thumbs_up,
+            "thumbs_down": self.thumbs_down,
+            "prompt_types": self.prompt_types,
+            "prompt_names": self.prompt_names,
+            "cell_inputs": self.cell_inputs,
+            "pending": 0,
+        }
+
+    def _set_pending(self, ui, change):
+        """Updates the number of requests in flight and the loading spinner.
 
-    def update_values(self, *args, **kwargs):
-        """Updates the values of UI elements based on the selected options.
+        Parameters
+        ----------
+        ui : dict
+            The widgets of the cell the request belongs to.
+        change : int
+            Change in the number of requests in flight.
+        """
+        with self._pending_lock:
+            ui["pending"] += change
+            ui["loading"].width = 30 if ui["pending"] > 0 else 0
+
+    def _show_response(self, future, text, ui):
+        """Displays the result of a finished request.
+
+        Parameters
+        ----------
+        future : concurrent.futures.Future
+            The finished request.
+        text : widgets.HTMLMath
+            The widget the response is displayed in.
+        ui : dict
+            The widgets of the cell the request belongs to.
+        """
+        try:
+            text.value = future.result()
+            self.response = text.value
+        except Exception as e:
+            text.value = (
+                "<p>Chatify could not generate a response: "
+                f"{html.escape(str(e))}</p>"
+            )
+        finally:
+            self._set_pending(ui, -1)
+
+    def update_values(self, *args, ui=None, **kwargs):
+        """Sends a request for the selected options to the background workers.
 
         Parameters
         ----------
         *args
             Variable-length argument list.
+        ui : dict, optional
+            The widgets of the cell that submitted the request, by default the
+            most recent cell.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The pending request; its result is the response HTML.
         """
-        self.loading.width = 30
-        index = self.tabs.selected_index
-        selected_prompt = self.prompt_names[index]
+        ui = ui or self.ui
+        index = ui["tabs"].selected_index
+        selected_prompt = ui["prompt_names"][index]
+        option = ui["options"][selected_prompt].value
         # Get the prompt
-        self.prompt = self.prompt_types[selected_prompt][
-            self.options[selected_prompt].value
-        ]
-        self.texts[selected_prompt].value = self.gpt(self.cell_inputs, self.prompt)
-        self.response = self.texts[selected_prompt].value
-        self.loading.width = 0
+        self.prompt = ui["prompt_types"][selected_prompt][option]
+
+        text = ui["texts"][selected_prompt]
+
+        def show_partial(value):
+            text.value = value
+
+        self._set_pending(ui, 1)
+        # Use the prefetched response if there is one, even if still in flight
+        future = self.prefetcher.get(
+            (selected_prompt, option, ui["cell_inputs"]["cell"])
+        )
+        if future is None:
+            future = self.executor.submit(
+                self.gpt, ui["cell_inputs"], self.prompt, on_update=show_partial
+            )
+        future.add_done_callback(
+            functools.partial(self._show_response, text=text, ui=ui)
+        )
+        return future
+
+    def prefetch(self, ui=None):
+        """Requests the most popular options of every prompt type in the background.
+
+        The first ``ui_config.prefetch_options`` options of each prompt type are
+        requested, first options first, with at most
+        ``ui_config.prefetch_concurrency`` requests in flight.
+
+        Parameters
+        ----------
+        ui : dict, optional
+            The widgets of the cell to prefetch for, by default the most recent
+            cell.
+
+        Returns
+        -------
+        futures : list
+            The scheduled prefetches.
+        """
+        ui = ui or self.ui
+        n_options = self.ui_config.get("prefetch_options", 1)
+        futures = []
+        for rank in range(n_options):
+            for prompt_type, options in ui["prompt_types"].items():
+                if rank >= len(options):
+                    continue
+                option = list(options)[rank]
+                key = (prompt_type, option, ui["cell_inputs"]["cell"])
+                futures.append(
+                    self.prefetcher.submit(
+                        key, self.gpt, ui["cell_inputs"], options[option]
+                    )
+                )
+        return futures
+
+    def cancel_prefetch(self, keep=None):
+        """Cancels prefetches that have not started yet.
+
+        Prefetches a submitted request is waiting for are never cancelled.
+
+        Parameters
+        ----------
+        keep : callable, optional
+            Called with each ``(prompt_type, option, cell)`` key; prefetches for
+            which it returns True are kept.
+
+        Returns
+        -------
+        cancelled : int
+            Number of cancelled prefetches.
+        """
+        return self.prefetcher.cancel(keep)
 
     def record(self, *args):
         try:
@@ -208,31 +474,92 @@ class Chatify(Magics):
         cell : str
             The input cell contents.
         """
+        import ipywidgets as widgets
+
+        with self.stats.request(kind="explain"):
+            self._explain(line, cell, widgets)
+
+    def _explain(self, line, cell, widgets):
+        """Builds and displays the chat UI of a cell; see :meth:`explain`."""
+        # Start loading the model while the UI is being built
+        if self._llm_chain is None:
+            self.executor.submit(lambda: self.llm_chain)
+
         # Store the inputs for processing
         self.cell_inputs = {"line": line, "cell": cell}
         self._create_ui_elements()
-
-        # Create tab container
-        components = []
-        for index in self.prompt_types:
-            components.append(self._arrange_ui_elements(index))
+        self.ui = self._collect_ui()
+
+        # Create tab container; only the first tab is built up front
+        components = [
+            self._arrange_ui_elements(prompt_type, self.ui)
+            if index == 0
+            else widgets.VBox()
+            for index, prompt_type in enumerate(self.prompt_types)
+        ]
         self.tabs = widgets.Tab(children=components)
+        self.ui["tabs"] = self.tabs
+        self.tabs.observe(
+            functools.partial(self._show_tab, ui=self.ui), names="selected_index"
+        )
 
         # Name the tabs components
         for i, prompt_type in enumerate(self.prompt_types.keys()):
             self.tabs.set_title(i, "Robo-" + prompt_type.lower())
-            self.texts[prompt_type].value = ""
 
         # Create a tab group
         accordion = widgets.Accordion(children=[self.tabs])
         accordion.set_title(0, "🤖💬")
         accordion.layout.collapsed = False
+        self.ui["accordion"] = accordion
 
         display(accordion)
+        self._remember(self.ui)
+
+        # Button click; requests run in the background so the kernel stays free
+        self.execute_button.on_click(functools.partial(self.update_values, ui=self.ui))
 
-        # Button click
-        self.execute_button.on_click(self.update_values)
+        # Prefetches for earlier cells are no longer needed
+        if self.ui_config.get("prefetch", False):
+            self.cancel_prefetch(keep=lambda key: key[2] == cell)
+            self.prefetch(self.ui)
 
         # Thumbs up and down
         self.thumbs_down.on_click(self.record)
         self.thumbs_up.on_click(self.record)
+
+    @line_magic
+    @magic_arguments()
+    @argument(
+        "--format",
+        choices=["table", "jsonl", "prometheus"],
+        default="table",
+        help="Output format, by default a table of percentiles per stage.",
+    )
+    @argument("--export", metavar="PATH", help="Write jsonl or prometheus to a file.")
+    @argument("--reset", action="store_true", help="Discard the recorded requests.")
+    def chatify_stats(self, line):
+        """Shows how long the stages of recent requests took.
+
+        Reports p50/p95/p99 of the prompt load, chain creation, cache lookup,
+        network/model, decode and render time of the last
+        ``ui_config.stats_history`` requests.
+
+        Parameters
+        ----------
+        line : str
+            The command line arguments.
+        """
+        args = parse_argstring(self.chatify_stats, line)
+        if args.reset:
+            self.stats.clear()
+            print("Chatify stats cleared.")
+        elif args.export:
+            format = "prometheus" if args.format == "prometheus" else "jsonl"
+            print(f"Wrote {self.stats.export(args.export, format)}")
+        elif args.format == "jsonl":
+            print(self.stats.to_jsonl(), end="")
+        elif args.format == "prometheus":
+            print(self.stats.to_prometheus(), end="")
+        else:
+            print(self.stats.format_summary())
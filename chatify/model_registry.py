@@ -0,0 +1,262 @@
+"""Process-wide registry of loaded models.
+
+Loading a model can take minutes and gigabytes of RAM, so every chain in the
+process that asks for the same ``model_config`` shares one model. Models are
+reference counted: :meth:`ModelRegistry.release` marks a model as unused, and
+:meth:`ModelRegistry.evict` frees unused models. Backends that must not
+generate from several threads at once are wrapped in a lock.
+"""
+
+import functools
+import gc
+import inspect
+import threading
+from typing import Any, List, Mapping, Optional
+
+from .utils import fingerprint
+
+# model_config keys that only tune the connection to the proxy, not the model
+_CLIENT_KEYS = frozenset(
+    {
+        "prewarm",
+        "pool_size",
+        "connect_timeout",
+        "read_timeout",
+        "compress_min_bytes",
+        "deadline",
+        "max_retries",
+        "retry_backoff",
+        "retry_backoff_max",
+        "hedge_percentile",
+        "hedge_min_samples",
+    }
+)
+
+# Backends that are not safe to call from several threads at once
+_THREAD_UNSAFE = frozenset({"llama_model", "huggingface_model"})
+
+
+def model_key(model_config):
+    """Returns the registry key of a model configuration.
+
+    Keys that do not affect the loaded model, and keys set to None, are
+    ignored, so e.g. changing a proxy timeout does not load a new model.
+
+    Parameters
+    ----------
+    model_config : dict
+        Configuration of the model.
+
+    Returns
+    -------
+    key : str
+        Fingerprint of the normalized configuration.
+    """
+    return fingerprint(
+        {
+            key: value
+            for key, value in model_config.items()
+            if key not in _CLIENT_KEYS and value is not None
+        }
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _make_locked_llm():
+    # Defined lazily so that importing this module does not import langchain
+    from langchain.llms.base import LLM
+
+    class LockedLLM(LLM):
+        """Serializes the calls to an LLM that is not thread-safe."""
+
+        llm: Any
+        lock: Any
+
+        @property
+        def _llm_type(self) -> str:
+            return self.llm._llm_type
+
+        def _call(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Any = None,
+            **kwargs: Any,
+        ) -> str:
+            # Older LLMs do not take a run manager (used for streaming tokens)
+            if "run_manager" in inspect.signature(self.llm._call).parameters:
+                kwargs["run_manager"] = run_manager
+            with self.lock:
+                return self.llm._call(prompt, stop=stop, **kwargs)
+
+        @property
+        def _identifying_params(self) -> Mapping[str, Any]:
+            return self.llm._identifying_params
+
+        def close(self):
+            close = getattr(self.llm, "close", None)
+            if callable(close):
+                close()
+
+    return LockedLLM
+
+
+class _Entry:
+    def __init__(self, key, model_config):
+        self.key = key
+        self.model_config = model_config
+        self.model = None
+        self.loaded = False
+        self.refs = 0
+        # Held while loading, so that a model is loaded once
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Loads every model configuration once and shares the loaded model."""
+
+    def __init__(self):
+        """Initializes the ModelRegistry instance."""
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, model_config):
+        from .llm_models import ModelsFactory
+
+        model = ModelsFactory().get_model(model_config)
+        name = model_config["model"]
+        batched = name == "huggingface_model" and model_config.get("batch_size", 1) > 1
+        # Batched models already generate from a single worker thread
+        if model is not None and name in _THREAD_UNSAFE and not batched:
+            model = _make_locked_llm()(llm=model, lock=threading.Lock())
+        return model
+
+    def acquire(self, model_config):
+        """Returns the shared model for a configuration, loading it if needed.
+
+        Every call must be matched by a call to :meth:`release`.
+
+        Parameters
+        ----------
+        model_config : dict
+            Configuration of the model.
+
+        Returns
+        -------
+        model : object
+            The loaded model (None for the proxy).
+        """
+        key = model_key(model_config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(key, dict(model_config))
+            entry.refs += 1
+
+        try:
+            with entry.load_lock:
+                if not entry.loaded:
+                    entry.model = self._load(model_config)
+                    entry.loaded = True
+        except BaseException:
+            with self._lock:
+                entry.refs -= 1
+                if entry.refs == 0 and not entry.loaded:
+                    self._entries.pop(key, None)
+            raise
+        return entry.model
+
+    def release(self, model_config):
+        """Marks one use of a model as finished.
+
+        Unused models stay loaded until they are evicted.
+
+        Parameters
+        ----------
+        model_config : dict
+            Configuration the model was acquired with.
+        """
+        with self._lock:
+            entry = self._entries.get(model_key(model_config))
+            if entry is not None and entry.refs > 0:
+                entry.refs -= 1
+
+    def evict(self, model_config=None, force=False):
+        """Unloads models to free memory.
+
+        Parameters
+        ----------
+        model_config : dict, optional
+            Configuration of the model to unload, by default every model.
+        force : bool, optional
+            Whether to unload models that are still in use, by default False.
+            Chains holding such a model keep working, but the next chain that
+            asks for it loads it again.
+
+        Models with a ``close`` method (e.g. a ``BatchingLLM``, whose worker
+        thread references the model) are closed, so that they can be freed.
+
+        Returns
+        -------
+        evicted : int
+            Number of unloaded models.
+        """
+        with self._lock:
+            if model_config is None:
+                keys = list(self._entries)
+            else:
+                keys = [model_key(model_config)]
+            evicted = []
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry.loaded and (force or entry.refs == 0):
+                    evicted.append(self._entries.pop(key))
+
+        for entry in evicted:
+            # Worker threads of e.g. a BatchingLLM would keep the model alive
+            close = getattr(entry.model, "close", None)
+            if callable(close):
+                close()
+            entry.model = None
+        if evicted:
+            # Model weights are often part of reference cycles
+            gc.collect()
+        return len(evicted)
+
+    def stats(self):
+        """Returns the loaded models and their reference counts.
+
+        Returns
+        -------
+        stats : list of dict
+            The 'model' name, 'key' and number of 'refs' of every loaded model.
+        """
+        with self._lock:
+            return [
+                {
+                    "model": entry.model_config.get("model"),
+                    "key": entry.key,
+                    "refs": entry.refs,
+                }
+                for entry in self._entries.values()
+                if entry.loaded
+            ]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry():
+    """Returns the process-wide model registry.
+
+    Returns
+    -------
+    registry : ModelRegistry
+        Shared registry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
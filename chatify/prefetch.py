@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+
+from .workers import get_executor
+
+
+class Prefetcher:
+    """Sends requests speculatively and keeps their results until needed.
+
+    Prefetches run on their own bounded thread pool, so they never hold up the
+    requests a user actually submits. Results are kept in a bounded in-memory
+    store keyed by the caller. Prefetches handed out by :meth:`get` are claimed:
+    they are never cancelled, since the caller is waiting for them.
+    """
+
+    def __init__(self, max_workers=2, max_results=64):
+        """Initializes the Prefetcher instance.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            Maximum number of prefetches in flight at the same time, by default 2.
+        max_results : int, optional
+            Maximum number of results kept in the store, by default 64.
+        """
+        self.executor = get_executor(max_workers, name="chatify-prefetch")
+        self.max_results = max_results
+        self._results = OrderedDict()
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedules a prefetch unless one with the same key already exists.
+
+        Parameters
+        ----------
+        key : hashable
+            Key the result is stored under.
+        fn : callable
+            Function computing the result.
+        *args
+            Positional arguments for ``fn``.
+        **kwargs
+            Keyword arguments for ``fn``.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The (possibly already existing) prefetch.
+        """
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None and not future.cancelled():
+                return future
+
+            future = self.executor.submit(fn, *args, **kwargs)
+            self._results[key] = future
+            self._claimed.discard(key)
+            while len(self._results) > self.max_results:
+                oldest_key, oldest = self._results.popitem(last=False)
+                if oldest_key in self._claimed:
+                    self._claimed.discard(oldest_key)
+                else:
+                    oldest.cancel()
+            return future
+
+    def get(self, key):
+        """Claims the prefetch stored under the key, if it can still be used.
+
+        Cancelled and failed prefetches are discarded, so the caller can send a
+        regular request instead. A claimed prefetch is no longer cancelled by
+        :meth:`cancel`.
+
+        Parameters
+        ----------
+        key : hashable
+            Key the result is stored under.
+
+        Returns
+        -------
+        future : concurrent.futures.Future or None
+            The prefetch, or None if there is no usable one.
+        """
+        with self._lock:
+            future = self._results.get(key)
+            if future is None:
+                return None
+            if future.cancelled() or (future.done() and future.exception()):
+                del self._results[key]
+                self._claimed.discard(key)
+                return None
+            self._claimed.add(key)
+            return future
+
+    def cancel(self, keep=None):
+        """Cancels prefetches that have not started yet and were not claimed.
+
+        Parameters
+        ----------
+        keep : callable, optional
+            Called with each key; prefetches for which it returns True are
+            kept. By default every pending, unclaimed prefetch is cancelled.
+
+        Returns
+        -------
+        cancelled : int
+            Number of cancelled prefetches.
+        """
+        cancelled = 0
+        with self._lock:
+            for key, future in list(self._results.items()):
+                if key in self._claimed or (keep is not None and keep(key)):
+                    continue
+                if future.cancel():
+                    del self._results[key]
+                    cancelled += 1
+        return cancelled
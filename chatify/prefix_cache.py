@@ -0,0 +1,308 @@
+"""Reuse of llama.cpp model state for the fixed prefixes of the prompts.
+
+Every prompt starts with a long ``SYSTEM:`` preamble that only differs from
+request to request after the user's code. :class:`PrefixStateCache` keeps the
+llama.cpp state (the KV cache) after evaluating each prompt's fixed prefix, and
+llama.cpp restores it before evaluating the rest of a prompt that starts with
+it, so the preamble is evaluated once instead of on every request.
+
+States can be persisted to disk, where they are memory-mapped when restored, so
+that a restarted kernel does not evaluate the prefixes again.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def template_prefix(prompt):
+    """Returns the fixed text at the start of a prompt template.
+
+    Parameters
+    ----------
+    prompt : dict
+        Prompt with 'content' and 'input_variables'.
+
+    Returns
+    -------
+    prefix : str
+        The rendered template up to its first input variable.
+    """
+    content = prompt["content"]
+    end = min(
+        (
+            content.find("{" + name + "}")
+            for name in prompt["input_variables"]
+            if "{" + name + "}" in content
+        ),
+        default=len(content),
+    )
+    return content[:end].replace("{{", "{").replace("}}", "}")
+
+
+def _longest_prefix(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class _DiskState:
+    """A llama.cpp state stored on disk and memory-mapped when it is restored.
+
+    Provides the attributes of ``llama_cpp.LlamaState`` that ``Llama.load_state``
+    reads.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.n_tokens = meta["n_tokens"]
+        self.llama_state_size = meta["llama_state_size"]
+        self.seed = meta["seed"]
+        self.size = meta["bytes"]
+
+    @property
+    def input_ids(self):
+        return np.load(self.path + ".input_ids.npy", mmap_mode="r")
+
+    @property
+    def scores(self):
+        return np.load(self.path + ".scores.npy", mmap_mode="r")
+
+    @property
+    def llama_state(self):
+        with open(self.path + ".state", "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PrefixStateCache:
+    """A llama.cpp state cache that only keeps the states of prompt prefixes.
+
+    Install it with ``Llama.set_cache``. Unlike llama-cpp-python's own caches,
+    which store the state after every completion and so evict the prefixes,
+    this cache only stores the states of prefixes registered with
+    :meth:`register`, and looking a state up does not remove it.
+    """
+
+    def __init__(self, cache_dir=None, capacity_bytes=2 << 30):
+        """Initializes the PrefixStateCache instance.
+
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory to persist the states in. States are only kept in memory
+            when None (the default).
+        capacity_bytes : int, optional
+            Maximum size of the states kept in memory, by default 2 GiB; the
+            least recently used states are dropped first. Persisted states are
+            not limited.
+        """
+        self.cache_dir = cache_dir
+        self.capacity_bytes = capacity_bytes
+        # token tuple -> LlamaState (in memory) or _DiskState
+        self._states = OrderedDict()
+        self._prefixes = set()
+        self._lock = threading.Lock()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in sorted(os.listdir(cache_dir)):
+                if name.endswith(".json"):
+                    path = os.path.join(cache_dir, name[: -len(".json")])
+                    with open(path + ".json") as f:
+                        meta = json.load(f)
+                    self._states[tuple(meta["tokens"])] = _DiskState(path, meta)
+
+    @property
+    def cache_size(self):
+        return sum(_state_size(state) for state in self._states.values())
+
+    @property
+    def wants_states(self):
+        """Whether a registered prefix has no stored state yet."""
+        with self._lock:
+            return any(
+                not any(stored[: len(prefix)] == prefix for stored in self._states)
+                for prefix in self._prefixes
+            )
+
+    def register(self, tokens):
+        """Marks a token sequence as a prefix whose state should be stored.
+
+        Parameters
+        ----------
+        tokens : list of int
+            Tokens of the prefix.
+
+        Returns
+        -------
+        missing : bool
+            Whether the prefix still has to be evaluated, i.e. no stored state
+            starts with it.
+        """
+        tokens = tuple(tokens)
+        with self._lock:
+            self._prefixes.add(tokens)
+            return not any(key[: len(tokens)] == tokens for key in self._states)
+
+    def _find(self, key):
+        best, best_len = None, 0
+        for stored in self._states:
+            n = _longest_prefix(stored, key)
+            if n > best_len:
+                best, best_len = stored, n
+        return best
+
+    def __getitem__(self, key):
+        with self._lock:
+            stored = self._find(tuple(key))
+            if stored is None:
+                raise KeyError("No prefix state matches the prompt")
+            self._states.move_to_end(stored)
+            return self._states[stored]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._find(tuple(key)) is not None
+
+    def __setitem__(self, key, state):
+        # llama.cpp offers the state after every completion; only the
+        # completions of registered prefixes are kept. The state is None when
+        # saving it was skipped (see attach_prefix_cache)
+        if state is None:
+            return
+        key = tuple(key)
+        with self._lock:
+            prefix = max(
+                (p for p in self._prefixes if p and key[: len(p)] == p),
+                key=len,
+                default=None,
+            )
+            if prefix is None or any(
+                stored[: len(prefix)] == prefix for stored in self._states
+            ):
+                return
+            if self.cache_dir is not None:
+                state = self._persist(key, state)
+            self._states[key] = state
+            self._evict()
+
+    def _persist(self, key, state):
+        name = hashlib.sha1(np.asarray(key, dtype=np.int64).tobytes()).hexdigest()
+        path = os.path.join(self.cache_dir, name)
+        np.save(path + ".input_ids.npy", state.input_ids)
+        np.save(path + ".scores.npy", state.scores)
+        with open(path + ".state", "wb") as f:
+            f.write(state.llama_state)
+        meta = {
+            "tokens": list(key),
+            "n_tokens": int(state.n_tokens),
+            "llama_state_size": int(state.llama_state_size),
+            # Only the states of newer llama-cpp-python versions have a seed
+            "seed": getattr(state, "seed", None),
+            "bytes": len(state.llama_state) + state.scores.nbytes,
+        }
+        # The index file is written last, so a crash never leaves half a state
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        return _DiskState(path, meta)
+
+    def _evict(self):
+        in_memory = [
+            key
+            for key, state in self._states.items()
+            if not isinstance(state, _DiskState)
+        ]
+        size = sum(_state_size(self._states[key]) for key in in_memory)
+        for key in in_memory:
+            if size <= self.capacity_bytes:
+                break
+            size -= _state_size(self._states.pop(key))
+
+
+def _state_size(state):
+    if isinstance(state, _DiskState):
+        return state.size
+    return len(state.llama_state) + state.scores.nbytes
+
+
+def attach_prefix_cache(client, model_config):
+    """Installs a :class:`PrefixStateCache` on a llama.cpp model.
+
+    llama.cpp copies its whole state (the KV cache) with ``save_state`` after
+    every completion to offer it to the cache, which only keeps the states of
+    the registered prefixes. The client's ``save_state`` is therefore replaced
+    by one that returns None, without copying anything, once every registered
+    prefix has a state.
+
+    Parameters
+    ----------
+    client : llama_cpp.Llama
+        The model.
+    model_config : dict
+        Model configuration; ``prefix_cache_dir`` and ``prefix_cache_bytes``
+        configure the cache.
+
+    Returns
+    -------
+    cache : PrefixStateCache
+        The installed cache.
+    """
+    cache_dir = model_config.get("prefix_cache_dir")
+    if cache_dir is not None:
+        cache_dir = os.path.expanduser(cache_dir)
+        # States are only valid for the model and context size they came from
+        model = f"{client.model_path}:{client.n_ctx()}"
+        cache_dir = os.path.join(cache_dir, hashlib.sha1(model.encode()).hexdigest())
+    cache = PrefixStateCache(
+        cache_dir, capacity_bytes=model_config.get("prefix_cache_bytes", 2 << 30)
+    )
+    client.set_cache(cache)
+
+    save_state = client.save_state
+
+    def save_state_if_wanted():
+        return save_state() if cache.wants_states else None
+
+    client.save_state = save_state_if_wanted
+    return cache
+
+
+def warm_prefixes(llm, prompts):
+    """Evaluates the fixed prefix of every prompt once, storing its state.
+
+    Prefixes whose state is already cached (e.g. on disk) are skipped.
+
+    Parameters
+    ----------
+    llm : LLM
+        The langchain LlamaCpp model, possibly wrapped in a lock by the model
+        registry.
+    prompts : iterable of dict
+        The prompts.
+
+    Returns
+    -------
+    warmed : int
+        Number of prefixes evaluated.
+    """
+    lock = getattr(llm, "lock", None) or threading.Lock()
+    client = getattr(llm, "llm", llm).client
+    if not isinstance(client.cache, PrefixStateCache):
+        return 0
+
+    warmed = 0
+    for prefix in sorted({template_prefix(prompt) for prompt in prompts}):
+        tokens = client.tokenize(prefix.encode("utf-8"))
+        if client.cache.register(tokens):
+            with lock:
+                client.create_completion(prefix, max_tokens=1)
+            warmed += 1
+    return warmed
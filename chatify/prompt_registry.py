@@ -0,0 +1,221 @@
+"""Process-wide registry of the prompts in ``chatify/prompts/*.yaml``.
+
+Prompt files are parsed once per process and re-parsed only when their
+modification time changes. A precompiled bundle (``prompts/bundle.json``,
+written by ``python -m chatify.prompt_registry`` when the package is built)
+lets a fresh process skip YAML parsing entirely for unchanged files.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+import yaml
+
+from .utils import fingerprint
+
+PROMPT_DIR = pathlib.Path(__file__).parent.resolve() / "prompts"
+BUNDLE_FILE = PROMPT_DIR / "bundle.json"
+
+# The C loader is much faster than the pure-Python one, when libyaml is present
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def compile_prompts(prompts):
+    """Validates the prompts of one prompt file and fills in their prompt ids.
+
+    Parameters
+    ----------
+    prompts : dict
+        Mapping of option names to prompts, as read from a prompt file.
+
+    Returns
+    -------
+    prompts : dict
+        The same mapping; prompts without a ``prompt_id`` get one derived from
+        their content.
+
+    Raises
+    ------
+    KeyError
+        If a prompt has no 'content' or 'input_variables'.
+    """
+    for option, prompt in prompts.items():
+        for key in ("content", "input_variables"):
+            if key not in prompt:
+                raise KeyError(f"Prompt {option!r} has no {key!r}")
+        prompt.setdefault("prompt_id", fingerprint(prompt["content"]))
+    return prompts
+
+
+class PromptRegistry:
+    """Loads prompt files once and indexes them by name and prompt id."""
+
+    def __init__(self, prompt_dir=PROMPT_DIR, bundle_file=BUNDLE_FILE):
+        """Initializes the PromptRegistry instance.
+
+        Parameters
+        ----------
+        prompt_dir : str or pathlib.Path, optional
+            Directory holding the ``*.yaml`` prompt files, by default the
+            package's prompt directory.
+        bundle_file : str or pathlib.Path, optional
+            Precompiled bundle to load unchanged prompt files from, if it exists.
+        """
+        self.prompt_dir = pathlib.Path(prompt_dir)
+        self._bundle = {}
+        if bundle_file is not None and os.path.exists(bundle_file):
+            with open(bundle_file, encoding="utf-8") as f:
+                self._bundle = json.load(f)
+
+        # name -> (mtime_ns, prompts)
+        self._files = {}
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def _load(self, name, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        bundled = self._bundle.get(name)
+        if bundled is not None and bundled["sha1"] == hashlib.sha1(data).hexdigest():
+            return bundled["prompts"]
+        return compile_prompts(yaml.load(data, Loader=_Loader))
+
+    def get(self, name):
+        """Returns the prompts of a prompt file, re-reading it only if it changed.
+
+        The returned dictionary is shared and must not be modified.
+
+        Parameters
+        ----------
+        name : str
+            Name of the prompt file without extension, e.g. 'tutor'.
+
+        Returns
+        -------
+        prompts : dict
+            Mapping of option names to prompts.
+
+        Raises
+        ------
+        FileNotFoundError
+            If there is no prompt file with that name.
+        """
+        path = self.prompt_dir / f"{name}.yaml"
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._files.get(name)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+
+            prompts = self._load(name, path)
+            self._files[name] = (mtime, prompts)
+            for prompt in prompts.values():
+                self._by_id[prompt["prompt_id"]] = prompt
+            return prompts
+
+    def get_many(self, names):
+        """Returns the prompts of several prompt files, skipping missing ones.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the prompt files.
+
+        Returns
+        -------
+        prompt_types : dict
+            Mapping of prompt file names to their prompts.
+        """
+        prompt_types = {}
+        for name in names:
+            try:
+                prompt_types[name] = self.get(name)
+            except FileNotFoundError:
+                continue
+        return prompt_types
+
+    def names(self):
+        """Returns the names of all available prompt files.
+
+        Returns
+        -------
+        names : list of str
+            Sorted prompt file names.
+        """
+        return sorted(path.stem for path in self.prompt_dir.glob("*.yaml"))
+
+    def by_id(self, prompt_id):
+        """Returns the prompt with the given prompt id.
+
+        Parameters
+        ----------
+        prompt_id : str
+            Identifier of the prompt.
+
+        Returns
+        -------
+        prompt : dict or None
+            The prompt, or None if no prompt file defines it.
+        """
+        with self._lock:
+            prompt = self._by_id.get(prompt_id)
+        if prompt is None:
+            # Load every prompt file once before giving up
+            self.get_many(self.names())
+            with self._lock:
+                prompt = self._by_id.get(prompt_id)
+        return prompt
+
+
+def build_bundle(prompt_dir=PROMPT_DIR, bundle_file=BUNDLE_FILE):
+    """Writes a precompiled bundle of all prompt files.
+
+    Parameters
+    ----------
+    prompt_dir : str or pathlib.Path, optional
+        Directory holding the ``*.yaml`` prompt files.
+    bundle_file : str or pathlib.Path, optional
+        Path of the bundle to write.
+
+    Returns
+    -------
+    bundle_file : str or pathlib.Path
+        Path of the written bundle.
+    """
+    bundle = {}
+    for path in sorted(pathlib.Path(prompt_dir).glob("*.yaml")):
+        data = path.read_bytes()
+        bundle[path.stem] = {
+            "sha1": hashlib.sha1(data).hexdigest(),
+            "prompts": compile_prompts(yaml.load(data, Loader=_Loader)),
+        }
+    with open(bundle_file, "w", encoding="utf-8") as f:
+        json.dump(bundle, f)
+    return bundle_file
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the process-wide prompt registry.
+
+    Returns
+    -------
+    registry : PromptRegistry
+        Shared registry of the package's prompts.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry()
+        return _registry
+
+
+if __name__ == "__main__":
+    print(f"Wrote {build_bundle()}")
@@ -0,0 +1,481 @@
+"""Reference implementation of the Chatify proxy server.
+
+Serves the protocol spoken by :class:`chatify.chains.RequestChain`: clients POST
+``{"user_text": ...}`` (optionally gzip-compressed) to
+``/prompt/{prompt_id}/response`` and receive the response text as a JSON
+string or, if their Accept header asks for it, streamed as server-sent events
+(``text/event-stream``) or newline-delimited JSON (``application/x-ndjson``)
+with one JSON string chunk per event or line. Prompts are resolved from the
+bundled prompt files and responses are generated by the model configured in
+``model_config`` (``fake_model`` works for testing).
+
+The server is a plain ASGI application, so it runs under any ASGI server::
+
+    chatify-server --config config.yaml --port 8000   # needs uvicorn
+    uvicorn --factory chatify.server:create_app
+
+Under load it:
+
+- coalesces identical concurrent requests, so that only one of them reaches
+  the model (single flight),
+- answers repeated requests from a persistent response cache, and
+- limits the number of model calls in flight, queueing at most
+  ``server_config.max_queue`` more requests and turning further ones away with
+  ``503 Service Unavailable``.
+"""
+
+import argparse
+import asyncio
+import json
+import pathlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from .cache import ResponseCache, cache_key
+from .chains import CreateLLMChain
+from .prompt_registry import get_registry
+from .transport import JSON, NDJSON, SSE
+from .utils import model_identity
+
+
+class HTTPError(Exception):
+    """An error answered with an HTTP status code."""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class ProxyServer:
+    """ASGI application answering Chatify proxy requests."""
+
+    def __init__(self, config, registry=None):
+        """Initializes the ProxyServer instance.
+
+        Parameters
+        ----------
+        config : dict
+            Chatify configuration. ``model_config`` and ``chain_config`` select
+            the backend; the optional ``server_config`` section tunes the
+            server (see ``default_config.yaml``).
+        registry : PromptRegistry, optional
+            Registry to resolve prompt ids with, by default the package's.
+        """
+        self.config = config
+        self.server_config = config.get("server_config", {})
+        self.registry = registry or get_registry()
+
+        # The server caches responses itself, so the chain's own cache is disabled
+        self.llm_chain = CreateLLMChain(
+            dict(config, cache_config=dict(config["cache_config"], cache=False))
+        )
+        self.model_id = model_identity(config["model_config"])
+
+        cache_path = self.server_config.get("cache_path", "chatify_server.cache")
+        self.cache = None
+        if cache_path is not None:
+            self.cache = ResponseCache(
+                cache_path,
+                max_entries=self.server_config.get("cache_max_entries", 100000),
+                ttl=self.server_config.get("cache_ttl", None),
+            )
+
+        self.max_concurrency = self.server_config.get("max_concurrency", 8)
+        self.max_queue = self.server_config.get("max_queue", 64)
+        self.max_body_bytes = self.server_config.get("max_body_bytes", 1 << 20)
+        # Model calls block, so they run on a pool as large as the concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="chatify-server"
+        )
+        # Cache lookups wait for SQLite locks, so they run off the event loop too,
+        # on a pool of their own, so that hits are not queued behind model calls
+        self.cache_executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="chatify-server-cache"
+        )
+        self._semaphore = None
+        self._active = 0
+        self._inflight = {}
+        self.counters = {
+            "requests": 0,
+            "cache_hits": 0,
+            "coalesced": 0,
+            "model_calls": 0,
+            "rejected": 0,
+            "errors": 0,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            result = await self._route(scope, receive, send)
+        except HTTPError as e:
+            body = json.dumps({"error": e.message}).encode("utf-8")
+            result = e.status, body, e.headers
+        if result is not None:
+            status, body, headers = result
+            await _respond(send, status, body, headers, head=scope["method"] == "HEAD")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _route(self, scope, receive, send):
+        """Handles a request; returns the response, or None if it was streamed."""
+        parts = scope["path"].strip("/").split("/")
+        if scope["method"] in ("GET", "HEAD"):
+            # Health check; clients also connect here to warm up the connection
+            if parts == [""]:
+                return 200, b'"ok"', {}
+            if parts == ["stats"]:
+                return 200, json.dumps(self.stats()).encode("utf-8"), {}
+
+        if len(parts) != 3 or parts[0] != "prompt" or parts[2] != "response":
+            raise HTTPError(404, f"Unknown path {scope['path']!r}")
+        if scope["method"] != "POST":
+            raise HTTPError(405, "Use POST", {"allow": "POST"})
+
+        prompt = self.registry.by_id(parts[1])
+        if prompt is None:
+            raise HTTPError(404, f"Unknown prompt id {parts[1]!r}")
+
+        user_text = self._parse(scope, await _read_body(receive, self.max_body_bytes))
+        kind = negotiate(dict(scope["headers"]).get(b"accept", b"").decode("latin-1"))
+        if kind != JSON:
+            await self._stream(send, kind, prompt, user_text)
+            return None
+        output = await self.respond(prompt, user_text)
+        return 200, json.dumps(output).encode("utf-8"), {}
+
+    async def _stream(self, send, kind, prompt, user_text):
+        """Streams a response as it is generated.
+
+        Only the request that calls the model streams its tokens (if the model
+        supports streaming); coalesced and cached responses arrive in one chunk.
+        """
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+
+        def on_update(text):
+            loop.call_soon_threadsafe(updates.put_nowait, text)
+
+        task = asyncio.ensure_future(self.respond(prompt, user_text, on_update))
+        task.add_done_callback(lambda _: updates.put_nowait(None))
+
+        started, sent = False, 0
+        while True:
+            text = await updates.get()
+            if text is None:
+                break
+            if not started:
+                await _start_stream(send, kind)
+                started = True
+            await _send_chunk(send, kind, text[sent:])
+            sent = len(text)
+
+        try:
+            output = task.result()
+        except HTTPError:
+            if not started:
+                raise
+            # Too late to change the status; end the stream without [DONE]
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if not started:
+            await _start_stream(send, kind)
+        await _send_chunk(send, kind, output[sent:])
+        end = b"data: [DONE]\n\n" if kind == SSE else b""
+        await send({"type": "http.response.body", "body": end})
+
+    def _parse(self, scope, body):
+        """Decodes the request body and returns its user text."""
+        headers = dict(scope["headers"])
+        if headers.get(b"content-encoding", b"").lower() == b"gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, self.max_body_bytes + 1)
+            except zlib.error:
+                raise HTTPError(400, "Invalid gzip body")
+            if len(body) > self.max_body_bytes:
+                raise HTTPError(413, "Request body too large")
+
+        try:
+            user_text = json.loads(body)["user_text"]
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, 'Expected a JSON body like {"user_text": "..."}')
+        if not isinstance(user_text, str):
+            raise HTTPError(400, "user_text must be a string")
+        return user_text
+
+    async def respond(self, prompt, user_text, on_update=None):
+        """Returns the response to a request, calling the model at most once.
+
+        Parameters
+        ----------
+        prompt : dict
+            The prompt, as stored in the prompt files.
+        user_text : str
+            The user's code cell.
+        on_update : callable, optional
+            Called from a worker thread with the text generated so far, if this
+            request calls the model and the model streams.
+
+        Returns
+        -------
+        output : str
+            The response text.
+
+        Raises
+        ------
+        HTTPError
+            503 if the queue is full, 500 if the model call failed.
+        """
+        self.counters["requests"] += 1
+        prompt_id = prompt["prompt_id"]
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            output = await loop.run_in_executor(
+                self.cache_executor, self.cache.get, prompt_id, self.model_id, user_text
+            )
+            if output is not None:
+                self.counters["cache_hits"] += 1
+                return output
+
+        # Identical requests in flight share the leader's result
+        key = cache_key(prompt_id, self.model_id, user_text)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        if self._active >= self.max_concurrency + self.max_queue:
+            self.counters["rejected"] += 1
+            raise HTTPError(503, "Server busy, try again later", {"retry-after": "1"})
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        future = loop.create_future()
+        self._inflight[key] = future
+        self._active += 1
+        try:
+            async with self._semaphore:
+                self.counters["model_calls"] += 1
+                output = await loop.run_in_executor(
+                    self.executor, self._generate, prompt, user_text, on_update
+                )
+            if self.cache is not None:
+                await loop.run_in_executor(
+                    self.cache_executor,
+                    self.cache.set,
+                    prompt_id,
+                    self.model_id,
+                    user_text,
+                    output,
+                )
+            future.set_result(output)
+        except Exception as e:
+            self.counters["errors"] += 1
+            error = HTTPError(500, f"The model failed to respond: {e}")
+            future.set_exception(error)
+            # Nobody else may be waiting; retrieve it to avoid a warning
+            future.exception()
+            raise error
+        finally:
+            self._active -= 1
+            del self._inflight[key]
+            if not future.done():
+                # The leader was cancelled (e.g. its client went away); its
+                # followers must not wait forever for it
+                future.set_exception(
+                    HTTPError(503, "Request cancelled, try again", {"retry-after": "0"})
+                )
+                future.exception()
+        return output
+
+    def _generate(self, prompt, user_text, on_update=None):
+        chain = self.llm_chain.create_chain(
+            self.config["model_config"], prompt_template=prompt
+        )
+        return self.llm_chain.execute(chain, user_text, on_update=on_update)
+
+    def stats(self):
+        """Returns the server's counters.
+
+        Returns
+        -------
+        stats : dict
+            Numbers of requests, cache hits, coalesced requests, model calls,
+            rejected requests and errors, and the requests currently active.
+        """
+        return dict(self.counters, active=self._active)
+
+    def close(self):
+        """Stops the model workers and closes the response cache."""
+        self.executor.shutdown(wait=False)
+        self.cache_executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.close()
+
+
+def negotiate(accept):
+    """Picks the response media type from an Accept header.
+
+    Parameters
+    ----------
+    accept : str
+        The request's Accept header.
+
+    Returns
+    -------
+    media_type : str
+        SSE or NDJSON if the client accepts it with a higher quality than plain
+        JSON, else JSON.
+    """
+    best, best_q = JSON, 0.0
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        if media_type.lower() not in (SSE, NDJSON, JSON):
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = media_type.lower(), q
+    return best
+
+
+async def _start_stream(send, kind):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", kind.encode("latin-1")),
+                (b"cache-control", b"no-cache"),
+            ],
+        }
+    )
+
+
+async def _send_chunk(send, kind, chunk):
+    if not chunk:
+        return
+    data = json.dumps(chunk)
+    line = f"data: {data}\n\n" if kind == SSE else f"{data}\n"
+    await send(
+        {"type": "http.response.body", "body": line.encode("utf-8"), "more_body": True}
+    )
+
+
+async def _read_body(receive, max_bytes):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPError(413, "Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _respond(send, status, body, headers, head=False):
+    headers = {"content-type": "application/json", **headers}
+    headers["content-length"] = str(len(body))
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers.items()
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": b"" if head else body})
+
+
+def load_config(path=None):
+    """Reads a Chatify configuration file.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path of the config.yaml, by default Chatify's default configuration.
+
+    Returns
+    -------
+    config : dict
+        The configuration.
+    """
+    path = path or pathlib.Path(__file__).parent / "default_config.yaml"
+    with open(path) as f:
+        return yaml.load(f, Loader=yaml.SafeLoader)
+
+
+def create_app(config=None):
+    """Creates the server application.
+
+    Parameters
+    ----------
+    config : dict or str, optional
+        Chatify configuration or the path of a config.yaml, by default Chatify's
+        default configuration.
+
+    Returns
+    -------
+    app : ProxyServer
+        The ASGI application.
+    """
+    if not isinstance(config, dict):
+        config = load_config(config)
+    return ProxyServer(config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="chatify-server",
+        description="Serve Chatify responses to clients using the proxy model.",
+    )
+    parser.add_argument(
+        "--config",
+        default=None,
+        help="config.yaml selecting the model and server settings "
+        "(default: Chatify's default configuration)",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="default: 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="default: 8000")
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("chatify-server needs uvicorn: pip install uvicorn")
+
+    uvicorn.run(create_app(args.config), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
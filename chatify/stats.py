@@ -0,0 +1,450 @@
+"""Per-request latency instrumentation.
+
+Every request is traced from the moment it is submitted until its response is
+rendered. Code along the request path marks its stages with :func:`span`::
+
+    with span("model"):
+        output = chain.invoke(inputs)
+
+A stage's time excludes the time of stages nested inside it, so the stages of a
+request add up to (at most) its total. Outside a traced request :func:`span`
+does nothing; threads only trace the request if they run in a copy of its
+context (see :func:`contextvars.copy_context`), and their spans do not nest in
+the spans of other threads. Finished requests are kept in a bounded ring buffer by the
+process-wide :class:`StatsRecorder`, summarized by the ``%chatify_stats`` magic
+and can be exported as JSON lines or in the Prometheus text format.
+"""
+
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import deque
+
+# Stages of a request, in the order they happen
+STAGES = (
+    "prompt_load",
+    "chain",
+    "compact",
+    "cache_lookup",
+    "model",
+    "decode",
+    "cache_store",
+    "render",
+)
+
+_current = contextvars.ContextVar("chatify_trace", default=None)
+
+
+class Trace:
+    """The spans of a single request."""
+
+    def __init__(self, **labels):
+        """Initializes the Trace instance.
+
+        Parameters
+        ----------
+        **labels
+            Information about the request, e.g. its prompt id, stored with it.
+        """
+        self.labels = labels
+        self.spans = {}
+        self.start = time.time()
+        self._start = time.perf_counter()
+        # Threads running in a copy of the request's context open spans of
+        # their own, which do not nest in the spans of other threads
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        # [stage, start, time spent in nested spans] of this thread's open spans
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def add(self, stage, seconds):
+        """Adds time to a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        seconds : float
+            Time spent in the stage.
+        """
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def as_dict(self, total, status):
+        return {
+            "start": self.start,
+            "total": total,
+            "status": status,
+            "spans": self.spans,
+            **self.labels,
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "stage")
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.trace._stack.append([self.stage, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        stack = self.trace._stack
+        stage, start, nested = stack.pop()
+        elapsed = time.perf_counter() - start
+        self.trace.add(stage, elapsed - nested)
+        if stack:
+            stack[-1][2] += elapsed
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def current_trace():
+    """Returns the trace of the request running in this context, if any.
+
+    Returns
+    -------
+    trace : Trace or None
+        The current trace.
+    """
+    return _current.get()
+
+
+def span(stage):
+    """Times a stage of the current request.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, one of :data:`STAGES`.
+
+    Returns
+    -------
+    span : context manager
+        Adds the time spent inside it to the stage; does nothing outside a
+        traced request.
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, stage)
+
+
+def label(**labels):
+    """Adds labels to the current request, if there is one.
+
+    Parameters
+    ----------
+    **labels
+        Information to store with the request, e.g. ``cache="hit"``.
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.labels.update(labels)
+
+
+def percentile(values, q):
+    """Returns a percentile of sorted values, interpolating linearly.
+
+    Parameters
+    ----------
+    values : list of float
+        Sorted values.
+    q : float
+        Percentile between 0 and 100.
+
+    Returns
+    -------
+    value : float
+        The percentile, or NaN if there are no values.
+    """
+    if not values:
+        return math.nan
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class _Request:
+    """Context manager tracing a request in the current context."""
+
+    def __init__(self, recorder, labels):
+        self.recorder = recorder
+        self.trace = Trace(**labels)
+
+    def __enter__(self):
+        self._token = _current.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        total = time.perf_counter() - self.trace._start
+        status = "ok" if exc_type is None else "error"
+        self.recorder.record(self.trace.as_dict(total, status))
+
+
+class StatsRecorder:
+    """Keeps the most recent requests in a ring buffer and summarizes them."""
+
+    def __init__(self, max_requests=1000):
+        """Initializes the StatsRecorder instance.
+
+        Parameters
+        ----------
+        max_requests : int, optional
+            Number of requests kept; older ones are dropped, by default 1000.
+        """
+        self._requests = deque(maxlen=max_requests)
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    @property
+    def max_requests(self):
+        return self._requests.maxlen
+
+    def resize(self, max_requests):
+        """Changes the number of requests kept, keeping the most recent ones.
+
+        Parameters
+        ----------
+        max_requests : int
+            Number of requests kept.
+        """
+        with self._lock:
+            if max_requests != self._requests.maxlen:
+                self._requests = deque(self._requests, maxlen=max_requests)
+
+    def request(self, **labels):
+        """Traces a request for the duration of a ``with`` block.
+
+        Parameters
+        ----------
+        **labels
+            Information about the request, e.g. its prompt id.
+
+        Returns
+        -------
+        request : context manager
+            Makes a new :class:`Trace` the current one, and records it when the
+            block exits.
+        """
+        return _Request(self, labels)
+
+    def record(self, request):
+        """Adds a finished request and passes it on to the export hooks.
+
+        Parameters
+        ----------
+        request : dict
+            The request, with its 'start' time, 'total' duration, 'status',
+            'spans' and labels.
+        """
+        with self._lock:
+            self._requests.append(request)
+            hooks = list(self._hooks)
+        for hook in hooks:
+            try:
+                hook(request)
+            except Exception as e:
+                print(f"Chatify stats hook {hook!r} failed: {e}")
+
+    def add_hook(self, hook):
+        """Registers a function called with every finished request.
+
+        Parameters
+        ----------
+        hook : callable
+            Called with the request dictionary; use it to ship requests to a
+            log or monitoring system as they finish.
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Unregisters a function registered with :meth:`add_hook`."""
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def requests(self):
+        """Returns the recorded requests, oldest first.
+
+        Returns
+        -------
+        requests : list of dict
+            Copy of the ring buffer.
+        """
+        with self._lock:
+            return list(self._requests)
+
+    def clear(self):
+        """Discards all recorded requests."""
+        with self._lock:
+            self._requests.clear()
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Summarizes the time spent in every stage.
+
+        Parameters
+        ----------
+        percentiles : tuple of float, optional
+            Percentiles to compute, by default (50, 95, 99).
+
+        Returns
+        -------
+        summary : dict
+            Maps every stage, and 'total', to its 'count' and percentiles in
+            seconds (keyed 'p50', 'p95', ...). Traces of another kind than
+            'request' have their total under '<kind>_total'.
+        """
+        samples = {}
+        for request in self.requests():
+            for stage, seconds in request["spans"].items():
+                samples.setdefault(stage, []).append(seconds)
+            # Totals of other kinds of traces, e.g. 'explain', are kept apart
+            kind = request.get("kind", "request")
+            total = "total" if kind == "request" else f"{kind}_total"
+            samples.setdefault(total, []).append(request["total"])
+
+        order = {stage: index for index, stage in enumerate(STAGES + ("total",))}
+        summary = {}
+        for stage in sorted(samples, key=lambda s: (order.get(s, len(order)), s)):
+            values = sorted(samples[stage])
+            summary[stage] = {"count": len(values)}
+            for q in percentiles:
+                summary[stage][f"p{q:g}"] = percentile(values, q)
+        return summary
+
+    def format_summary(self, percentiles=(50, 95, 99)):
+        """Formats :meth:`summary` as a table in milliseconds.
+
+        Returns
+        -------
+        table : str
+            One line per stage.
+        """
+        summary = self.summary(percentiles)
+        if not summary:
+            return "No requests recorded yet."
+        columns = [f"p{q:g}" for q in percentiles]
+        lines = [
+            f"{'stage':<14}{'count':>7}" + "".join(f"{c + ' ms':>11}" for c in columns)
+        ]
+        for stage, values in summary.items():
+            lines.append(
+                f"{stage:<14}{values['count']:>7}"
+                + "".join(f"{values[c] * 1e3:>11.1f}" for c in columns)
+            )
+        return "\n".join(lines)
+
+    def to_jsonl(self):
+        """Exports the recorded requests as JSON lines.
+
+        Returns
+        -------
+        text : str
+            One JSON object per request, oldest first.
+        """
+        return "".join(
+            json.dumps(request, default=str) + "\n" for request in self.requests()
+        )
+
+    def to_prometheus(self, percentiles=(50, 95, 99)):
+        """Exports the stage summary in the Prometheus text format.
+
+        Returns
+        -------
+        text : str
+            A ``chatify_stage_seconds`` summary with one quantile per stage and
+            percentile, and the number of samples per stage.
+        """
+        lines = [
+            "# HELP chatify_stage_seconds Time spent in each stage of a request.",
+            "# TYPE chatify_stage_seconds summary",
+        ]
+        for stage, values in self.summary(percentiles).items():
+            for q in percentiles:
+                lines.append(
+                    f'chatify_stage_seconds{{stage="{stage}",quantile="{q / 100:g}"}} '
+                    f"{values[f'p{q:g}']:.6g}"
+                )
+            lines.append(
+                f'chatify_stage_seconds_count{{stage="{stage}"}} {values["count"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, format="jsonl"):
+        """Writes the recorded requests or their summary to a file.
+
+        Parameters
+        ----------
+        path : str
+            File to write.
+        format : str, optional
+            'jsonl' or 'prometheus', by default 'jsonl'.
+
+        Returns
+        -------
+        path : str
+            The written file.
+
+        Raises
+        ------
+        ValueError
+            If the format is unknown.
+        """
+        exporters = {"jsonl": self.to_jsonl, "prometheus": self.to_prometheus}
+        if format not in exporters:
+            raise ValueError(
+                f"Unknown stats format {format!r}; use 'jsonl' or 'prometheus'"
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(exporters[format]())
+        return path
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder(max_requests=None):
+    """Returns the process-wide stats recorder.
+
+    Parameters
+    ----------
+    max_requests : int, optional
+        Number of requests kept; resizes the recorder if given.
+
+    Returns
+    -------
+    recorder : StatsRecorder
+        Shared recorder.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = StatsRecorder(max_requests or 1000)
+        elif max_requests is not None:
+            _recorder.resize(max_requests)
+        return _recorder
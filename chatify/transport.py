@@ -0,0 +1,557 @@
+import ast
+import collections
+import gzip
+import json
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .stats import label, percentile
+
+try:
+    # orjson parses large responses several times faster than the json module
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+# Media types of the proxy protocol; the streaming ones carry one JSON string
+# chunk per event or line
+JSON = "application/json"
+SSE = "text/event-stream"
+NDJSON = "application/x-ndjson"
+STREAMING_ACCEPT = f"{SSE}, {NDJSON};q=0.9, {JSON};q=0.5"
+
+# Responses worth retrying: rate limiting and an overloaded or restarting proxy
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+# Bytes read at a time from a response body, between deadline checks
+CHUNK_SIZE = 16 * 1024
+
+
+class ProxyTransport:
+    """A pooled, keep-alive HTTP transport for talking to the proxy server.
+
+    A single :class:`requests.Session` is shared by every request sent through
+    the transport, so DNS lookups and TCP/TLS handshakes are paid once per
+    connection rather than once per request.
+
+    Every request has a deadline. Connection errors, timeouts and transient
+    HTTP errors are retried with exponential backoff until it passes. The
+    deadline also covers reading the response body (see :func:`read_body` and
+    :func:`iter_chunks`), but it is only checked between socket reads, each of
+    which may block for up to the read timeout: a server that stalls can
+    overrun the deadline by at most ``read_timeout`` seconds. With
+    hedging enabled, an attempt that is slower than the given percentile of
+    recent requests gets a duplicate, and whichever returns first is used.
+    """
+
+    def __init__(
+        self,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=60,
+        compress_min_bytes=None,
+        deadline=90,
+        max_retries=2,
+        retry_backoff=0.5,
+        retry_backoff_max=8,
+        hedge_percentile=None,
+        hedge_min_samples=20,
+    ):
+        """Initializes the ProxyTransport instance.
+
+        Parameters
+        ----------
+        pool_size : int, optional
+            Maximum number of connections kept alive per host, by default 10.
+        connect_timeout : float, optional
+            Seconds to wait for a connection to be established, by default 3.05.
+        read_timeout : float, optional
+            Seconds to wait for the server to send a response, by default 60.
+        compress_min_bytes : int, optional
+            Request bodies of at least this many bytes are gzip-compressed.
+            Compression is disabled when None (the default).
+        deadline : float, optional
+            Seconds after which a request fails, including all retries and
+            reading the response, by default 90. No deadline when None.
+        max_retries : int, optional
+            Number of times a failed request is retried, by default 2.
+        retry_backoff : float, optional
+            Upper bound in seconds of the random delay before the first retry,
+            by default 0.5; it doubles with every further retry.
+        retry_backoff_max : float, optional
+            Maximum delay in seconds before a retry, by default 8.
+        hedge_percentile : float, optional
+            Percentile (e.g. 95) of recent response times after which a
+            duplicate request is sent. Hedging is disabled when None (the
+            default).
+        hedge_min_samples : int, optional
+            Number of response times needed before requests are hedged, by
+            default 20.
+        """
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.compress_min_bytes = compress_min_bytes
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        # Response times of recent successful attempts, for hedging
+        self._latencies = collections.deque(maxlen=256)
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Connection": "keep-alive"})
+
+    def _encode(self, data, headers):
+        """Serializes the payload, compressing it if it is large enough.
+
+        Parameters
+        ----------
+        data : dict
+            JSON-serializable request payload.
+        headers : dict
+            Request headers; updated in place.
+
+        Returns
+        -------
+        body : bytes
+            Encoded request body.
+        """
+        body = json.dumps(data).encode("utf-8")
+        if self.compress_min_bytes is not None and len(body) >= self.compress_min_bytes:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body
+
+    def hedge_delay(self):
+        """Returns how long an attempt may take before it is hedged.
+
+        Returns
+        -------
+        delay : float or None
+            Seconds, or None if hedging is disabled or there are too few
+            response times to go by.
+        """
+        if self.hedge_percentile is None:
+            return None
+        latencies = sorted(self._latencies)
+        if len(latencies) < max(self.hedge_min_samples, 1):
+            return None
+        return percentile(latencies, self.hedge_percentile)
+
+    def _send(self, url, body, headers, stream, timeout):
+        """Sends a single attempt and records its response time."""
+        start = time.perf_counter()
+        response = self.session.post(
+            url, data=body, headers=headers, timeout=timeout, stream=stream
+        )
+        if response.ok:
+            self._latencies.append(time.perf_counter() - start)
+        return response
+
+    def _send_hedged(self, url, body, headers, stream, timeout, delay):
+        """Sends an attempt, and a duplicate if it takes longer than ``delay``.
+
+        Returns
+        -------
+        response : requests.Response
+            The first successful response, or the last failure's response.
+        hedged : bool
+            Whether a duplicate was sent.
+
+        Raises
+        ------
+        requests.RequestException
+            If every attempt failed without a response.
+        """
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * self.pool_size, thread_name_prefix="chatify-hedge"
+                )
+        executor = self._hedge_executor
+
+        pending = {executor.submit(self._send, url, body, headers, stream, timeout)}
+        done, _ = wait(pending, timeout=delay)
+        hedged = not done
+        if hedged:
+            pending.add(
+                executor.submit(self._send, url, body, headers, stream, timeout)
+            )
+
+        result, error = None, None
+        while pending and (result is None or not result.ok):
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                if result is None or (response.ok and not result.ok):
+                    result, response = response, result
+                if response is not None:
+                    response.close()
+
+        # Close the slower attempt's connection once it finishes
+        for future in pending:
+            future.add_done_callback(_close_response)
+        if result is None:
+            raise error
+        return result, hedged
+
+    def _backoff(self, retry, response=None):
+        """Returns the delay before a retry, honouring Retry-After headers."""
+        if response is not None:
+            try:
+                return float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+        limit = min(self.retry_backoff * 2**retry, self.retry_backoff_max)
+        # "Full jitter" spreads out the retries of many clients failing at once
+        return random.uniform(0, limit)
+
+    def post(self, url, data, headers=None, stream=False):
+        """Sends a JSON payload to the given URL.
+
+        Connection errors, timeouts and 429, 502, 503 and 504 responses are
+        retried with exponential backoff while the deadline allows.
+
+        Parameters
+        ----------
+        url : str
+            Target URL.
+        data : dict
+            JSON-serializable request payload.
+        headers : dict, optional
+            Additional request headers.
+        stream : bool, optional
+            Whether to return before the response body has been read, by
+            default False. The body of a streamed response must then be read
+            with :func:`read_body` or :func:`iter_chunks` for the deadline to
+            apply to it.
+
+        Returns
+        -------
+        response : requests.Response
+            The server response.
+
+        Raises
+        ------
+        requests.Timeout
+            If the deadline passed before the response was read.
+        requests.HTTPError
+            If the server answered with an error status.
+        requests.RequestException
+            If the last attempt failed without a response.
+        """
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "application/json")
+        body = self._encode(data, headers)
+        # With a deadline the body is read here, checking it between reads
+        send_stream = stream or self.deadline is not None
+
+        start = time.monotonic()
+        retry = 0
+        while True:
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining = self.deadline - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise requests.Timeout(
+                        f"No response from {url} within the {self.deadline} s "
+                        f"deadline ({retry} retries)"
+                    )
+                timeout = (
+                    min(self.connect_timeout, remaining),
+                    min(self.read_timeout, remaining),
+                )
+
+            response, error = None, None
+            delay = self.hedge_delay()
+            try:
+                if delay is not None and delay < timeout[1]:
+                    response, hedged = self._send_hedged(
+                        url, body, headers, send_stream, timeout, delay
+                    )
+                    if hedged:
+                        label(hedged=True)
+                else:
+                    response = self._send(url, body, headers, send_stream, timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                break
+            if retry >= self.max_retries:
+                if error is not None:
+                    raise error
+                break
+
+            backoff = self._backoff(retry, response)
+            if response is not None:
+                response.close()
+            if self.deadline is not None:
+                backoff = min(backoff, self.deadline - (time.monotonic() - start))
+            time.sleep(max(0.0, backoff))
+            retry += 1
+            label(retries=retry)
+
+        if self.deadline is not None:
+            response.deadline = start + self.deadline
+        response.raise_for_status()
+        if not stream:
+            read_body(response)
+        return response
+
+    def prewarm(self, url, background=True):
+        """Opens a connection to the server ahead of the first request.
+
+        Parameters
+        ----------
+        url : str
+            Any URL on the server to connect to.
+        background : bool, optional
+            Whether to connect from a daemon thread, by default True.
+
+        Returns
+        -------
+        None
+        """
+
+        def _connect():
+            parts = urlsplit(url)
+            try:
+                self.session.head(
+                    f"{parts.scheme}://{parts.netloc}/", timeout=self.timeout
+                )
+            except requests.RequestException:
+                # Warming up is best effort; the real request will report errors
+                pass
+
+        if background:
+            threading.Thread(target=_connect, daemon=True).start()
+        else:
+            _connect()
+
+    def close(self):
+        """Closes all pooled connections."""
+        self.session.close()
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _check_deadline(response):
+    deadline = getattr(response, "deadline", None)
+    if deadline is not None and time.monotonic() > deadline:
+        response.close()
+        raise requests.Timeout(
+            f"The response from {response.url} was not read within its deadline"
+        )
+
+
+def read_body(response):
+    """Reads the whole body of a response within its deadline.
+
+    Parameters
+    ----------
+    response : requests.Response
+        A response from :meth:`ProxyTransport.post`, streamed or not.
+
+    Returns
+    -------
+    content : bytes
+        The response body, also available as ``response.content``.
+
+    Raises
+    ------
+    requests.Timeout
+        If the request's deadline passed while the body was being read.
+    """
+    if getattr(response, "deadline", None) is None:
+        return response.content
+    chunks = []
+    for chunk in response.iter_content(CHUNK_SIZE):
+        chunks.append(chunk)
+        _check_deadline(response)
+    # Where requests keeps a body it read itself, for response.content
+    response._content = b"".join(chunks)
+    response.deadline = None
+    return response.content
+
+
+def decode_response(content):
+    """Decodes a complete proxy response.
+
+    Parameters
+    ----------
+    content : bytes
+        Response body: a JSON string, or a Python string literal as sent by
+        older proxies.
+
+    Returns
+    -------
+    output : str
+        The response text.
+
+    Raises
+    ------
+    ValueError
+        If the body is neither.
+    """
+    try:
+        output = loads(content)
+    except ValueError:
+        # Older proxies answer with a Python string literal; literal_eval only
+        # accepts literals, so nothing in the response is ever executed
+        try:
+            output = ast.literal_eval(content.decode("utf-8").strip())
+        except (SyntaxError, ValueError, UnicodeDecodeError):
+            raise ValueError(f"Could not decode the proxy response {content[:80]!r}")
+    if not isinstance(output, str):
+        raise ValueError(f"Expected a string response, got {type(output).__name__}")
+    return output
+
+
+def media_type(response):
+    """Returns the media type of a response, without parameters."""
+    return response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+
+def iter_chunks(response):
+    """Yields the text chunks of a streamed proxy response.
+
+    Parameters
+    ----------
+    response : requests.Response
+        A streamed response of any of the protocol's media types; responses
+        that are not streamed yield their whole text at once.
+
+    Yields
+    ------
+    chunk : str
+        The next piece of the response text.
+    """
+    kind = media_type(response)
+    if kind == SSE:
+        yield from iter_sse(response)
+    elif kind == NDJSON:
+        yield from iter_ndjson(response)
+    else:
+        yield decode_response(read_body(response))
+
+
+def iter_ndjson(response):
+    """Yields the text chunks of a newline-delimited JSON (NDJSON) response.
+
+    Parameters
+    ----------
+    response : requests.Response
+        A streamed response with one JSON-encoded string chunk per line.
+
+    Yields
+    ------
+    chunk : str
+        The next piece of the response text.
+    """
+    for line in response.iter_lines():
+        _check_deadline(response)
+        if line.strip():
+            yield loads(line)
+
+
+def iter_sse(response):
+    """Yields the text chunks of a server-sent events (SSE) response.
+
+    Each event's ``data`` field holds a JSON-encoded string chunk; an event
+    whose data is ``[DONE]`` ends the stream.
+
+    Parameters
+    ----------
+    response : requests.Response
+        A streamed response with a ``text/event-stream`` body.
+
+    Yields
+    ------
+    chunk : str
+        The next piece of the response text.
+    """
+    data = []
+    for line in response.iter_lines():
+        _check_deadline(response)
+        line = line.decode("utf-8")
+        if line:
+            if line.startswith("data:"):
+                data.append(line[5:].lstrip())
+            continue
+        # A blank line terminates the event
+        if data:
+            payload = "\n".join(data)
+            data = []
+            if payload == "[DONE]":
+                return
+            yield loads(payload)
+    if data and "\n".join(data) != "[DONE]":
+        yield loads("\n".join(data))
+
+
+# model_config keys that tune the transport, with their defaults
+_SETTINGS = {
+    "pool_size": 10,
+    "connect_timeout": 3.05,
+    "read_timeout": 60,
+    "compress_min_bytes": None,
+    "deadline": 90,
+    "max_retries": 2,
+    "retry_backoff": 0.5,
+    "retry_backoff_max": 8,
+    "hedge_percentile": None,
+    "hedge_min_samples": 20,
+}
+
+
+def get_transport(model_config=None):
+    """Returns the process-wide transport matching the model configuration.
+
+    Parameters
+    ----------
+    model_config : dict, optional
+        Model configuration; the optional keys named after the arguments of
+        :class:`ProxyTransport` (``pool_size``, ``read_timeout``, ``deadline``,
+        ``max_retries``, ``hedge_percentile``, ...) tune the transport.
+
+    Returns
+    -------
+    transport : ProxyTransport
+        Shared transport instance.
+    """
+    model_config = model_config or {}
+    settings = {
+        key: model_config.get(key, default) for key, default in _SETTINGS.items()
+    }
+    key = tuple(settings.values())
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = ProxyTransport(**settings)
+        return _transports[key]
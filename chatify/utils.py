@@ -1,95 +1,132 @@
-import random
-import urllib
-from typing import Any, List, Mapping, Optional
+import functools
+import hashlib
+import json
+import threading
+from collections import OrderedDict
 
-from langchain.llms.base import LLM
-from markdown_it import MarkdownIt
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name
+# NOTE: markdown_it and pygments are imported when the first response is
+# rendered, so that loading the extension stays fast.
 
 
-def highlight_code(code, name, attrs):
-    """Highlight a block of code"""
+@functools.lru_cache(maxsize=64)
+def _get_lexer(name):
+    """Return the (cached) Pygments lexer for a language, falling back to Python."""
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
 
     try:
-        lexer = get_lexer_by_name(name)
-    except:
-        lexer = get_lexer_by_name('python')
-    formatter = HtmlFormatter(cssclass='codehilite', linenos='table')
+        return get_lexer_by_name(name)
+    except ClassNotFound:
+        return get_lexer_by_name('python')
 
-    return highlight(code, lexer, formatter)
 
+@functools.lru_cache(maxsize=1)
+def _get_code_formatter():
+    """Return the (cached) formatter for highlighted code blocks."""
+    from pygments.formatters import HtmlFormatter
 
-def get_html(markdown, code_style='default'):
-    """Return HTML string rendered from markdown source."""
+    return HtmlFormatter(cssclass='codehilite', linenos='table')
 
-    md = MarkdownIt(
-        "js-default",
-        {
-            "linkify": True,
-            "html": True,
-            "typographer": True,
-            "highlight": highlight_code,
-        },
-    )
 
-    formatter = HtmlFormatter(style=code_style, linenos='table')
-    css = formatter.get_style_defs()
+@functools.lru_cache(maxsize=256)
+def _highlight(code, name):
+    from pygments import highlight
 
-    return f'<head><style>{css}</style></head>' + md.render(markdown)
+    return highlight(code, _get_lexer(name), _get_code_formatter())
 
 
-class FakeListLLM(LLM):
-    """Fake LLM wrapper for testing purposes.
+def highlight_code(code, name, attrs):
+    """Highlight a block of code"""
+    # Memoized, since streamed responses re-render finished code blocks
+    return _highlight(code, name or 'python')
 
-    Attributes
-    ----------
-    responses : List
-        List of responses.
-    """
 
-    responses: List
+class MarkdownRenderer:
+    """Renders markdown to HTML, reusing one parser and the code style's CSS.
 
-    @property
-    def _llm_type(self) -> str:
-        """Return type of LLM.
+    Rendered HTML is memoized by content hash in a bounded LRU cache, so
+    repeated (e.g. cached) responses are only rendered once.
+    """
 
-        Returns
-        -------
-        str
-            Type of LLM.
-        """
-        return "fake-list"
+    def __init__(self, code_style='default', max_cached=128):
+        """Initializes the MarkdownRenderer instance.
 
-    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
-        """First try to lookup in queries, else return 'foo' or 'bar'.
+        Parameters
+        ----------
+        code_style : str, optional
+            Pygments style used for code blocks, by default 'default'.
+        max_cached : int, optional
+            Maximum number of rendered responses to keep, by default 128.
+        """
+        from markdown_it import MarkdownIt
+        from pygments.formatters import HtmlFormatter
+
+        self.md = MarkdownIt(
+            "js-default",
+            {
+                "linkify": True,
+                "html": True,
+                "typographer": True,
+                "highlight": highlight_code,
+            },
+        )
+        css = HtmlFormatter(style=code_style, linenos='table').get_style_defs()
+        self.head = f'<head><style>{css}</style></head>'
+
+        self.max_cached = max_cached
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, markdown, cache=True):
+        """Return HTML string rendered from markdown source.
 
         Parameters
         ----------
-        prompt : str
-            Input prompt.
-        stop : List[str], optional
-            List of stop tokens, by default None.
+        markdown : str
+            Markdown source.
+        cache : bool, optional
+            Whether to memoize the result, by default True. Partial (streamed)
+            responses are rendered without caching.
 
         Returns
         -------
-        str
-            Generated response.
+        html : str
+            The rendered HTML, including the code style's CSS.
         """
-        response = self.responses[random.randint(0, len(self.responses) - 1)]
-        return response
+        key = hashlib.sha1(markdown.encode('utf-8')).digest()
+        with self._lock:
+            html = self._rendered.get(key)
+            if html is not None:
+                self._rendered.move_to_end(key)
+                return html
 
-    @property
-    def _identifying_params(self) -> Mapping[str, Any]:
-        """Get the identifying parameters.
+        html = self.head + self.md.render(markdown)
+        if cache:
+            with self._lock:
+                self._rendered[key] = html
+                while len(self._rendered) > self.max_cached:
+                    self._rendered.popitem(last=False)
+        return html
 
-        Returns
-        -------
-        Mapping[str, Any]
-            Identifying parameters.
-        """
-        return {}
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_html(markdown, code_style='default', cache=True):
+    """Return HTML string rendered from markdown source."""
+    with _renderers_lock:
+        renderer = _renderers.get(code_style)
+        if renderer is None:
+            renderer = _renderers[code_style] = MarkdownRenderer(code_style)
+    return renderer.render(markdown, cache=cache)
+
+
+def read_prompt_dir(prompts_to_use):
+    """Return the prompt files in the package's 'prompts' directory, by name."""
+    from .prompt_registry import get_registry
+
+    return get_registry().get_many(prompts_to_use)
 
 
 def compress_code(text):
@@ -98,6 +135,21 @@ def compress_code(text):
     )
 
 
+def fingerprint(obj):
+    """Return a stable hash of a JSON-serializable object (e.g. a config dict)."""
+    data = json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def model_identity(model_config):
+    """Return a stable, secret-free identifier of the model a config selects."""
+    model = model_config['model']
+    if model == 'proxy':
+        return f"proxy:{model_config['proxy_url'].rstrip('/')}"
+    parts = [model, model_config.get('model_name'), model_config.get('weights_fname')]
+    return ':'.join(str(part) for part in parts if part is not None)
+
+
 def check_dev_config(config):
     # We assume that the dev config has openai api key
     if ('open_ai' in config['model_config']['model']) and (
@@ -108,12 +160,31 @@ def check_dev_config(config):
 
 
 def download_cache_database(config):
+    """Downloads the cache database named after ``cache_db_version``.
+
+    Files that are already current are not downloaded again, and interrupted
+    downloads are resumed; see :func:`chatify.download.download_file`.
+
+    Parameters
+    ----------
+    config : dict
+        The ``cache_config`` section of the configuration.
+    """
+    from .download import download_file
+
+    cache_db_version = config['cache_db_version']
+    file_name = f'NMA_2023_v{cache_db_version}.cache'
+    url = config['url']
     try:
-        cache_db_version = config['cache_db_version']
-        file_name = f'NMA_2023_v{cache_db_version}.cache'
-        url = config['url']
-        # print(f'Downloading the \'cache\' file.')
-
-        urllib.request.urlretrieve(url, file_name)
-    except FileNotFoundError:
-        print(f'{file_name} could not be downloaded from the provided cache URL: {url}')
+        download_file(url, file_name, sha256=config.get('sha256', None))
+    except (OSError, ValueError) as e:
+        print(f'{file_name} could not be downloaded from the cache URL {url}: {e}')
+
+
+def __getattr__(name):
+    # FakeListLLM lives in llm_models so that importing utils does not load langchain
+    if name == 'FakeListLLM':
+        from .llm_models import FakeListLLM
+
+        return FakeListLLM
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,7 +1,26 @@
+import functools
 import pathlib
 
 import ipywidgets as widgets
 
+# Widgets shared by every cell; they must outlive any single cell's widgets
+_shared_widgets = []
+
+
+@functools.lru_cache(maxsize=1)
+def _loading_gif():
+    dirname = pathlib.Path(__file__).parent.resolve()
+    with open(f"{dirname}/assets/loading.gif", "rb") as file:
+        # read file as string into `image`
+        return file.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_layout(**kwargs):
+    layout = widgets.Layout(**kwargs)
+    _shared_widgets.append(layout)
+    return layout
+
 
 def option_widget(config):
     """Create an options dropdown widget based on the given configuration.
@@ -44,11 +63,7 @@ def button_widget():
 
 
 def loading_widget():
-    dirname = pathlib.Path(__file__).parent.resolve()
-    with open(f"{dirname}/assets/loading.gif", "rb") as file:
-        # read file as string into `image`
-        image = file.read()
-    loading = widgets.Image(value=image, format='gif', width=0, height=10)
+    loading = widgets.Image(value=_loading_gif(), format='gif', width=0, height=10)
     return loading
 
 
@@ -70,7 +85,7 @@ def thumbs(icon='fa-thumbs-up'):
         disabled=False,
         button_style='',
         icon=u'\U0001F44D',
-        layout=widgets.Layout(width='5%'),
+        layout=_shared_layout(width='5%'),
     )
     return button
 
@@ -85,3 +100,23 @@ def text_widget():
     """
     text = widgets.HTMLMath(value='', placeholder='', description='')
     return text
+
+
+def close_widgets(*roots):
+    """Close widgets, their children and their own layouts and styles.
+
+    Parameters
+    ----------
+    *roots : widgets.Widget
+        Widgets to close, e.g. the container holding a cell's UI.
+    """
+    for widget in roots:
+        for child in getattr(widget, 'children', ()):
+            close_widgets(child)
+        for attribute in ('layout', 'style'):
+            sub_widget = getattr(widget, attribute, None)
+            if isinstance(sub_widget, widgets.Widget) and not any(
+                sub_widget is shared for shared in _shared_widgets
+            ):
+                sub_widget.close()
+        widget.close()
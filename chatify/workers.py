@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(max_workers=4, name="chatify"):
+    """Returns a process-wide, bounded thread pool for background requests.
+
+    Pools are shared by name and size, so every ``Chatify`` instance in a
+    kernel sends its requests through the same workers. Pools are never shut
+    down here, as other callers may still be using them; asking for another
+    size gives a separate pool.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of requests in flight at the same time, by default 4.
+    name : str, optional
+        Name of the pool, by default 'chatify'.
+
+    Returns
+    -------
+    executor : ThreadPoolExecutor
+        Shared executor.
+    """
+    with _executors_lock:
+        executor = _executors.get((name, max_workers))
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=name
+            )
+            _executors[name, max_workers] = executor
+        return executor
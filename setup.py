@@ -19,6 +19,7 @@ requirements = [
     "requests",
     "markdown-it-py[linkify,plugins]",
     "pygments",
+    "numpy",
 ]
 extras = [
     "transformers",
@@ -51,11 +52,20 @@ setup(
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
+    entry_points={
+        "console_scripts": [
+            "chatify-build-cache=chatify.build_cache:main",
+            "chatify-answer-store=chatify.answer_store:main",
+            "chatify-server=chatify.server:main",
+        ],
+    },
     description="A python package that adds a magic command to Jupyter notebooks to enable LLM interactions with code cells.",
     description_content_type="text/markdown",
     install_requires=requirements,
     extras_require={
         "hf": extras,
+        "server": ["uvicorn"],
+        "zstd": ["zstandard"],
     },
     license="MIT license",
     long_description=readme + "\n\n" + history,
@@ -66,7 +76,7 @@ setup(
     packages=find_packages(include=["chatify", "chatify.*"]),
     test_suite="tests",
     tests_require=test_requirements,
-    package_data={"": ["**/*.yaml", "**/*.gif"]},
+    package_data={"": ["**/*.yaml", "**/*.gif", "**/*.json"]},
     url="https://github.com/ContextLab/chatify",
     version="0.2.1",
     zip_safe=False,
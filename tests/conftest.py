@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The offline proxy stub lives with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import stub_server  # noqa: E402
+
+
+@pytest.fixture
+def proxy_server():
+    server = stub_server.serve()
+    yield server
+    server.shutdown()
+    server.server_close()
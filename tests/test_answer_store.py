@@ -0,0 +1,73 @@
+import pytest
+
+from chatify.answer_store import AnswerStore, merge, write_answer_store
+from chatify.cache import ResponseCache, cache_key
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'a.answers')
+    answers = {
+        cache_key('explain', 'model', f'x = {i}'): f'answer {i} é' for i in range(100)
+    }
+    assert write_answer_store(path, answers.items(), models=['model']) == 100
+
+    store = AnswerStore(path)
+    assert len(store) == 100
+    assert store.model_ids == ['model']
+    for key, answer in answers.items():
+        assert store.get_key(key) == answer
+    assert store.get('explain', 'x = 7') == 'answer 7 é'
+    assert store.get('explain', 'x = 100') is None
+    assert store.get('explain', 'x = 7', model_ids=['other']) == 'answer 7 é'
+    assert [bytes(key).hex() for key, _ in store.items()] == sorted(answers)
+    store.close()
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / 'a.answers')
+    write_answer_store(path, [])
+    store = AnswerStore(path)
+    assert len(store) == 0
+    assert store.get_key('00' * 32) is None
+    store.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'not.answers'
+    path.write_bytes(b'SQLite format 3\x00' + b'\x00' * 100)
+    with pytest.raises(ValueError):
+        AnswerStore(str(path))
+
+
+def test_merge_precedence(tmp_path):
+    first = str(tmp_path / 'first.answers')
+    write_answer_store(
+        first,
+        [
+            (cache_key('explain', 'model', 'x = 1'), 'old 1'),
+            (cache_key('explain', 'model', 'x = 2'), 'old 2'),
+        ],
+        models=['model'],
+    )
+    second = str(tmp_path / 'second.cache')
+    cache = ResponseCache(second, max_entries=None)
+    cache.set('explain', 'model', 'x = 2', 'new 2')
+    cache.set('explain', 'model', 'x = 3', 'new 3')
+    cache.set('explain', 'other', 'x = 4', 'other 4')
+    cache.close()
+
+    output = str(tmp_path / 'merged.answers')
+    assert merge(output, [first, second], model_id='model') == 3
+    store = AnswerStore(output)
+    assert store.get('explain', 'x = 1') == 'old 1'
+    # Later inputs take precedence
+    assert store.get('explain', 'x = 2') == 'new 2'
+    assert store.get('explain', 'x = 3') == 'new 3'
+    assert store.get('explain', 'x = 4', model_ids=['other']) is None
+    store.close()
+
+    # A store can be merged into itself
+    assert merge(first, [first, second]) == 4
+    store = AnswerStore(first)
+    assert store.get('explain', 'x = 4', model_ids=['other']) == 'other 4'
+    store.close()
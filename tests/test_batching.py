@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from chatify.batching import BatchScheduler
+
+
+def test_concurrent_prompts_are_batched():
+    calls = []
+    release = threading.Event()
+
+    def generate(prompts, stop):
+        calls.append((list(prompts), stop))
+        release.wait(5)
+        return [prompt.upper() for prompt in prompts]
+
+    scheduler = BatchScheduler(generate, max_batch_size=4, max_wait_ms=200)
+    futures = [scheduler.submit(f'prompt {i}') for i in range(4)]
+    # Prompts with other stop sequences are generated separately
+    other = scheduler.submit('other', stop=['\n'])
+    release.set()
+    assert [future.result(5) for future in futures] == [f'PROMPT {i}' for i in range(4)]
+    assert other.result(5) == 'OTHER'
+    assert calls[0] == ([f'prompt {i}' for i in range(4)], None)
+    assert calls[1] == (['other'], ['\n'])
+    assert scheduler.batch_sizes == [4, 1]
+    scheduler.close()
+
+
+def test_errors_reach_every_prompt_of_the_batch():
+    def generate(prompts, stop):
+        raise ValueError('out of memory')
+
+    scheduler = BatchScheduler(generate, max_batch_size=2, max_wait_ms=200)
+    futures = [scheduler.submit('a'), scheduler.submit('b')]
+    for future in futures:
+        with pytest.raises(ValueError, match='out of memory'):
+            future.result(5)
+
+    # The worker survives the error
+    scheduler.generate = lambda prompts, stop: prompts
+    assert scheduler.submit('c').result(5) == 'c'
+    scheduler.close()
+
+
+def test_close_stops_the_worker():
+    scheduler = BatchScheduler(lambda prompts, stop: prompts, max_wait_ms=0)
+    assert scheduler.submit('a').result(5) == 'a'
+    worker = scheduler._worker
+    scheduler.close()
+    assert not worker.is_alive()
+    # A later prompt starts a new worker
+    assert scheduler.submit('b').result(5) == 'b'
+    scheduler.close()
+
+
+def test_idle_worker_exits():
+    scheduler = BatchScheduler(
+        lambda prompts, stop: prompts, max_wait_ms=0, idle_timeout=0.05
+    )
+    assert scheduler.submit('a').result(5) == 'a'
+    worker = scheduler._worker
+    worker.join(5)
+    assert not worker.is_alive()
+    assert scheduler.submit('b').result(5) == 'b'
+    scheduler.close()
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from chatify import build_cache as build_cache_module
+from chatify.build_cache import build_cache, read_notebook_cells
+from chatify.chains import CreateLLMChain
+from chatify.utils import read_prompt_dir
+
+CELLS = ['import numpy as np\nx = np.arange(3)\n', 'def f(x):\n    return x ** 2\n']
+
+CONFIG = {
+    'cache_config': {'cache': True, 'cache_db_version': 'test', 'url': None},
+    'feedback': False,
+    'model_config': {'model': 'fake_model'},
+    'chain_config': {'chain_type': 'default'},
+    'prompts_config': {'prompts_to_use': ['tutor']},
+}
+
+
+@pytest.fixture
+def notebook(tmp_path):
+    cells = [
+        {'cell_type': 'markdown', 'source': ['# Tutorial']},
+        {'cell_type': 'code', 'source': CELLS[0].splitlines(keepends=True)},
+        {'cell_type': 'code', 'source': '%%explain\n' + CELLS[1]},
+        {'cell_type': 'code', 'source': '\n'},
+    ]
+    path = tmp_path / 'tutorial.ipynb'
+    path.write_text(json.dumps({'cells': cells}))
+    return str(path)
+
+
+def test_read_notebook_cells(notebook):
+    assert read_notebook_cells(notebook) == CELLS
+
+
+def test_interrupted_builds_resume(tmp_path, notebook, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    requests = len(CELLS) * len(read_prompt_dir(['tutor'])['tutor'])
+    calls = []
+
+    def execute(self, chain, cell):
+        calls.append((chain.metadata['prompt_id'], cell))
+        if len(calls) == 5:
+            raise KeyboardInterrupt
+        return f"{chain.metadata['prompt_id']}|{cell}"
+
+    monkeypatch.setattr(build_cache_module.CreateLLMChain, 'execute', execute)
+    output = 'NMA_2023_vtest.cache'
+    with pytest.raises(KeyboardInterrupt):
+        build_cache([notebook], CONFIG, output, workers=1, verbose=False)
+    # The pending requests were dropped; at most one more was in flight
+    stored = len(calls) - 1
+    assert stored in (4, 5)
+
+    stats = build_cache([notebook], CONFIG, output, workers=1, verbose=False)
+    assert stats == {'cached': requests - stored, 'skipped': stored, 'failed': 0}
+    # Every request was sent once, apart from the interrupted one
+    assert len(set(calls)) == requests
+    assert len(calls) == requests + 1
+    monkeypatch.undo()
+
+    # Chatify finds every precomputed response under the key it looks up
+    monkeypatch.chdir(tmp_path)
+    llm_chain = CreateLLMChain(CONFIG)
+    assert llm_chain.cacher.wait(5)
+    for prompt in read_prompt_dir(['tutor'])['tutor'].values():
+        chain = llm_chain.create_chain(CONFIG['model_config'], prompt_template=prompt)
+        for cell in CELLS:
+            expected = f"{chain.metadata['prompt_id']}|{cell}"
+            assert llm_chain.execute(chain, cell) == expected
+    assert llm_chain.cacher.stats()['hits'] == requests
+    llm_chain.close()
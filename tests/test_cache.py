@@ -0,0 +1,418 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+
+import pytest
+
+from chatify import cache as cache_module
+from chatify.cache import ResponseCache, SimilarityCache, cache_key, embed_texts
+from chatify.workers import get_executor
+
+RESPONSES = [
+    f'## Explanation\n\nThis code computes step {i} of the simulation and '
+    f'plots the membrane potential of neuron {i % 7} over time.\n'
+    for i in range(400)
+]
+
+
+def fill(cache, n=len(RESPONSES)):
+    for i, response in enumerate(RESPONSES[:n]):
+        cache.set('explain', 'model', f'x = {i}', response)
+
+
+def test_migrates_caches_without_codec_column(tmp_path):
+    path = str(tmp_path / 'old.cache')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE responses (key TEXT PRIMARY KEY, prompt_id TEXT, '
+        'model TEXT, response TEXT, created REAL, accessed REAL, '
+        'hits INTEGER DEFAULT 0)'
+    )
+    conn.execute(
+        'INSERT INTO responses VALUES (?, ?, ?, ?, 0, 0, 0)',
+        (cache_key('explain', 'model', 'x = 1'), 'explain', 'model', 'old'),
+    )
+    conn.commit()
+    conn.close()
+
+    cache = ResponseCache(path)
+    assert cache.get('explain', 'model', 'x = 1') == 'old'
+    cache.set('explain', 'model', 'x = 2', 'new')
+    assert cache.get('explain', 'model', 'x = 2') == 'new'
+    cache.close()
+
+    # Migrations are applied once
+    cache = ResponseCache(path)
+    assert cache.get('explain', 'model', 'x = 1') == 'old'
+    cache.close()
+
+
+def test_compressed_round_trip(tmp_path):
+    pytest.importorskip('zstandard')
+    cache = ResponseCache(str(tmp_path / 'c.cache'), max_entries=None)
+    fill(cache)
+    stats = cache.train_dictionary(dict_size=4096)
+    assert stats['entries'] == len(RESPONSES)
+    assert stats['after'] < stats['before']
+    cache.set('explain', 'model', 'new', 'a new response')
+    for i, response in enumerate(RESPONSES):
+        assert cache.get('explain', 'model', f'x = {i}') == response
+    assert cache.get('explain', 'model', 'new') == 'a new response'
+    cache.close()
+
+
+def test_missing_dictionary_is_a_miss(tmp_path):
+    pytest.importorskip('zstandard')
+    cache = ResponseCache(str(tmp_path / 'c.cache'), max_entries=None)
+    fill(cache)
+    cache.train_dictionary(dict_size=4096)
+    cache._conn.execute('DELETE FROM dictionaries')
+    cache._conn.commit()
+    with pytest.raises(ValueError, match='missing'):
+        cache.codec.decode(b'', 'zstd:1')
+    with pytest.warns(UserWarning):
+        assert cache.get('explain', 'model', 'x = 1') is None
+    cache.close()
+
+
+def test_missing_zstandard_warns_once(tmp_path, monkeypatch):
+    pytest.importorskip('zstandard')
+    cache = ResponseCache(str(tmp_path / 'c.cache'), max_entries=None)
+    fill(cache)
+    cache.train_dictionary(dict_size=4096)
+    cache.codec._decompressors.clear()
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    monkeypatch.setattr(cache_module, '_warned_zstandard', False)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert cache.get('explain', 'model', 'x = 1') is None
+        assert cache.get('explain', 'model', 'x = 2') is None
+    assert len(caught) == 1
+    cache.close()
+
+
+CODE = 'import numpy as np\n\ndef f(x):\n    return np.sum(x ** 2)\n'
+
+
+def test_similarity_threshold(tmp_path):
+    cache = SimilarityCache(str(tmp_path / 's.cache'), max_entries=8, threshold=0.9)
+    cache.set('explain', 'model', CODE, 'sum of squares')
+    assert cache.get('explain', 'model', CODE) == 'sum of squares'
+    edited = CODE.replace('x ** 2', 'x**2')
+    assert cache.get('explain', 'model', edited) == 'sum of squares'
+    assert cache.get('explain', 'model', 'print("hello world")') is None
+    # Only the same prompt and model match
+    assert cache.get('debug', 'model', CODE) is None
+    assert cache.get('explain', 'other', CODE) is None
+
+    ((similarity, _),) = cache.lookup_many([('explain', 'model', edited)])[0]
+    cache.threshold = similarity + 1e-3
+    assert cache.get('explain', 'model', edited) is None
+    cache.close()
+
+
+def test_similarity_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / 's.cache')
+    cache = SimilarityCache(path, max_entries=8)
+    cache.set('explain', 'model', CODE, 'sum of squares')
+    cache.close()
+    cache = SimilarityCache(path, max_entries=8)
+    assert cache.get('explain', 'model', CODE) == 'sum of squares'
+    cache.close()
+
+
+def test_similarity_ttl(tmp_path, monkeypatch):
+    cache = SimilarityCache(str(tmp_path / 's.cache'), max_entries=8, ttl=60)
+    cache.set('explain', 'model', CODE, 'sum of squares')
+    assert cache.get('explain', 'model', CODE) == 'sum of squares'
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('explain', 'model', CODE) is None
+    cache.close()
+
+
+def test_similarity_clear(tmp_path):
+    cache = SimilarityCache(str(tmp_path / 's.cache'), max_entries=8)
+    cache.set('explain', 'model', CODE, 'sum of squares')
+    cache.clear()
+    assert cache.get('explain', 'model', CODE) is None
+    assert cache.stats()['entries'] == 0
+    cache.close()
+
+
+def test_similarity_cache_shared_by_kernels(tmp_path):
+    # Kernels started in the same directory open the same files
+    path = str(tmp_path / 's.cache')
+    first = SimilarityCache(path, max_entries=8)
+    second = SimilarityCache(path, max_entries=8)
+    first.set('explain', 'model', CODE, 'sum of squares')
+    second.set('debug', 'model', 'print("hello world")', 'no bug')
+    assert first.get('explain', 'model', CODE) == 'sum of squares'
+    assert first.get('debug', 'model', 'print("hello world")') == 'no bug'
+    assert second.get('explain', 'model', CODE) == 'sum of squares'
+
+    second.clear()
+    assert first.get('explain', 'model', CODE) is None
+    first.close()
+    second.close()
+
+
+def test_similarity_skips_overwritten_rows(tmp_path):
+    path = str(tmp_path / 's.cache')
+    cache = SimilarityCache(path, max_entries=8)
+    cache.set('explain', 'model', CODE, 'sum of squares')
+    # Another kernel overwriting the embedding, but not yet the response
+    (cache._vectors[0],) = embed_texts(['print("hello world")'])
+    assert cache.get('explain', 'model', 'print("hello world")') is None
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'c.cache'), max_entries=3)
+    for i in range(3):
+        cache.set('explain', 'model', f'x = {i}', f'r{i}')
+        time.sleep(0.01)
+    # Reading x = 0 makes x = 1 the least recently used
+    assert cache.get('explain', 'model', 'x = 0') == 'r0'
+    time.sleep(0.01)
+    cache.set('explain', 'model', 'x = 3', 'r3')
+    assert cache.contains('explain', 'model', 'x = 0')
+    assert not cache.contains('explain', 'model', 'x = 1')
+    assert cache.stats()['entries'] == 3
+    cache.close()
+
+
+def test_expires_after_ttl(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / 'c.cache'), ttl=60)
+    cache.set('explain', 'model', 'x = 1', 'r1')
+    assert cache.get('explain', 'model', 'x = 1') == 'r1'
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('explain', 'model', 'x = 1') is None
+    assert cache.stats()['misses'] == 1
+    cache.close()
+
+
+def cacher_config(**cache_config):
+    return {
+        'cache_config': dict(
+            {'cache': True, 'cache_db_version': 'test', 'url': None}, **cache_config
+        ),
+        'model_config': {'model': 'fake_model'},
+    }
+
+
+def test_cacher_never_evicts_precomputed_responses(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    precomputed = ResponseCache('NMA_2023_vtest.cache', max_entries=None)
+    model_id = cache_module.model_identity({'model': 'fake_model'})
+    for i in range(10):
+        precomputed.set('explain', model_id, f'x = {i}', f'precomputed {i}')
+    precomputed.close()
+
+    cacher = cache_module.LLMCacher(cacher_config(max_entries=2))
+    assert cacher.wait(5)
+    for i in range(5):
+        cacher.store('explain', f'y = {i}', f'generated {i}')
+    for i in range(10):
+        assert cacher.lookup('explain', f'x = {i}') == f'precomputed {i}'
+    assert cacher.lookup('explain', 'y = 4') == 'generated 4'
+    assert cacher.lookup('explain', 'y = 0') is None
+    assert cacher.stats()['entries'] == 10
+    assert cacher.stats()['local']['entries'] == 2
+
+
+def test_read_only_cache_never_writes(tmp_path):
+    path = str(tmp_path / 'c.cache')
+    cache = ResponseCache(path, ttl=60)
+    cache.set('explain', 'model', 'x = 1', 'r1')
+    cache.close()
+    with open(path, 'rb') as f:
+        before = f.read()
+
+    cache = ResponseCache(path, ttl=60, read_only=True)
+    assert cache.get('explain', 'model', 'x = 1') == 'r1'
+    assert cache.get('explain', 'model', 'x = 2') is None
+    with pytest.raises(sqlite3.OperationalError):
+        cache.set('explain', 'model', 'x = 2', 'r2')
+    cache.close()
+    with open(path, 'rb') as f:
+        assert f.read() == before
+
+
+def test_shared_lookups_do_not_wait_for_writers(tmp_path):
+    path = str(tmp_path / 'shared.cache')
+    cache = ResponseCache(path, shared=True, busy_timeout=0.1)
+    cache.set('explain', 'model', 'x = 1', 'r1')
+
+    writer = sqlite3.connect(path)
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute('UPDATE responses SET hits = 7')
+    start = time.monotonic()
+    for _ in range(3):
+        assert cache.get('explain', 'model', 'x = 1') == 'r1'
+    assert time.monotonic() - start < 0.1
+    writer.rollback()
+    writer.close()
+
+    # The lookups are recorded with the next write
+    cache.set('explain', 'model', 'x = 2', 'r2')
+    (hits,) = cache._conn.execute('SELECT hits FROM responses').fetchone()
+    assert hits == 3
+    cache.close()
+
+
+# A group both users of the shared cache tests belong to
+GROUP = 4242
+
+
+def in_process(uid, function, *args, groups=(GROUP,)):
+    """Runs function(*args) in a child process running as another user."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.umask(0o022)
+            os.setgroups(groups)
+            os.setgid(uid)
+            os.setuid(uid)
+            result = repr(function(*args))
+        except BaseException as e:
+            result = f'error: {e!r}'
+        os.write(write_end, result.encode('utf-8'))
+        os._exit(0)
+    os.close(write_end)
+    return pid, read_end
+
+
+def result(child):
+    pid, read_end = child
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as f:
+        return f.read()
+
+
+def store_and_wait(path, go):
+    cache = ResponseCache(path, shared=True, mode=0o660)
+    cache.set('explain', 'model', 'x = 1', 'from user 1')
+    # Keep the database, and its -wal and -shm files, open meanwhile
+    os.read(go, 1)
+    response = cache.get('explain', 'model', 'x = 2')
+    cache.close()
+    return response
+
+
+def read_and_store(path):
+    cache = ResponseCache(path, shared=True, mode=0o660)
+    response = cache.get('explain', 'model', 'x = 1')
+    cache.set('explain', 'model', 'x = 2', 'from user 2')
+    cache.close()
+    return response
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'fork') or os.geteuid() != 0, reason='needs root to switch users'
+)
+def test_shared_cache_is_writable_by_its_group():
+    # Owned by the group, whose files get the group too
+    directory = tempfile.mkdtemp()
+    os.chown(directory, 0, GROUP)
+    os.chmod(directory, 0o2770)
+    path = os.path.join(directory, 'shared.cache')
+
+    go_read, go_write = os.pipe()
+    first = in_process(1000, store_and_wait, path, go_read)
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(path + '-wal') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert result(in_process(65534, read_and_store, path)) == "'from user 1'"
+    finally:
+        os.write(go_write, b'x')
+    assert result(first) == "'from user 2'"
+    assert os.stat(path).st_mode & 0o777 == 0o660
+    assert os.stat(path).st_gid == GROUP
+    # Users outside the group cannot read it
+    assert result(in_process(65533, read_and_store, path, groups=())).startswith(
+        'error'
+    )
+    shutil.rmtree(directory)
+
+
+def test_shared_cache_respects_the_umask(tmp_path):
+    path = str(tmp_path / 'shared.cache')
+    umask = os.umask(0o022)
+    try:
+        ResponseCache(path, shared=True).close()
+    finally:
+        os.umask(umask)
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+
+def test_legacy_cache_is_not_used(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    # Caches written by older versions of Chatify with gptcache
+    conn = sqlite3.connect('NMA_2023_vtest.cache')
+    conn.execute('CREATE TABLE gptcache_question (id INTEGER PRIMARY KEY, question)')
+    conn.commit()
+    conn.close()
+    with pytest.raises(sqlite3.DatabaseError):
+        ResponseCache('NMA_2023_vtest.cache', read_only=True)
+
+    cacher = cache_module.LLMCacher(cacher_config())
+    assert cacher.wait(5)
+    assert 'not a Chatify response cache' in capsys.readouterr().out
+    assert cacher.response_cache is None
+    assert cacher.lookup('explain', 'x = 1') is None
+    cacher.store('explain', 'x = 1', 'generated')
+    assert cacher.lookup('explain', 'x = 1') == 'generated'
+
+
+def test_cacher_indexes_precomputed_responses(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    precomputed = ResponseCache(
+        'NMA_2023_vtest.cache', max_entries=None, keep_text=True
+    )
+    model_id = cache_module.model_identity({'model': 'fake_model'})
+    precomputed.set('explain', model_id, CODE, 'sum of squares')
+    precomputed.set('explain', 'other model', 'x = 1', 'other')
+    precomputed.close()
+
+    config = cacher_config(caching_strategy='similarity', similarity_threshold=0.9)
+    cacher = cache_module.LLMCacher(config)
+    assert cacher.wait(5)
+    edited = CODE.replace('x ** 2', 'x**2')
+    assert cacher.lookup('explain', edited) == 'sum of squares'
+    assert cacher.stats()['precomputed_similarity']['entries'] == 1
+
+    # The index is reused by the next kernel
+    monkeypatch.setattr(
+        cache_module, 'embed_texts', lambda *args, **kwargs: pytest.fail('reindexed')
+    )
+    cacher = cache_module.LLMCacher(config)
+    assert cacher.wait(5)
+    assert cacher.stats()['precomputed_similarity']['entries'] == 1
+
+
+def test_cacher_stores_in_the_shared_cache_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shared_path = str(tmp_path / 'shared.cache')
+    cacher = cache_module.LLMCacher(cacher_config(shared_path=shared_path))
+    assert cacher.wait(5)
+
+    # Another kernel holds the write lock
+    writer = sqlite3.connect(shared_path)
+    writer.execute('BEGIN IMMEDIATE')
+    start = time.monotonic()
+    cacher.store('explain', 'x = 1', 'generated')
+    assert time.monotonic() - start < 1
+    writer.rollback()
+    writer.close()
+
+    get_executor(1, name='chatify-shared-cache').submit(lambda: None).result()
+    model_id = cacher.model_id
+    assert cacher.shared_cache.get('explain', model_id, 'x = 1') == 'generated'
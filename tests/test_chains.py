@@ -0,0 +1,58 @@
+from chatify.cache import ResponseCache
+from chatify.chains import CreateLLMChain
+from chatify.utils import model_identity
+
+CELL = 'import numpy as np  # numerical library\n\n# square it\nx = np.arange(3) ** 2\n'
+
+
+class RecordingChain:
+    """Stands in for an LLM chain, recording what the model is sent."""
+
+    def __init__(self, prompt_id):
+        self.metadata = {'prompt_id': prompt_id}
+        self.inputs = []
+
+    def invoke(self, inputs, config=None):
+        self.inputs.append(inputs)
+        return {'text': f'response {len(self.inputs)}'}
+
+
+def make_llm_chain(**chain_config):
+    return CreateLLMChain(
+        {
+            'cache_config': {'cache': True, 'cache_db_version': 'test', 'url': None},
+            'feedback': False,
+            'model_config': {'model': 'fake_model'},
+            'chain_config': dict({'chain_type': 'default'}, **chain_config),
+            'prompts_config': {'prompts_to_use': ['tutor']},
+        }
+    )
+
+
+def test_precomputed_answers_hit_with_compaction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # As stored by chatify-build-cache: keyed on the cell as written
+    cache = ResponseCache('NMA_2023_vtest.cache', max_entries=None)
+    cache.set('explain', model_identity({'model': 'fake_model'}), CELL, 'precomputed')
+    cache.close()
+
+    llm_chain = make_llm_chain(compact_code=True)
+    assert llm_chain.cacher.wait(5)
+    chain = RecordingChain('explain')
+    assert llm_chain.execute(chain, CELL) == 'precomputed'
+    assert chain.inputs == []
+    llm_chain.close()
+
+
+def test_only_the_model_sees_compacted_code(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    llm_chain = make_llm_chain(compact_code=True)
+    assert llm_chain.cacher.wait(5)
+    chain = RecordingChain('explain')
+    assert llm_chain.execute(chain, CELL) == 'response 1'
+    assert chain.inputs == ['import numpy as np\n\nx = np.arange(3) ** 2']
+    # Stored under the cell as written
+    assert llm_chain.cacher.lookup('explain', CELL) == 'response 1'
+    assert llm_chain.execute(chain, CELL) == 'response 1'
+    assert len(chain.inputs) == 1
+    llm_chain.close()
@@ -0,0 +1,88 @@
+import ast
+
+from chatify.compaction import compact_code, estimate_tokens, truncate_to_budget
+
+
+def test_drops_comments_and_comment_lines():
+    code = "# setup\nx = 1  # one\n\n\n\ny = 2\n"
+    assert compact_code(code) == "x = 1\n\ny = 2"
+
+
+def test_keeps_hash_in_strings():
+    code = "url = 'http://example.com/#anchor'  # comment\n"
+    assert compact_code(code) == "url = 'http://example.com/#anchor'"
+
+
+def test_shortens_long_strings():
+    code = 'def f():\n    """' + "a" * 50 + '"""\n    return 1\n'
+    compacted = compact_code(code, max_literal_chars=10)
+    assert '"""aaaaaaaaaa..."""' in compacted
+    ast.parse(compacted)
+
+
+def test_shortened_string_never_escapes_its_quote():
+    code = "s = '" + "\\\\" * 20 + "'\n"
+    ast.parse(compact_code(code, max_literal_chars=3))
+
+
+def test_collapses_long_literal_arrays():
+    code = "data = [" + ", ".join(map(str, range(100))) + "]\n"
+    compacted = compact_code(code, max_sequence_items=3)
+    assert compacted == "data = [0, 1, 2, ...]"
+
+
+def test_collapses_arrays_with_non_ascii_items():
+    items = ', '.join(repr(f'é{i}') for i in range(20))
+    code = f"names = [{items}]\nprint(names)\n"
+    compacted = compact_code(code, max_sequence_items=2)
+    assert compacted == "names = ['é0', 'é1', ...]\nprint(names)"
+
+
+def test_collapses_multi_line_arrays():
+    code = "data = [\n    'ü',\n" + "".join(f"    {i},\n" for i in range(30)) + "]\n"
+    code += "print(data)\n"
+    compacted = compact_code(code, max_sequence_items=3)
+    assert compacted == "data = [\n    'ü',\n    0,\n    1, ...,\n]\nprint(data)"
+    ast.parse(compacted)
+
+
+def test_keeps_non_literal_arrays():
+    code = "data = [" + ", ".join(f"f({i})" for i in range(20)) + "]"
+    assert compact_code(code, max_sequence_items=3) == code
+
+
+def test_keeps_shell_lines_intact():
+    code = "!pip install git+https://github.com/x/y.git#egg=y\nx = 1  # one\n"
+    assert compact_code(code) == (
+        "!pip install git+https://github.com/x/y.git#egg=y\nx = 1"
+    )
+
+
+def test_magics_do_not_prevent_compaction():
+    code = "%matplotlib inline\ndata = [" + ", ".join(map(str, range(20))) + "]\n"
+    compacted = compact_code(code, max_sequence_items=2)
+    assert compacted == "%matplotlib inline\ndata = [0, 1, ...]"
+
+
+def test_operators_at_line_start_are_not_magics():
+    code = "y = (1\n     % 2)  # mod\nz = (1\n     != 2)\n"
+    assert compact_code(code) == "y = (1\n     % 2)\nz = (1\n     != 2)"
+
+
+def test_cell_magics_are_left_alone():
+    code = "%%bash\necho hi  # not a Python comment\n"
+    assert compact_code(code) == code
+
+
+def test_invalid_code_keeps_edits_before_the_error():
+    code = "x = 1  # one\ns = '''unterminated\n"
+    assert compact_code(code).startswith("x = 1\n")
+
+
+def test_truncate_to_budget():
+    text = "\n".join(f"line_{i} = {i}" for i in range(100))
+    truncated = truncate_to_budget(text, 50, estimate_tokens)
+    assert estimate_tokens(truncated) <= 50
+    assert truncated.startswith("line_0 = 0\n")
+    assert truncated.endswith("more lines)")
+    assert truncate_to_budget("x = 1", 50, estimate_tokens) == "x = 1"
@@ -0,0 +1,183 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+import requests
+
+from chatify.cache import LLMCacher, ResponseCache
+from chatify.download import CHUNK_SIZE, ChecksumError, download_file
+from chatify.utils import model_identity
+
+CONTENT = os.urandom(300_000)
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        content, etag = server.content, server.etag
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', etag) == etag:
+            start = int(byte_range[len('bytes=') :].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}'
+            )
+        else:
+            self.send_response(200)
+        body = content[start:]
+        # Simulates a dropped connection after this many bytes
+        if server.fail_after is not None:
+            body = body[: server.fail_after]
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(body)
+        if server.fail_after is not None:
+            server.fail_after = None
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.daemon_threads = True
+    server.content, server.etag = CONTENT, '"v1"'
+    server.fail_after = None
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/db.cache'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_downloads_and_skips_current_file(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    sha256 = hashlib.sha256(CONTENT).hexdigest()
+    assert download_file(file_server.url, path, sha256=sha256)
+    assert read(path) == CONTENT
+    assert not os.path.exists(path + '.part')
+    # A file with the expected checksum is not requested again
+    assert not download_file(file_server.url, path, sha256=sha256)
+    assert len(file_server.requests) == 1
+
+
+def test_not_modified(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    assert download_file(file_server.url, path)
+    assert not download_file(file_server.url, path)
+    assert file_server.requests[-1]['If-None-Match'] == '"v1"'
+
+    # A changed file is downloaded again
+    file_server.content, file_server.etag = CONTENT[::-1], '"v2"'
+    assert download_file(file_server.url, path)
+    assert read(path) == CONTENT[::-1]
+
+
+def test_resumes_interrupted_download(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    file_server.fail_after = 100_000
+    with pytest.raises(requests.RequestException):
+        download_file(file_server.url, path)
+    # Only the chunk being read when the connection dropped is lost
+    offset = os.path.getsize(path + '.part')
+    assert 100_000 - CHUNK_SIZE < offset <= 100_000
+    assert not os.path.exists(path)
+
+    assert download_file(file_server.url, path)
+    assert file_server.requests[-1]['Range'] == f'bytes={offset}-'
+    assert file_server.requests[-1]['If-Range'] == '"v1"'
+    assert read(path) == CONTENT
+
+
+def test_restarts_when_file_changed_during_download(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    file_server.fail_after = 100_000
+    with pytest.raises(requests.RequestException):
+        download_file(file_server.url, path)
+
+    # If-Range no longer matches, so the server sends the whole new file
+    file_server.content, file_server.etag = CONTENT[::-1], '"v2"'
+    assert download_file(file_server.url, path)
+    assert read(path) == CONTENT[::-1]
+
+
+def test_restarts_on_unsatisfiable_range(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    file_server.fail_after = 100_000
+    with pytest.raises(requests.RequestException):
+        download_file(file_server.url, path)
+
+    # The partial file is longer than the (same version of the) file
+    file_server.content = CONTENT[:50_000]
+    assert download_file(file_server.url, path)
+    ranges = [r.get('Range') for r in file_server.requests[-2:]]
+    assert ranges[0] is not None and ranges[1] is None
+    assert read(path) == CONTENT[:50_000]
+
+
+def test_bad_checksum_discards_the_download(file_server, tmp_path):
+    path = str(tmp_path / 'db.cache')
+    with pytest.raises(ChecksumError):
+        download_file(file_server.url, path, sha256='0' * 64)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def test_cacher_keeps_the_downloaded_database_unchanged(
+    file_server, tmp_path, monkeypatch
+):
+    built = str(tmp_path / 'built.cache')
+    cache = ResponseCache(built, max_entries=None)
+    model_id = model_identity({'model': 'fake_model'})
+    cache.set('explain', model_id, 'x = 1', 'precomputed')
+    cache.close()
+    file_server.content = read(built)
+    sha256 = hashlib.sha256(file_server.content).hexdigest()
+
+    monkeypatch.chdir(tmp_path)
+    config = {
+        'cache_config': {
+            'cache': True,
+            'cache_db_version': 'test',
+            'url': file_server.url,
+            'sha256': sha256,
+        },
+        'model_config': {'model': 'fake_model'},
+    }
+    for session in range(2):
+        cacher = LLMCacher(config)
+        assert cacher.wait(5)
+        assert cacher.lookup('explain', 'x = 1') == 'precomputed'
+        cacher.store('explain', f'y = {session}', 'generated')
+        assert cacher.lookup('explain', f'y = {session}') == 'generated'
+        assert cacher.download.result() == (session == 0)
+
+    assert len(file_server.requests) == 1
+    assert read('NMA_2023_vtest.cache') == file_server.content
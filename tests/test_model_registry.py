@@ -0,0 +1,87 @@
+import gc
+import threading
+import time
+import weakref
+
+from langchain_community.llms.fake import FakeListLLM
+
+from chatify.batching import BatchingLLM
+from chatify.model_registry import ModelRegistry, model_key
+
+CONFIG = {'model': 'fake_model', 'batch_size': 2}
+
+
+class CountingRegistry(ModelRegistry):
+    def __init__(self, load_delay=0):
+        super().__init__()
+        self.loads = 0
+        self.load_delay = load_delay
+
+    def _load(self, model_config):
+        self.loads += 1
+        time.sleep(self.load_delay)
+        return BatchingLLM(llm=FakeListLLM(responses=['response']))
+
+
+def test_model_key_ignores_client_settings():
+    assert model_key(CONFIG) == model_key(dict(CONFIG, read_timeout=30))
+    assert model_key(CONFIG) == model_key(dict(CONFIG, max_length=None))
+    assert model_key(CONFIG) != model_key(dict(CONFIG, batch_size=4))
+
+
+def test_models_are_shared_and_reference_counted():
+    registry = CountingRegistry()
+    model = registry.acquire(CONFIG)
+    assert registry.acquire(dict(CONFIG)) is model
+    assert registry.loads == 1
+    assert registry.stats()[0]['refs'] == 2
+
+    # Models in use are only evicted when forced
+    assert registry.evict() == 0
+    registry.release(CONFIG)
+    assert registry.evict(CONFIG) == 0
+    registry.release(CONFIG)
+    assert registry.evict(CONFIG) == 1
+    assert registry.stats() == []
+
+    assert registry.acquire(CONFIG) is not model
+    assert registry.loads == 2
+
+
+def test_concurrent_first_loads_load_once():
+    registry = CountingRegistry(load_delay=0.1)
+    models = []
+
+    def acquire():
+        models.append(registry.acquire(CONFIG))
+
+    threads = [threading.Thread(target=acquire) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.loads == 1
+    assert len(models) == 8
+    assert all(model is models[0] for model in models)
+    assert registry.stats()[0]['refs'] == 8
+
+
+def test_evicting_frees_the_model():
+    registry = CountingRegistry()
+    model = registry.acquire(CONFIG)
+    # Starts the batching worker thread, which references the model
+    assert model.invoke('x = 1') == 'response'
+    freed = weakref.ref(model)
+    del model
+    registry.release(CONFIG)
+    assert registry.evict() == 1
+    gc.collect()
+    assert freed() is None
+
+
+def test_force_evicted_models_keep_working():
+    registry = CountingRegistry()
+    model = registry.acquire(CONFIG)
+    assert registry.evict(force=True) == 1
+    assert model.invoke('x = 1') == 'response'
+    model.close()
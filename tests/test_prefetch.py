@@ -0,0 +1,64 @@
+import threading
+
+from chatify.prefetch import Prefetcher
+
+
+def blocked_prefetcher():
+    # One worker, busy until released, so that further prefetches stay pending
+    prefetcher = Prefetcher(max_workers=1)
+    release = threading.Event()
+    running = threading.Event()
+
+    def block():
+        running.set()
+        release.wait(5)
+        return 'blocked'
+
+    prefetcher.submit('running', block)
+    running.wait(5)
+    return prefetcher, release
+
+
+def test_prefetches_are_reused():
+    prefetcher = Prefetcher(max_workers=1)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return 'response'
+
+    future = prefetcher.submit('key', fetch)
+    assert prefetcher.submit('key', fetch) is future
+    assert prefetcher.get('key').result(5) == 'response'
+    assert calls == [1]
+    assert prefetcher.get('other') is None
+
+
+def test_cancels_pending_prefetches():
+    prefetcher, release = blocked_prefetcher()
+    prefetcher.submit('kept', str, 'kept')
+    pending = prefetcher.submit('pending', str, 'pending')
+    assert prefetcher.cancel(keep=lambda key: key == 'kept') == 1
+    assert pending.cancelled()
+    assert prefetcher.get('pending') is None
+    release.set()
+    assert prefetcher.get('running').result(5) == 'blocked'
+    assert prefetcher.get('kept').result(5) == 'kept'
+
+
+def test_claimed_prefetches_are_not_cancelled():
+    prefetcher, release = blocked_prefetcher()
+    prefetcher.submit('pending', str, 'pending')
+    # A submitted request waits for the prefetch, then the user moves on
+    future = prefetcher.get('pending')
+    assert prefetcher.cancel() == 0
+    release.set()
+    assert future.result(5) == 'pending'
+
+
+def test_failed_prefetches_are_discarded():
+    prefetcher = Prefetcher(max_workers=1)
+    future = prefetcher.submit('key', int, 'not a number')
+    future.exception(5)
+    assert prefetcher.get('key') is None
+    assert prefetcher.submit('key', int, '1').result(5) == 1
@@ -0,0 +1,125 @@
+import types
+
+import numpy as np
+
+from chatify.prefix_cache import attach_prefix_cache, template_prefix, warm_prefixes
+
+PROMPTS = [
+    {
+        'content': 'SYSTEM: You explain code.\nCODE: {text}\nEXPLANATION:',
+        'input_variables': ['text'],
+    },
+    {
+        'content': 'SYSTEM: You find bugs.\nCODE: {text}\nBUGS:',
+        'input_variables': ['text'],
+    },
+]
+
+
+def longest_token_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class FakeLlama:
+    """Calls its cache like llama_cpp.Llama._create_completion (0.2.90) does."""
+
+    model_path = 'model.gguf'
+
+    def __init__(self):
+        self.cache = None
+        self._input_ids = np.array([], dtype=np.intc)
+        self.saved = 0
+        self.loaded = 0
+
+    def n_ctx(self):
+        return 512
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def tokenize(self, text):
+        return list(text)
+
+    def save_state(self):
+        # The expensive copy of the KV cache
+        self.saved += 1
+        return types.SimpleNamespace(
+            input_ids=self._input_ids.copy(),
+            scores=np.zeros((len(self._input_ids), 4), dtype=np.single),
+            n_tokens=len(self._input_ids),
+            llama_state=bytes(len(self._input_ids)),
+            llama_state_size=len(self._input_ids),
+        )
+
+    def load_state(self, state):
+        self.loaded += 1
+        self._input_ids = np.asarray(state.input_ids).copy()
+
+    def create_completion(self, prompt, max_tokens=16):
+        prompt_tokens = self.tokenize(prompt.encode('utf-8'))
+        if self.cache:
+            try:
+                cache_item = self.cache[prompt_tokens]
+                cache_prefix_len = longest_token_prefix(
+                    cache_item.input_ids.tolist(), prompt_tokens
+                )
+                eval_prefix_len = longest_token_prefix(
+                    self._input_ids.tolist(), prompt_tokens
+                )
+                if cache_prefix_len > eval_prefix_len:
+                    self.load_state(cache_item)
+            except KeyError:
+                pass
+        completion_tokens = [0]
+        self._input_ids = np.array(prompt_tokens + completion_tokens, dtype=np.intc)
+        if self.cache:
+            self.cache[prompt_tokens + completion_tokens] = self.save_state()
+        return {'choices': [{'text': ''}]}
+
+
+def prompt(template, text):
+    return template['content'].replace('{text}', text)
+
+
+def test_template_prefix():
+    assert template_prefix(PROMPTS[0]) == 'SYSTEM: You explain code.\nCODE: '
+    assert template_prefix({'content': 'a {{b}}', 'input_variables': []}) == 'a {b}'
+
+
+def test_warmed_prefixes_are_restored_without_saving_states():
+    client = FakeLlama()
+    cache = attach_prefix_cache(client, {})
+    # Requests before warming are not stored
+    client.create_completion(prompt(PROMPTS[0], 'x = 1'))
+    assert client.saved == 0
+
+    assert warm_prefixes(types.SimpleNamespace(client=client), PROMPTS) == 2
+    assert client.saved == 2
+    assert not cache.wants_states
+
+    for i in range(4):
+        client.create_completion(prompt(PROMPTS[i % 2], f'x = {i}'))
+    # Switching prompts restores the other prefix's state
+    assert client.loaded == 4
+    assert client.saved == 2
+    assert warm_prefixes(types.SimpleNamespace(client=client), PROMPTS) == 0
+
+
+def test_persisted_states_are_reused(tmp_path):
+    config = {'prefix_cache_dir': str(tmp_path)}
+    client = FakeLlama()
+    attach_prefix_cache(client, config)
+    assert warm_prefixes(types.SimpleNamespace(client=client), PROMPTS) == 2
+
+    # A restarted kernel
+    client = FakeLlama()
+    attach_prefix_cache(client, config)
+    assert warm_prefixes(types.SimpleNamespace(client=client), PROMPTS) == 0
+    client.create_completion(prompt(PROMPTS[1], 'x = 1'))
+    assert client.loaded == 1
+    assert client.saved == 0
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+import yaml
+
+from chatify import prompt_registry
+from chatify.prompt_registry import PromptRegistry, build_bundle, compile_prompts
+from chatify.utils import fingerprint
+
+PROMPTS = '''
+explain:
+  input_variables: ['text']
+  content: 'SYSTEM: Explain {text}'
+debug:
+  input_variables: ['text']
+  content: 'SYSTEM: Debug {text}'
+  prompt_id: debug-prompt
+'''
+
+
+@pytest.fixture
+def prompt_dir(tmp_path):
+    (tmp_path / 'course.yaml').write_text(PROMPTS)
+    return tmp_path
+
+
+def test_lookup_by_name_and_id(prompt_dir):
+    registry = PromptRegistry(prompt_dir, bundle_file=None)
+    prompts = registry.get('course')
+    assert set(prompts) == {'explain', 'debug'}
+    assert registry.get('course') is prompts
+    assert registry.names() == ['course']
+    assert registry.get_many(['course', 'missing']) == {'course': prompts}
+
+    # A fresh registry loads the prompt files to find an id
+    registry = PromptRegistry(prompt_dir, bundle_file=None)
+    assert registry.by_id('debug-prompt')['content'] == 'SYSTEM: Debug {text}'
+
+
+def test_unknown_prompts(prompt_dir):
+    registry = PromptRegistry(prompt_dir, bundle_file=None)
+    with pytest.raises(FileNotFoundError):
+        registry.get('missing')
+    assert registry.by_id('missing') is None
+    with pytest.raises(KeyError, match="'broken' has no 'input_variables'"):
+        compile_prompts({'broken': {'content': 'SYSTEM:'}})
+
+
+def test_prompt_ids_are_stable(prompt_dir):
+    registry = PromptRegistry(prompt_dir, bundle_file=None)
+    explain = registry.get('course')['explain']
+    # Derived ids key cached responses, so they must never change
+    assert explain['prompt_id'] == fingerprint('SYSTEM: Explain {text}')
+    assert fingerprint('SYSTEM: {text}') == '6a4aa440e4c8742dbed0ee8de4c5f57f20d1b963'
+    assert PromptRegistry(prompt_dir, bundle_file=None).by_id(explain['prompt_id'])
+
+    tutor = prompt_registry.get_registry().get('tutor')
+    assert (
+        tutor['understand what this code does']['prompt_id']
+        == 'q44yic3bwec36ax3k04xrrp7h6bb4c2n'
+    )
+
+
+def test_changed_files_are_reloaded(prompt_dir):
+    registry = PromptRegistry(prompt_dir, bundle_file=None)
+    old_id = registry.get('course')['explain']['prompt_id']
+    path = prompt_dir / 'course.yaml'
+    path.write_text(PROMPTS.replace('Explain', 'Summarize'))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    explain = registry.get('course')['explain']
+    assert explain['content'] == 'SYSTEM: Summarize {text}'
+    assert explain['prompt_id'] != old_id
+    assert registry.by_id(explain['prompt_id']) is explain
+
+
+def test_bundled_prompts_match_the_files(prompt_dir, tmp_path, monkeypatch):
+    bundle_file = tmp_path / 'bundle.json'
+    build_bundle(prompt_dir, bundle_file)
+    expected = PromptRegistry(prompt_dir, bundle_file=None).get('course')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('parsed an unchanged prompt file')
+
+    monkeypatch.setattr(yaml, 'load', fail)
+    assert PromptRegistry(prompt_dir, bundle_file).get('course') == expected
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+import pytest
+
+from chatify.server import HTTPError, ProxyServer
+
+PROMPT = {'prompt_id': 'tutor'}
+
+
+def make_server(**server_config):
+    config = {
+        'cache_config': {'cache': False, 'cache_db_version': 0.1, 'url': None},
+        'feedback': False,
+        'model_config': {'model': 'fake_model'},
+        'chain_config': {'chain_type': 'default'},
+        'prompts_config': {'prompts_to_use': ['tutor']},
+        'server_config': dict({'cache_path': None}, **server_config),
+    }
+    server = ProxyServer(config)
+    # The model blocks until released, so that requests pile up
+    server.release = threading.Event()
+
+    def generate(prompt, user_text, on_update=None):
+        server.release.wait(5)
+        return f'answer to {user_text}'
+
+    server._generate = generate
+    return server
+
+
+async def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+
+def test_identical_requests_share_one_model_call():
+    server = make_server()
+
+    async def run():
+        tasks = [
+            asyncio.ensure_future(server.respond(PROMPT, 'x = 1')) for _ in range(5)
+        ]
+        await wait_for(lambda: server.counters['coalesced'] == 4)
+        server.release.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run()) == ['answer to x = 1'] * 5
+    assert server.counters['model_calls'] == 1
+    server.close()
+
+
+def test_rejects_requests_beyond_the_queue():
+    server = make_server(max_concurrency=1, max_queue=1)
+
+    async def run():
+        tasks = [
+            asyncio.ensure_future(server.respond(PROMPT, f'x = {i}')) for i in range(2)
+        ]
+        await wait_for(lambda: server._active == 2)
+        with pytest.raises(HTTPError) as error:
+            await server.respond(PROMPT, 'x = 2')
+        server.release.set()
+        await asyncio.gather(*tasks)
+        return error.value
+
+    error = asyncio.run(run())
+    assert error.status == 503
+    assert 'retry-after' in error.headers
+    assert server.counters['rejected'] == 1
+    server.close()
+
+
+def test_followers_of_a_cancelled_request_fail_fast():
+    server = make_server()
+
+    async def run():
+        leader = asyncio.ensure_future(server.respond(PROMPT, 'x = 1'))
+        await wait_for(lambda: server.counters['model_calls'] == 1)
+        follower = asyncio.ensure_future(server.respond(PROMPT, 'x = 1'))
+        await wait_for(lambda: server.counters['coalesced'] == 1)
+        leader.cancel()
+        try:
+            with pytest.raises(HTTPError) as error:
+                await asyncio.wait_for(follower, 2)
+        finally:
+            server.release.set()
+        return error.value
+
+    assert asyncio.run(run()).status == 503
+    assert server._inflight == {}
+    server.close()
+
+
+def test_cache_lookups_do_not_block_the_event_loop(tmp_path):
+    server = make_server(cache_path=str(tmp_path / 'server.cache'))
+    server.release.set()
+    looking_up = threading.Event()
+    unblock = threading.Event()
+    get = server.cache.get
+
+    def slow_get(*args):
+        # E.g. waiting for another process's write lock
+        looking_up.set()
+        unblock.wait(5)
+        return get(*args)
+
+    server.cache.get = slow_get
+
+    async def run():
+        task = asyncio.ensure_future(server.respond(PROMPT, 'x = 1'))
+        # The loop keeps running while the lookup waits
+        await wait_for(looking_up.is_set)
+        assert not task.done()
+        unblock.set()
+        first = await task
+        return first, await server.respond(PROMPT, 'x = 1')
+
+    assert asyncio.run(run()) == ('answer to x = 1', 'answer to x = 1')
+    assert server.counters['model_calls'] == 1
+    assert server.counters['cache_hits'] == 1
+    server.close()
@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+
+import pytest
+
+from chatify.stats import StatsRecorder, current_trace, label, percentile, span
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Spans read the time from a clock the test advances
+    now = [0.0]
+    monkeypatch.setattr(time, 'perf_counter', lambda: now[0])
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return advance
+
+
+def test_nested_spans_exclude_the_inner_time(clock):
+    recorder = StatsRecorder()
+    with recorder.request(prompt_id='explain'):
+        with span('chain'):
+            clock(1)
+            with span('model'):
+                clock(3)
+            with span('model'):
+                clock(2)
+        clock(0.5)
+
+    (request,) = recorder.requests()
+    assert request['spans'] == {'chain': 1, 'model': 5}
+    assert request['total'] == 6.5
+    assert request['status'] == 'ok'
+    assert request['prompt_id'] == 'explain'
+
+
+def test_spans_outside_a_request_do_nothing():
+    recorder = StatsRecorder()
+    with span('model'):
+        label(cache='hit')
+    assert current_trace() is None
+    assert recorder.requests() == []
+
+
+def test_failed_requests_are_recorded():
+    recorder = StatsRecorder()
+    with pytest.raises(ValueError):
+        with recorder.request():
+            label(cache='miss')
+            raise ValueError('model failed')
+    (request,) = recorder.requests()
+    assert request['status'] == 'error'
+    assert request['cache'] == 'miss'
+
+
+def test_threads_only_trace_in_a_copy_of_the_context(clock):
+    recorder = StatsRecorder()
+    entered = threading.Event()
+    model_done = threading.Event()
+    seen = []
+
+    def work():
+        with span('decode'):
+            entered.set()
+            model_done.wait(5)
+            clock(2)
+
+    def untraced():
+        seen.append(current_trace())
+        with span('render'):
+            clock(10)
+
+    with recorder.request():
+        thread = threading.Thread(target=untraced)
+        thread.start()
+        thread.join()
+
+        # The worker's span is still open when the model span closes
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(work,))
+        with span('model'):
+            worker.start()
+            entered.wait(5)
+            clock(3)
+        model_done.set()
+        worker.join()
+
+    assert seen == [None]
+    (request,) = recorder.requests()
+    assert request['spans'] == {'model': 3, 'decode': 5}
+
+
+def test_concurrent_requests_are_traced_apart():
+    recorder = StatsRecorder()
+    barrier = threading.Barrier(4)
+
+    def run(i):
+        with recorder.request(prompt_id=i):
+            barrier.wait(5)
+            with span(f'stage{i}'):
+                label(index=i)
+                barrier.wait(5)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    requests = sorted(recorder.requests(), key=lambda request: request['prompt_id'])
+    for i, request in enumerate(requests):
+        assert request['index'] == i
+        assert list(request['spans']) == [f'stage{i}']
+
+
+def test_asyncio_tasks_are_traced_apart():
+    recorder = StatsRecorder()
+
+    async def run(i):
+        with recorder.request(prompt_id=i):
+            with span('model'):
+                await asyncio.sleep(0.01)
+                label(trace=id(current_trace()))
+
+    async def main():
+        await asyncio.gather(*(run(i) for i in range(3)))
+
+    asyncio.run(main())
+    requests = recorder.requests()
+    assert len({request['trace'] for request in requests}) == 3
+    assert all(list(request['spans']) == ['model'] for request in requests)
+
+
+def test_summary_percentiles():
+    recorder = StatsRecorder(max_requests=3)
+    for total in (4.0, 1.0, 2.0, 3.0):
+        recorder.record({'total': total, 'status': 'ok', 'spans': {'model': total}})
+    summary = recorder.summary(percentiles=(50, 100))
+    # Only the 3 most recent requests are kept
+    assert summary['model'] == {'count': 3, 'p50': 2.0, 'p100': 3.0}
+    assert list(summary) == ['model', 'total']
+    assert math.isnan(percentile([], 50))
+    assert percentile([1.0, 2.0], 25) == 1.25
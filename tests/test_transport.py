@@ -0,0 +1,100 @@
+import time
+
+import pytest
+import requests
+import stub_server
+
+from chatify.transport import (
+    JSON,
+    NDJSON,
+    SSE,
+    ProxyTransport,
+    decode_response,
+    iter_chunks,
+)
+
+
+def url(server):
+    return server.proxy_url + 'tutor/response'
+
+
+def test_post_decodes_json(proxy_server):
+    transport = ProxyTransport()
+    response = transport.post(url(proxy_server), {'user_text': 'x = 1'})
+    assert decode_response(response.content) == stub_server.RESPONSE
+
+
+@pytest.mark.parametrize('accept', [SSE, NDJSON, JSON])
+def test_streamed_chunks(proxy_server, accept):
+    transport = ProxyTransport()
+    response = transport.post(
+        url(proxy_server), {'user_text': 'x'}, headers={'Accept': accept}, stream=True
+    )
+    assert ''.join(iter_chunks(response)) == stub_server.RESPONSE
+
+
+def test_retries_transient_errors(proxy_server):
+    proxy_server.failures += [(503, {}), (429, {})]
+    transport = ProxyTransport(max_retries=2, retry_backoff=0.01)
+    response = transport.post(url(proxy_server), {'user_text': 'x'})
+    assert response.status_code == 200
+    assert proxy_server.requests == 3
+
+
+def test_gives_up_after_max_retries(proxy_server):
+    proxy_server.failures += [(503, {})] * 3
+    transport = ProxyTransport(max_retries=1, retry_backoff=0.01)
+    with pytest.raises(requests.HTTPError):
+        transport.post(url(proxy_server), {'user_text': 'x'})
+    assert proxy_server.requests == 2
+
+
+def test_does_not_retry_client_errors(proxy_server):
+    proxy_server.failures.append((400, {}))
+    transport = ProxyTransport(max_retries=2, retry_backoff=0.01)
+    with pytest.raises(requests.HTTPError):
+        transport.post(url(proxy_server), {'user_text': 'x'})
+    assert proxy_server.requests == 1
+
+
+def test_honours_retry_after(proxy_server):
+    proxy_server.failures.append((503, {'Retry-After': '0.5'}))
+    transport = ProxyTransport(max_retries=1, retry_backoff=0)
+    start = time.monotonic()
+    transport.post(url(proxy_server), {'user_text': 'x'})
+    assert time.monotonic() - start >= 0.5
+
+
+def test_retry_after_is_capped_by_the_deadline(proxy_server):
+    proxy_server.failures += [(503, {'Retry-After': '30'})] * 2
+    transport = ProxyTransport(max_retries=5, deadline=0.5)
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        transport.post(url(proxy_server), {'user_text': 'x'})
+    assert time.monotonic() - start < 5
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_deadline_covers_a_slow_body(proxy_server, stream):
+    # Every read returns within the read timeout, but the body takes longer
+    # than the deadline
+    proxy_server.chunk_delay = 0.05
+    transport = ProxyTransport(read_timeout=5, deadline=0.3)
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        response = transport.post(
+            url(proxy_server),
+            {'user_text': 'x'},
+            headers={'Accept': NDJSON},
+            stream=stream,
+        )
+        list(iter_chunks(response))
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.parametrize(
+    'body', [b'not json', b'["x = 1"]', b'{"user_text": 1}', b'{}']
+)
+def test_stub_rejects_malformed_requests(proxy_server, body):
+    response = requests.post(url(proxy_server), data=body)
+    assert response.status_code == 400
@@ -0,0 +1,15 @@
+from chatify.workers import get_executor
+
+
+def test_executors_are_shared_by_name_and_size():
+    executor = get_executor(2, name="test-workers")
+    assert get_executor(2, name="test-workers") is executor
+    assert get_executor(2, name="test-workers-other") is not executor
+
+
+def test_other_size_does_not_shut_down_the_pool():
+    executor = get_executor(2, name="test-workers-size")
+    other = get_executor(3, name="test-workers-size")
+    assert other is not executor
+    # The first pool is still usable by whoever holds it
+    assert executor.submit(lambda: 42).result() == 42